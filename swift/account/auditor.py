@@ -24,6 +24,7 @@ from swift.account.backend import AccountBroker
 from swift.common.utils import get_logger, audit_location_generator, \
     config_true_value, dump_recon_cache, ratelimit_sleep
 from swift.common.daemon import Daemon
+from swift.common.db_auditor import DatabaseCompactor
 
 from eventlet import Timeout
 
@@ -40,10 +41,12 @@ class AccountAuditor(Daemon):
         self.account_passes = 0
         self.account_failures = 0
         self.accounts_running_time = 0
+        self.compactor = DatabaseCompactor(conf, self.logger, 'account')
         self.max_accounts_per_second = \
             float(conf.get('accounts_per_second', 200))
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        swift.common.db.DB_WAL = config_true_value(conf.get('db_wal', 'f'))
         self.recon_cache_path = conf.get('recon_cache_path',
                                          '/var/cache/swift')
         self.rcache = os.path.join(self.recon_cache_path, "account.recon")
@@ -62,11 +65,11 @@ class AccountAuditor(Daemon):
                                  {'time': time.ctime(reported),
                                   'passed': self.account_passes,
                                   'failed': self.account_failures})
-                dump_recon_cache({'account_audits_since': reported,
-                                  'account_audits_passed': self.account_passes,
-                                  'account_audits_failed':
-                                  self.account_failures},
-                                 self.rcache, self.logger)
+                recon = {'account_audits_since': reported,
+                         'account_audits_passed': self.account_passes,
+                         'account_audits_failed': self.account_failures}
+                recon.update(self.compactor.report(reported))
+                dump_recon_cache(recon, self.rcache, self.logger)
                 reported = time.time()
                 self.account_passes = 0
                 self.account_failures = 0
@@ -116,9 +119,11 @@ class AccountAuditor(Daemon):
             broker = AccountBroker(path)
             if not broker.is_deleted():
                 broker.get_info()
+                broker.checkpoint()
                 self.logger.increment('passes')
                 self.account_passes += 1
                 self.logger.debug(_('Audit passed for %s') % broker)
+                self.compactor.compact(broker)
         except (Exception, Timeout):
             self.logger.increment('failures')
             self.account_failures += 1
@@ -26,7 +26,32 @@ import sqlite3
 
 from swift.common.utils import normalize_timestamp, lock_parent_directory
 from swift.common.db import DatabaseBroker, DatabaseConnectionError, \
-    PENDING_CAP, PICKLE_PROTOCOL, utf8encode
+    PENDING_CAP, PICKLE_PROTOCOL, utf8encode, mark_dirty
+
+
+def _merge_container_record(record, row):
+    """
+    Merges an existing container row into a newer record for the same
+    container, in place: fields missing from the record are taken from the
+    row, the newest put and delete timestamps are kept, and the record is
+    marked deleted if it was deleted after its last put and has no objects.
+
+    :param record: list of [name, put_timestamp, delete_timestamp,
+                   object_count, bytes_used, deleted]
+    :param row: the existing row, in the same order
+    """
+    for i in xrange(5):
+        if record[i] is None and row[i] is not None:
+            record[i] = row[i]
+    if row[1] > record[1]:  # Keep newest put_timestamp
+        record[1] = row[1]
+    if row[2] > record[2]:  # Keep newest delete_timestamp
+        record[2] = row[2]
+    # If deleted, mark as such
+    if record[2] > record[1] and record[3] in (None, '', 0, '0'):
+        record[5] = 1
+    else:
+        record[5] = 0
 
 
 class AccountBroker(DatabaseBroker):
@@ -34,6 +59,8 @@ class AccountBroker(DatabaseBroker):
     db_type = 'account'
     db_contains_type = 'container'
     db_reclaim_timestamp = 'delete_timestamp'
+    db_hash_value = "put_timestamp || '-' || delete_timestamp || '-' || " \
+        "object_count || '-' || bytes_used"
 
     def _initialize(self, conn, put_timestamp):
         """
@@ -120,7 +147,8 @@ class AccountBroker(DatabaseBroker):
                 id TEXT,
                 status TEXT DEFAULT '',
                 status_changed_at TEXT DEFAULT '0',
-                metadata TEXT DEFAULT ''
+                metadata TEXT DEFAULT '',
+                reclaim_point TEXT DEFAULT ''
             );
 
             INSERT INTO account_stat (container_count) VALUES (0);
@@ -226,6 +254,7 @@ class AccountBroker(DatabaseBroker):
                          bytes_used, deleted),
                         protocol=PICKLE_PROTOCOL).encode('base64'))
                     fp.flush()
+            mark_dirty(self.db_file, self.logger)
 
     def is_deleted(self):
         """
@@ -360,58 +389,66 @@ class AccountBroker(DatabaseBroker):
                           'deleted'}
         :param source: if defined, update incoming_sync with the source
         """
+        # Merging records one after the other gives the same result as
+        # merging them into each other first, so each name in the batch is
+        # folded into one record before being merged with its row, if any.
+        merged = {}
+        max_rowid = -1
+        for seq, rec in enumerate(item_list):
+            record = [rec['name'], rec['put_timestamp'],
+                      rec['delete_timestamp'], rec['object_count'],
+                      rec['bytes_used'], rec['deleted']]
+            key = utf8encode(rec['name'])[0]
+            if key in merged:
+                _merge_container_record(record, merged[key][1])
+            # the row ends up where the last record for its name was
+            merged[key] = (seq, record)
+            if source:
+                max_rowid = max(max_rowid, rec['ROWID'])
         with self.get() as conn:
-            max_rowid = -1
-            for rec in item_list:
-                record = [rec['name'], rec['put_timestamp'],
-                          rec['delete_timestamp'], rec['object_count'],
-                          rec['bytes_used'], rec['deleted']]
-                query = '''
-                    SELECT name, put_timestamp, delete_timestamp,
-                           object_count, bytes_used, deleted
-                    FROM container WHERE name = ?
+            with self._immediate_transaction(conn):
+                self._stage_merge_items(
+                    conn, ['name TEXT'],
+                    [(seq, rec[0]) for seq, rec in merged.itervalues()])
+                # CROSS JOIN keeps merge_batch as the outer loop, so that each
+                # name is looked up in the index rather than the whole table
+                # being scanned
+                join = '''
+                    FROM merge_batch CROSS JOIN container
+                    ON container.name = merge_batch.name
+                    AND container.deleted IN (0, 1)
                 '''
-                if self.get_db_version(conn) >= 1:
-                    query += ' AND deleted IN (0, 1)'
-                curs = conn.execute(query, (rec['name'],))
+                curs = conn.execute('''
+                    SELECT container.name, put_timestamp, delete_timestamp,
+                           object_count, bytes_used, deleted
+                ''' + join + ' ORDER BY container.deleted, container.ROWID')
                 curs.row_factory = None
-                row = curs.fetchone()
-                if row:
-                    row = list(row)
-                    for i in xrange(5):
-                        if record[i] is None and row[i] is not None:
-                            record[i] = row[i]
-                    if row[1] > record[1]:  # Keep newest put_timestamp
-                        record[1] = row[1]
-                    if row[2] > record[2]:  # Keep newest delete_timestamp
-                        record[2] = row[2]
-                    # If deleted, mark as such
-                    if record[2] > record[1] and \
-                            record[3] in (None, '', 0, '0'):
-                        record[5] = 1
-                    else:
-                        record[5] = 0
-                conn.execute('''
-                    DELETE FROM container WHERE name = ? AND
-                                                deleted IN (0, 1)
-                ''', (record[0],))
-                conn.execute('''
+                seen = set()
+                for row in curs:
+                    key = utf8encode(row[0])[0]
+                    if key not in seen:
+                        seen.add(key)
+                        _merge_container_record(merged[key][1], row)
+                conn.execute('DELETE FROM container WHERE ROWID IN '
+                             '(SELECT container.ROWID ' + join + ')')
+                conn.executemany('''
                     INSERT INTO container (name, put_timestamp,
                         delete_timestamp, object_count, bytes_used,
                         deleted)
                     VALUES (?, ?, ?, ?, ?, ?)
-                ''', record)
+                ''', [rec for seq, rec in sorted(merged.itervalues())])
                 if source:
-                    max_rowid = max(max_rowid, rec['ROWID'])
-            if source:
-                try:
-                    conn.execute('''
-                        INSERT INTO incoming_sync (sync_point, remote_id)
-                        VALUES (?, ?)
-                    ''', (max_rowid, source))
-                except sqlite3.IntegrityError:
-                    conn.execute('''
-                        UPDATE incoming_sync SET sync_point=max(?, sync_point)
-                        WHERE remote_id=?
-                    ''', (max_rowid, source))
-            conn.commit()
+                    try:
+                        conn.execute('''
+                            INSERT INTO incoming_sync (sync_point, remote_id)
+                            VALUES (?, ?)
+                        ''', (max_rowid, source))
+                    except sqlite3.IntegrityError:
+                        conn.execute('''
+                            UPDATE incoming_sync
+                            SET sync_point=max(?, sync_point)
+                            WHERE remote_id=?
+                        ''', (max_rowid, source))
+            conn.execute('DROP TABLE temp.merge_batch')
+        if merged:
+            mark_dirty(self.db_file, self.logger)
@@ -208,6 +208,7 @@ class Bench(object):
         self.total_objects = int(conf.num_objects)
         self.total_gets = int(conf.num_gets)
         self.timeout = int(conf.timeout)
+        self.keepalive = config_true_value(getattr(conf, 'keepalive', 'yes'))
         self.devices = conf.devices.split()
         self.names = names
         self.conn_pool = ConnectionPool(self.url,
@@ -237,6 +238,9 @@ class Bench(object):
                     pass
                 self.failures += 1
                 hc = self.conn_pool.create()
+            if not self.keepalive:
+                # the next request on it will reconnect
+                hc[1].close()
         finally:
             self.conn_pool.put(hc)
 
@@ -36,12 +36,27 @@ from swift.common.exceptions import LockTimeout
 
 #: Whether calls will be made to preallocate disk space for database files.
 DB_PREALLOCATION = True
+#: Whether database files are put in write-ahead log (WAL) journal mode.
+DB_WAL = False
+#: Whether changes to container DB object rows are accounted for in
+#: container_stat once per transaction instead of by per-row triggers
+DB_BATCHED_STATS = False
+#: Whether changed databases are recorded in a dirty index on their device,
+#: so that replication passes can skip the unchanged ones
+DB_DIRTY_TRACKING = False
+#: Pages in the write-ahead log after which a committing connection
+#: checkpoints it; the replicator and auditors normally checkpoint before then
+WAL_AUTOCHECKPOINT = 10000
 #: Timeout for trying to connect to a DB
 BROKER_TIMEOUT = 25
 #: Pickle protocol to use
 PICKLE_PROTOCOL = 2
 #: Max number of pending entries
 PENDING_CAP = 131072
+#: Max number of rows marked deleted gone through per reclaim transaction
+RECLAIM_BATCH_SIZE = 10000
+#: Rows read per query when hashing a name range, sleeping between queries
+RANGE_HASH_BATCH_SIZE = 1000
 
 
 def utf8encode(*args):
@@ -142,16 +157,63 @@ def chexor(old, name, timestamp):
     of the contents. (check + XOR)
 
     :param old: hex representation of the current DB hash
-    :param name: name of the object or container being inserted
+    :param name: name of the object or container being inserted, unicode
+                 or UTF-8 encoded
     :param timestamp: timestamp of the new record
     :returns: a hex representation of the new hash value
     """
     if name is None:
         raise Exception('name is None!')
-    new = hashlib.md5(('%s-%s' % (name, timestamp)).encode('utf8')).hexdigest()
+    new = hashlib.md5('%s-%s' % tuple(utf8encode(name, timestamp))).hexdigest()
     return '%032x' % (int(old, 16) ^ int(new, 16))
 
 
+def dirty_marker(db_file):
+    """
+    Returns the path of the file recording a database as changed in the dirty
+    index of its device; for a DB at
+    <datadir>/<partition>/<suffix>/<hash>/<hash>.db that is
+    <datadir>_dirty/<partition>-<hash>.
+
+    :param db_file: path to the DB
+    :returns: the marker path, or None if the DB is not in a data dir
+    """
+    hash_dir, name = os.path.split(db_file)
+    suffix_dir, hsh = os.path.split(hash_dir)
+    part_dir, suffix = os.path.split(suffix_dir)
+    datadir, partition = os.path.split(part_dir)
+    if not suffix or not hsh.endswith(suffix) or name != hsh + '.db' or \
+            not partition:
+        return None
+    return os.path.join(datadir + '_dirty', '%s-%s' % (partition, hsh))
+
+
+def mark_dirty(db_file, logger):
+    """
+    Records a changed database in the dirty index of its device if
+    DB_DIRTY_TRACKING is on. Errors are logged; the next full replication
+    sweep will pick the DB up anyway.
+
+    :param db_file: path to the DB
+    :param logger: logger to report errors to
+    """
+    if not DB_DIRTY_TRACKING:
+        return
+    marker = dirty_marker(db_file)
+    if not marker or os.path.exists(marker):
+        return
+    try:
+        try:
+            open(marker, 'a').close()
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            mkdirs(os.path.dirname(marker))
+            open(marker, 'a').close()
+    except (IOError, OSError):
+        logger.exception(_('ERROR marking %s as changed'), db_file)
+
+
 def get_db_connection(path, timeout=30, okay_to_create=False):
     """
     Returns a properly configured SQLite database connection.
@@ -178,7 +240,21 @@ def get_db_connection(path, timeout=30, okay_to_create=False):
             cur.execute('PRAGMA synchronous = NORMAL')
             cur.execute('PRAGMA count_changes = OFF')
             cur.execute('PRAGMA temp_store = MEMORY')
-            cur.execute('PRAGMA journal_mode = DELETE')
+            journal_mode = 'wal' if DB_WAL else 'delete'
+            if cur.execute('PRAGMA journal_mode').fetchone()[0] != \
+                    journal_mode:
+                # changing the journal mode fails while other connections
+                # use the DB; don't wait for them, a later connection will
+                # change it
+                try:
+                    sqlite3.Cursor.execute(
+                        cur, 'PRAGMA journal_mode = %s' % journal_mode)
+                except sqlite3.OperationalError as err:
+                    if 'locked' not in str(err):
+                        raise
+            if DB_WAL:
+                cur.execute('PRAGMA wal_autocheckpoint = %d' %
+                            WAL_AUTOCHECKPOINT)
         conn.create_function('chexor', 3, chexor)
     except sqlite3.DatabaseError:
         import traceback
@@ -288,6 +364,7 @@ class DatabaseBroker(object):
                     # of the system were "racing" each other.
                     raise DatabaseAlreadyExists(self.db_file)
                 renamer(tmp_db_file, self.db_file)
+            mark_dirty(self.db_file, self.logger)
             self.conn = get_db_connection(self.db_file, self.timeout)
         else:
             self.conn = conn
@@ -308,6 +385,7 @@ class DatabaseBroker(object):
         with self.get() as conn:
             self._delete_db(conn, timestamp)
             conn.commit()
+        mark_dirty(self.db_file, self.logger)
 
     def possibly_quarantine(self, exc_type, exc_value, exc_traceback):
         """
@@ -368,6 +446,28 @@ class DatabaseBroker(object):
             conn.close()
             raise
 
+    @contextmanager
+    def _immediate_transaction(self, conn):
+        """
+        Use with the "with" statement, inside a :func:`get` block; runs the
+        statements in the block in one transaction that holds the write lock
+        from the start, so that rows read in it cannot change before it
+        writes. The transaction is committed at the end of the block.
+
+        :param conn: DB connection object
+        """
+        orig_isolation_level = conn.isolation_level
+        try:
+            # We turn off auto-transactions to begin the transaction
+            # ourselves; on error, get() closes the connection, which
+            # rolls it back.
+            conn.isolation_level = None
+            conn.execute('BEGIN IMMEDIATE')
+            yield
+            conn.execute('COMMIT')
+        finally:
+            conn.isolation_level = orig_isolation_level
+
     @contextmanager
     def lock(self):
         """Use with the "with" statement; locks a database."""
@@ -394,6 +494,92 @@ class DatabaseBroker(object):
                 _('Broker error trying to rollback locked connection'))
             conn.close()
 
+    def checkpoint(self, min_size=0):
+        """
+        Copies the changes in the write-ahead log of a DB in WAL mode into
+        the DB file, without waiting on other connections.
+
+        :param min_size: only checkpoint a write-ahead log of at least this
+                         many bytes
+        :returns: True if the DB file holds every committed change
+        """
+        try:
+            if os.path.getsize(self.db_file + '-wal') < min_size:
+                return False
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return True
+        with self.get() as conn:
+            busy, log, checkpointed = conn.execute(
+                'PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        return not busy and log == checkpointed
+
+    def disable_wal(self):
+        """
+        Takes the DB out of WAL mode, so the DB file can be renamed without
+        its write-ahead log.  This only works when no other connection has the
+        DB open, as with a DB received by rsync.
+
+        :returns: True if the DB is not in WAL mode
+        """
+        with self.get() as conn:
+            journal_mode = conn.execute(
+                'PRAGMA journal_mode = DELETE').fetchone()[0]
+        return journal_mode != 'wal'
+
+    def get_file_stats(self):
+        """
+        Gets the stats of the files the DB is kept in, which change with
+        every update to it, whichever process makes it.
+
+        :returns: tuple of (inode, size, mtime) for the DB file, its
+                  write-ahead log and its pending file; None for the missing
+                  ones
+        """
+        stats = []
+        for path in (self.db_file, self.db_file + '-wal', self.pending_file):
+            try:
+                stat = os.stat(path)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                stats.append(None)
+            else:
+                stats.append((stat.st_ino, stat.st_size, stat.st_mtime))
+        return tuple(stats)
+
+    def get_free_ratio(self):
+        """
+        Estimates how much of the DB compaction would reclaim.
+
+        :returns: the ratio of free pages to all the pages of the DB
+        """
+        with self.get() as conn:
+            page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+            freelist_count = \
+                conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not page_count:
+            return 0.0
+        return float(freelist_count) / page_count
+
+    def compact(self):
+        """
+        Rebuilds the DB without its free pages. VACUUM builds the compacted
+        copy and writes it back into the DB file while holding the DB's
+        exclusive lock, so connections other processes have open to the DB
+        keep working with it; updates wait for the lock meanwhile.
+
+        :returns: the number of bytes the DB file shrank by
+        """
+        size = os.path.getsize(self.db_file)
+        with self.get() as conn:
+            conn.execute('VACUUM')
+        # in WAL mode the compacted DB only gets to the DB file when the
+        # write-ahead log is checkpointed
+        self.checkpoint()
+        return size - os.path.getsize(self.db_file)
+
     def newid(self, remote_id):
         """
         Re-id the database.  This should be called after an rsync.
@@ -434,6 +620,7 @@ class DatabaseBroker(object):
                                    delete_timestamp=MAX(?, delete_timestamp)
             ''' % self.db_type, (created_at, put_timestamp, delete_timestamp))
             conn.commit()
+        mark_dirty(self.db_file, self.logger)
 
     def get_items_since(self, start, count):
         """
@@ -451,6 +638,130 @@ class DatabaseBroker(object):
             curs.row_factory = dict_factory
             return [r for r in curs]
 
+    def _name_range(self, lower, upper, deleted=None):
+        """
+        Returns the WHERE clause and its arguments selecting the rows whose
+        names are after lower and up to upper; None is unbounded. The rows
+        are looked up through the (deleted, name) index, only those with the
+        given deleted value if there is one.
+        """
+        if deleted is None:
+            clauses = ['deleted IN (0, 1)']
+            args = []
+        else:
+            clauses = ['deleted = ?']
+            args = [deleted]
+        if lower is not None:
+            clauses.append('name > ?')
+            args.append(utf8encode(lower)[0])
+        if upper is not None:
+            clauses.append('name <= ?')
+            args.append(utf8encode(upper)[0])
+        return ' AND '.join(clauses), args
+
+    def _count_name_range(self, lower, upper, deleted=None):
+        where, args = self._name_range(lower, upper, deleted)
+        with self.get() as conn:
+            return conn.execute('SELECT COUNT(*) FROM %s WHERE %s' % (
+                self.db_contains_type, where), args).fetchone()[0]
+
+    def get_range_bounds(self, lower, upper, parts):
+        """
+        Get the names splitting the rows in a name range into about equal
+        parts. Only the live or only the deleted rows, whichever there are
+        more of, are counted, so that each name is found by walking the
+        (deleted, name) index.
+
+        :param lower: exclusive lower bound of the range, or None
+        :param upper: inclusive upper bound of the range, or None
+        :param parts: number of parts to split the range into
+        :returns: list of up to parts - 1 names, in order
+        """
+        self._commit_puts_stale_ok()
+        counts = [self._count_name_range(lower, upper, deleted)
+                  for deleted in (0, 1)]
+        deleted = int(counts[1] > counts[0])
+        step = counts[deleted] // parts
+        if not step:
+            return []
+        where, args = self._name_range(lower, upper, deleted)
+        bounds = []
+        for i in xrange(1, parts):
+            sleep()
+            with self.get() as conn:
+                bounds.append(conn.execute(
+                    'SELECT name FROM %s WHERE %s ORDER BY name '
+                    'LIMIT 1 OFFSET ?' % (self.db_contains_type, where),
+                    args + [i * step - 1]).fetchone()[0])
+        return bounds
+
+    def get_range_hashes(self, bounds, max_rows=None):
+        """
+        Get the hashes of the rows in consecutive name ranges: the XOR of
+        the hashes of their rows, which the DB keeps its own hash as (see
+        chexor()); so the hashes of ranges covering all names XOR to the DB
+        hash. Ranges with more rows than are left of max_rows are not
+        hashed, for the caller to split further.
+
+        :param bounds: list of names [b0, b1, ..., bn] for the ranges
+                       (b0, b1], (b1, b2], ..., (bn-1, bn]; b0 and bn may be
+                       None for unbounded
+        :param max_rows: max number of rows to hash in all, or None
+        :returns: list of [row count, hex hash or None] for each range
+        """
+        self._commit_puts_stale_ok()
+        ranges = []
+        for lower, upper in zip(bounds[:-1], bounds[1:]):
+            count = self._count_name_range(lower, upper)
+            if max_rows is not None:
+                if count > max_rows:
+                    ranges.append([count, None])
+                    continue
+                max_rows -= count
+            hsh = 0
+            for deleted in (0, 1):
+                hsh ^= self._hash_name_range(lower, upper, deleted)
+            ranges.append([count, '%032x' % hsh])
+        return ranges
+
+    def _hash_name_range(self, lower, upper, deleted):
+        """
+        XORs the hashes of the rows in a name range with the given deleted
+        value, reading them RANGE_HASH_BATCH_SIZE at a time and sleeping in
+        between so that other requests get served.
+        """
+        hsh = 0
+        while True:
+            where, args = self._name_range(lower, upper, deleted)
+            with self.get() as conn:
+                rows = conn.execute(
+                    'SELECT name, %s FROM %s WHERE %s ORDER BY name LIMIT ?'
+                    % (self.db_hash_value, self.db_contains_type, where),
+                    args + [RANGE_HASH_BATCH_SIZE]).fetchall()
+            for name, value in rows:
+                hsh ^= int(hashlib.md5('%s-%s' % tuple(
+                    utf8encode(name, value))).hexdigest(), 16)
+            if len(rows) < RANGE_HASH_BATCH_SIZE:
+                return hsh
+            lower = rows[-1][0]
+            sleep()
+
+    def get_items_in_range(self, lower, upper):
+        """
+        Get the rows in a name range, the way get_items_since() does.
+
+        :param lower: exclusive lower bound of the range, or None
+        :param upper: inclusive upper bound of the range, or None
+        :returns: list of rows in ROWID order
+        """
+        self._commit_puts_stale_ok()
+        where, args = self._name_range(lower, upper)
+        with self.get() as conn:
+            curs = conn.execute('SELECT * FROM %s WHERE %s ORDER BY ROWID' % (
+                self.db_contains_type, where), args)
+            curs.row_factory = dict_factory
+            return [r for r in curs]
+
     def get_sync(self, id, incoming=True):
         """
         Gets the most recent sync point for a server from the sync table.
@@ -567,6 +878,29 @@ class DatabaseBroker(object):
         """
         raise NotImplementedError
 
+    def _stage_merge_items(self, conn, columns, rows):
+        """
+        Loads rows into the temporary merge_batch table, so that a broker's
+        merge_items can resolve a whole batch against its table with a few
+        statements rather than several per item. The table has a ``seq``
+        column (the first value of every row) followed by the given columns;
+        drop it with ``DROP TABLE temp.merge_batch`` once committed.
+
+        :param conn: DB connection object
+        :param columns: list of column definitions, e.g. ['name TEXT']
+        :param rows: list of tuples of (seq, value of each column)
+        """
+        # Python's sqlite3 commits before DDL statements, so the table is
+        # created before anything else is done in the transaction.
+        conn.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS merge_batch (
+                seq INTEGER PRIMARY KEY, %s)
+        ''' % ', '.join(columns))
+        conn.execute('DELETE FROM merge_batch')
+        conn.executemany(
+            'INSERT INTO merge_batch VALUES (%s)' %
+            ', '.join('?' * (len(columns) + 1)), rows)
+
     def merge_syncs(self, sync_points, incoming=True):
         """
         Merge a list of sync points with the incoming sync table.
@@ -678,38 +1012,116 @@ class DatabaseBroker(object):
             conn.execute('UPDATE %s_stat SET metadata = ?' % self.db_type,
                          (json.dumps(md),))
             conn.commit()
+        mark_dirty(self.db_file, self.logger)
 
-    def reclaim(self, age_timestamp, sync_timestamp):
+    def reclaim(self, age_timestamp, sync_timestamp,
+                batch_size=RECLAIM_BATCH_SIZE):
         """
         Delete rows from the db_contains_type table that are marked deleted
         and whose created_at timestamp is < age_timestamp.  Also deletes rows
         from incoming_sync and outgoing_sync where the updated_at timestamp is
         < sync_timestamp.
 
+        The rows marked deleted are gone through in name order, batch_size
+        at a time, each batch in its own transaction with a yield to other
+        greenthreads in between, so that the DB is never locked for long.
+        The name reached is saved in the DB (reclaim_point), so a reclaim
+        that was interrupted carries on from there the next time.
+
         In addition, this calls the DatabaseBroker's :func:`_reclaim` method.
 
         :param age_timestamp: max created_at timestamp of object rows to delete
         :param sync_timestamp: max update_at timestamp of sync rows to delete
+        :param batch_size: max number of rows marked deleted to go through
+                           per transaction
+        :returns: tuple of (number of rows deleted, longest time in seconds
+                  the DB was locked for)
         """
         self._commit_puts()
+        reclaimed = 0
+        lock_time = 0
         with self.get() as conn:
+            more = True
+            while more:
+                start = time.time()
+                with self._immediate_transaction(conn):
+                    count, more = self._reclaim_batch(conn, age_timestamp,
+                                                      batch_size)
+                reclaimed += count
+                lock_time = max(lock_time, time.time() - start)
+                sleep()
+            start = time.time()
+            with self._immediate_transaction(conn):
+                try:
+                    conn.execute('''
+                        DELETE FROM outgoing_sync WHERE updated_at < ?
+                    ''', (sync_timestamp,))
+                    conn.execute('''
+                        DELETE FROM incoming_sync WHERE updated_at < ?
+                    ''', (sync_timestamp,))
+                except sqlite3.OperationalError as err:
+                    # Old dbs didn't have updated_at in the _sync tables.
+                    if 'no such column: updated_at' not in str(err):
+                        raise
+                DatabaseBroker._reclaim(self, conn, age_timestamp)
+            lock_time = max(lock_time, time.time() - start)
+        return reclaimed, lock_time
+
+    def _reclaim_batch(self, conn, age_timestamp, batch_size):
+        """
+        Deletes the rows older than age_timestamp among the next batch_size
+        rows marked deleted after the reclaim_point, and moves the
+        reclaim_point past them. Called by :func:`reclaim` with the write
+        lock held.
+
+        :param conn: DB connection object
+        :param age_timestamp: max timestamp of rows to delete
+        :param batch_size: max number of rows marked deleted to go through
+        :returns: tuple of (number of rows deleted, True if there are rows
+                  marked deleted left after the batch)
+        """
+        try:
+            marker = conn.execute('SELECT reclaim_point FROM %s_stat' %
+                                  self.db_type).fetchone()[0]
+        except sqlite3.OperationalError as err:
+            if 'no such column: reclaim_point' not in str(err):
+                raise
             conn.execute('''
-                DELETE FROM %s WHERE deleted = 1 AND %s < ?
-            ''' % (self.db_contains_type, self.db_reclaim_timestamp),
-                (age_timestamp,))
-            try:
-                conn.execute('''
-                    DELETE FROM outgoing_sync WHERE updated_at < ?
-                ''', (sync_timestamp,))
-                conn.execute('''
-                    DELETE FROM incoming_sync WHERE updated_at < ?
-                ''', (sync_timestamp,))
-            except sqlite3.OperationalError as err:
-                # Old dbs didn't have updated_at in the _sync tables.
-                if 'no such column: updated_at' not in str(err):
-                    raise
-            DatabaseBroker._reclaim(self, conn, age_timestamp)
-            conn.commit()
+                ALTER TABLE %s_stat ADD COLUMN reclaim_point TEXT DEFAULT ''
+            ''' % self.db_type)
+            marker = ''
+        row = conn.execute('''
+            SELECT name FROM %s WHERE deleted = 1 AND name > ?
+            ORDER BY name LIMIT 1 OFFSET ?
+        ''' % self.db_contains_type, (marker, batch_size - 1)).fetchone()
+        end_marker = row[0] if row else None
+        query = 'SELECT * FROM %s WHERE deleted = 1 AND name > ?' % \
+            self.db_contains_type
+        query_args = [marker]
+        if end_marker is not None:
+            query += ' AND name <= ?'
+            query_args.append(end_marker)
+        query += ' AND %s < ?' % self.db_reclaim_timestamp
+        query_args.append(age_timestamp)
+        rows = conn.execute(query, query_args).fetchall()
+        if rows:
+            self._reclaim_items(conn, rows)
+        if (end_marker or '') != marker:
+            conn.execute('UPDATE %s_stat SET reclaim_point = ?' %
+                         self.db_type, (end_marker or '',))
+        return len(rows), end_marker is not None
+
+    def _reclaim_items(self, conn, rows):
+        """
+        Deletes rows of the db_contains_type table that are being reclaimed.
+        Called by :func:`reclaim` with the write lock held.
+
+        :param conn: DB connection object
+        :param rows: list of the rows to delete
+        """
+        conn.executemany('DELETE FROM %s WHERE ROWID = ?' %
+                         self.db_contains_type,
+                         [(row['ROWID'],) for row in rows])
 
     def _reclaim(self, conn, timestamp):
         """
@@ -757,3 +1169,4 @@ class DatabaseBroker(object):
                 ' WHERE put_timestamp < ?' % self.db_type,
                 (timestamp, timestamp))
             conn.commit()
+        mark_dirty(self.db_file, self.logger)
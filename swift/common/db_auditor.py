@@ -0,0 +1,95 @@
+# Copyright (c) 2010-2012 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+from swift import gettext_ as _
+
+from eventlet import Timeout
+
+from swift.common.utils import ratelimit_sleep
+
+
+class DatabaseCompactor(object):
+    """
+    Compacts the account or container DBs an auditor goes through when
+    enough of them is free pages. Updates to a DB wait while it is
+    compacted, so DBs over compaction_max_size are left as they are.
+
+    :param conf: configuration of the auditor
+    :param logger: logger of the auditor
+    :param db_type: 'account' or 'container'
+    """
+
+    def __init__(self, conf, logger, db_type):
+        self.logger = logger
+        self.db_type = db_type
+        self.free_ratio = float(conf.get('compaction_free_ratio', 0))
+        self.min_size = int(conf.get('compaction_min_size', 1048576))
+        self.max_size = int(conf.get('compaction_max_size', 67108864))
+        self.max_bytes_per_second = \
+            float(conf.get('compaction_bytes_per_second', 10485760))
+        self.running_time = 0
+        self.compactions = 0
+        self.compacted_bytes = 0
+
+    def compact(self, broker):
+        """
+        Compacts the given DB if compaction is on and enough of the DB is
+        free pages.
+
+        :param broker: the broker of the DB
+        """
+        if not self.free_ratio:
+            return
+        try:
+            size = os.path.getsize(broker.db_file)
+            if not self.min_size <= size <= self.max_size or \
+                    broker.get_free_ratio() < self.free_ratio:
+                return
+            self.running_time = ratelimit_sleep(
+                self.running_time, self.max_bytes_per_second, incr_by=size)
+            reclaimed = broker.compact()
+        except (Exception, Timeout):
+            self.logger.increment('compaction_failures')
+            self.logger.exception(_('ERROR Could not compact %s'),
+                                  broker.db_file)
+            return
+        self.logger.increment('compactions')
+        self.logger.update_stats('compacted_bytes', reclaimed)
+        self.compactions += 1
+        self.compacted_bytes += reclaimed
+        self.logger.debug(_('Compacted %(db)s, reclaiming %(bytes)s bytes'),
+                          {'db': broker, 'bytes': reclaimed})
+
+    def report(self, reported):
+        """
+        Logs the compactions since the last report and starts counting anew.
+
+        :param reported: time of the last report
+        :returns: dict of the stats for the recon cache
+        """
+        if self.free_ratio:
+            self.logger.info(
+                _('Since %(time)s: %(type)s compactions: %(compactions)s '
+                  'reclaiming %(bytes)s bytes'),
+                {'time': time.ctime(reported), 'type': self.db_type.title(),
+                 'compactions': self.compactions,
+                 'bytes': self.compacted_bytes})
+        stats = {'%s_compactions' % self.db_type: self.compactions,
+                 '%s_compacted_bytes' % self.db_type: self.compacted_bytes}
+        self.compactions = 0
+        self.compacted_bytes = 0
+        return stats
@@ -21,6 +21,7 @@ import shutil
 import uuid
 import errno
 import re
+import zlib
 from swift import gettext_ as _
 
 from eventlet import GreenPool, sleep, Timeout
@@ -28,6 +29,7 @@ from eventlet.green import subprocess
 import simplejson
 
 import swift.common.db
+from swift.common.db import mark_dirty
 from swift.common.direct_client import quote
 from swift.common.utils import get_logger, whataremyips, storage_directory, \
     renamer, mkdirs, lock_parent_directory, config_true_value, \
@@ -38,7 +40,7 @@ from swift.common.bufferedhttp import BufferedHTTPConnection
 from swift.common.exceptions import DriveNotMounted, ConnectionTimeout
 from swift.common.daemon import Daemon
 from swift.common.swob import Response, HTTPNotFound, HTTPNoContent, \
-    HTTPAccepted, HTTPBadRequest
+    HTTPAccepted, HTTPBadRequest, HTTPInternalServerError
 
 
 DEBUG_TIMINGS_THRESHOLD = 10
@@ -98,7 +100,56 @@ def roundrobin_datadirs(datadirs):
                     if os.path.exists(object_file):
                         yield (partition, object_file, node_id)
 
-    its = [walk_datadir(datadir, node_id) for datadir, node_id in datadirs]
+    return _roundrobin(
+        [walk_datadir(datadir, node_id) for datadir, node_id in datadirs])
+
+
+def roundrobin_dirty(datadirs):
+    """
+    Generator like roundrobin_datadirs, but only yielding the .db files
+    recorded in the dirty index of each data dir. Each DB is taken out of
+    the index before it is yielded, so changes made while it is replicated
+    mark it again for the next pass.
+
+    :param datadirs: a list of (path, node_id) to walk
+    :returns: A generator of (partition, path_to_db_file, node_id)
+    """
+
+    def walk_dirty(datadir, node_id):
+        dirty_dir = datadir + '_dirty'
+        for marker in list_dirty(dirty_dir):
+            partition, hsh = marker.split('-', 1)
+            try:
+                os.unlink(os.path.join(dirty_dir, marker))
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+            object_file = os.path.join(
+                storage_directory(datadir, partition, hsh), hsh + '.db')
+            if os.path.exists(object_file):
+                yield (partition, object_file, node_id)
+
+    return _roundrobin(
+        [walk_dirty(datadir, node_id) for datadir, node_id in datadirs])
+
+
+def list_dirty(dirty_dir):
+    """
+    Lists the markers in a dirty index directory.
+
+    :param dirty_dir: path to the dirty index
+    :returns: a list of marker names, <partition>-<hash>
+    """
+    try:
+        markers = os.listdir(dirty_dir)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return []
+    return [marker for marker in markers if '-' in marker]
+
+
+def _roundrobin(its):
     while its:
         for it in its:
             try:
@@ -112,10 +163,12 @@ class ReplConnection(BufferedHTTPConnection):
     Helper to simplify REPLICATEing to a remote server.
     """
 
-    def __init__(self, node, partition, hash_, logger):
+    def __init__(self, node, partition, hash_, logger, compress=False):
         ""
         self.logger = logger
         self.node = node
+        self.partition = partition
+        self.compress = compress
         host = "%s:%s" % (node['replication_ip'], node['replication_port'])
         BufferedHTTPConnection.__init__(self, host)
         self.path = '/%s/%s/%s' % (node['device'], partition, hash_)
@@ -130,8 +183,11 @@ class ReplConnection(BufferedHTTPConnection):
         """
         try:
             body = simplejson.dumps(args)
-            self.request('REPLICATE', self.path, body,
-                         {'Content-Type': 'application/json'})
+            headers = {'Content-Type': 'application/json'}
+            if self.compress:
+                body = zlib.compress(body)
+                headers['Content-Encoding'] = 'deflate'
+            self.request('REPLICATE', self.path, body, headers)
             response = self.getresponse()
             response.data = response.read()
             return response
@@ -141,6 +197,24 @@ class ReplConnection(BufferedHTTPConnection):
             return None
 
 
+def load_replicate_args(req):
+    """
+    Loads the RPC arguments of a REPLICATE request, inflating its body first
+    if the replicator compressed it.
+
+    :param req: swob.Request object
+    :returns: the list of RPC arguments
+    :raises ValueError: if the body can't be decoded
+    """
+    body = req.body
+    if req.headers.get('content-encoding') == 'deflate':
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as err:
+            raise ValueError(str(err))
+    return simplejson.loads(body)
+
+
 class Replicator(Daemon):
     """
     Implements the logic for directing db replication.
@@ -158,14 +232,33 @@ class Replicator(Daemon):
         self.ring = ring.Ring(swift_dir, ring_name=self.server_type)
         self.per_diff = int(conf.get('per_diff', 1000))
         self.max_diffs = int(conf.get('max_diffs') or 100)
+        self.usync_concurrency = max(
+            int(conf.get('usync_concurrency', 1)), 1)
+        self.compress_replication = config_true_value(
+            conf.get('compress_replication', 'no'))
+        self.range_sync = config_true_value(conf.get('range_sync', 'no'))
+        self.range_fanout = max(int(conf.get('range_fanout', 16)), 2)
+        self.range_hash_rows = max(int(conf.get('range_hash_rows', 100000)),
+                                   self.per_diff)
+        self.range_hash_timeout = float(conf.get('range_hash_timeout', 60))
         self.interval = int(conf.get('interval') or
                             conf.get('run_pause') or 30)
         self.vm_test_mode = config_true_value(conf.get('vm_test_mode', 'no'))
         self.node_timeout = int(conf.get('node_timeout', 10))
         self.conn_timeout = float(conf.get('conn_timeout', 0.5))
         self.reclaim_age = float(conf.get('reclaim_age', 86400 * 7))
+        self.wal_checkpoint_size = int(
+            conf.get('wal_checkpoint_size', 1048576))
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        swift.common.db.DB_WAL = config_true_value(conf.get('db_wal', 'f'))
+        swift.common.db.DB_BATCHED_STATS = \
+            config_true_value(conf.get('db_batched_stats', 'f'))
+        swift.common.db.DB_DIRTY_TRACKING = \
+            config_true_value(conf.get('db_dirty_tracking', 'f'))
+        self.full_sweep_interval = int(
+            conf.get('full_sweep_interval', 86400))
+        self.last_full_sweep = 0
         self._zero_stats()
         self.recon_cache_path = conf.get('recon_cache_path',
                                          '/var/cache/swift')
@@ -180,7 +273,8 @@ class Replicator(Daemon):
         self.stats = {'attempted': 0, 'success': 0, 'failure': 0, 'ts_repl': 0,
                       'no_change': 0, 'hashmatch': 0, 'rsync': 0, 'diff': 0,
                       'remove': 0, 'empty': 0, 'remote_merge': 0,
-                      'start': time.time(), 'diff_capped': 0}
+                      'start': time.time(), 'diff_capped': 0,
+                      'range_sync': 0}
 
     def _report_stats(self):
         """Report the current stats to the logs."""
@@ -202,7 +296,7 @@ class Replicator(Daemon):
         self.logger.info(' '.join(['%s:%s' % item for item in
                          self.stats.items() if item[0] in
                          ('no_change', 'hashmatch', 'rsync', 'diff', 'ts_repl',
-                          'empty', 'diff_capped')]))
+                          'empty', 'diff_capped', 'range_sync')]))
 
     def _rsync_file(self, db_file, remote_file, whole_file=True):
         """
@@ -247,14 +341,20 @@ class Replicator(Daemon):
         else:
             remote_file = '%s::%s/%s/tmp/%s' % (
                 device_ip, self.server_type, device['device'], local_id)
+        # only the db file is sent, so it needs the changes made in WAL mode
+        checkpointed = broker.checkpoint()
         mtime = os.path.getmtime(broker.db_file)
         if not self._rsync_file(broker.db_file, remote_file):
             return False
-        # perform block-level sync if the db was modified during the first sync
-        if os.path.exists(broker.db_file + '-journal') or \
+        # perform block-level sync if the db was modified during the first
+        # sync, or if some of its changes were left in the write-ahead log
+        if not checkpointed or \
+                os.path.exists(broker.db_file + '-journal') or \
                 os.path.getmtime(broker.db_file) > mtime:
             # grab a lock so nobody else can modify it
             with broker.lock():
+                if not broker.checkpoint():
+                    return False
                 if not self._rsync_file(broker.db_file, remote_file, False):
                     return False
         with Timeout(replicate_timeout or self.node_timeout):
@@ -277,21 +377,29 @@ class Replicator(Daemon):
         self.logger.increment('diffs')
         self.logger.debug(_('Syncing chunks with %s'), http.host)
         sync_table = broker.get_syncs()
-        objects = broker.get_items_since(point, self.per_diff)
-        diffs = 0
-        while len(objects) and diffs < self.max_diffs:
-            diffs += 1
-            with Timeout(self.node_timeout):
-                response = http.replicate('merge_items', objects, local_id)
-            if not response or response.status >= 300 or response.status < 200:
-                if response:
-                    self.logger.error(_('ERROR Bad response %(status)s from '
-                                        '%(host)s'),
-                                      {'status': response.status,
-                                       'host': http.host})
-                return False
-            point = objects[-1]['ROWID']
-            objects = broker.get_items_since(point, self.per_diff)
+        start_time = time.time()
+        start_point = point
+        if self.usync_concurrency > 1:
+            sent = self._send_items_pipelined(point, broker, http)
+        else:
+            sent = self._send_items(point, broker, http, local_id)
+        if not sent:
+            return False
+        point, rows, objects = sent
+        elapsed = time.time() - start_time
+        self.logger.debug(
+            _('Sent %(rows)d rows to %(host)s in %(time).3fs (%(rate).1f/s)'),
+            {'rows': rows, 'host': http.host, 'time': elapsed,
+             'rate': rows / (elapsed + 0.0000001)})
+        if self.usync_concurrency > 1 and point > start_point:
+            # the batches were sent without a source, so the remote is told
+            # how far it is in sync with this replica once they all made it
+            own_sync = [{'remote_id': local_id, 'sync_point': point}]
+            if objects:
+                with Timeout(self.node_timeout):
+                    http.replicate('merge_syncs', own_sync)
+            else:
+                sync_table = sync_table + own_sync
         if objects:
             self.logger.debug(_(
                 'Synchronization for %s has fallen more than '
@@ -309,6 +417,181 @@ class Replicator(Daemon):
                 return True
         return False
 
+    def _send_items(self, point, broker, http, local_id):
+        """
+        Sends the records since a sync point one batch after the other.
+
+        :param point: synchronization high water mark between the replicas
+        :param broker: database broker object
+        :param http: ReplConnection object for the remote server
+        :param local_id: database id for the local replica
+
+        :returns: None on failure, else a tuple of the new sync point, the
+                  number of records sent and the next batch of records, if
+                  the pass is capped by max_diffs
+        """
+        rows = 0
+        objects = broker.get_items_since(point, self.per_diff)
+        diffs = 0
+        while len(objects) and diffs < self.max_diffs:
+            diffs += 1
+            with Timeout(self.node_timeout):
+                response = http.replicate('merge_items', objects, local_id)
+            if not self._check_response(response, http):
+                return None
+            rows += len(objects)
+            point = objects[-1]['ROWID']
+            objects = broker.get_items_since(point, self.per_diff)
+        return point, rows, objects
+
+    def _send_items_pipelined(self, point, broker, http):
+        """
+        Sends the records since a sync point with up to usync_concurrency
+        batches in flight on as many connections, reading the next batch
+        while the previous ones are sent. The batches are sent without a
+        source, so that a later batch making it doesn't move the remote's
+        sync point past an earlier one that may not.
+
+        :param point: synchronization high water mark between the replicas
+        :param broker: database broker object
+        :param http: ReplConnection object for the remote server
+
+        :returns: None on failure, else a tuple of the new sync point, the
+                  number of records sent and the next batch of records, if
+                  the pass is capped by max_diffs
+        """
+        pool = GreenPool(self.usync_concurrency)
+        idle = [http]
+        failed = []
+
+        def send(objects):
+            conn = idle.pop() if idle else self._http_connect(
+                http.node, http.partition, broker.db_file)
+            try:
+                with Timeout(self.node_timeout):
+                    response = conn.replicate('merge_items', objects, None)
+                if not self._check_response(response, conn):
+                    failed.append(objects)
+            except (Exception, Timeout):
+                self.logger.exception(_('ERROR syncing %(file)s with node'
+                                        ' %(node)s'),
+                                      {'file': broker.db_file,
+                                       'node': http.node})
+                failed.append(objects)
+            idle.append(conn)
+
+        rows = 0
+        objects = broker.get_items_since(point, self.per_diff)
+        diffs = 0
+        while len(objects) and diffs < self.max_diffs and not failed:
+            diffs += 1
+            pool.spawn_n(send, objects)
+            # get the batch on the wire before reading the next one
+            sleep()
+            rows += len(objects)
+            point = objects[-1]['ROWID']
+            objects = broker.get_items_since(point, self.per_diff)
+        pool.waitall()
+        for conn in idle:
+            if conn is not http:
+                conn.close()
+        if failed:
+            return None
+        return point, rows, objects
+
+    def _range_sync_db(self, broker, http, remote_id, info):
+        """
+        Sync a db by comparing the hashes of name ranges with the remote
+        replica's, splitting the ranges that differ until they are small
+        enough, then sending their records. Only the records that may differ
+        are sent, wherever they are in the db; the remote replica sends its
+        own the same way when it replicates to this one. Each side hashes at
+        most range_hash_rows rows per round; the ranges left unhashed are
+        split like the differing ones.
+
+        :param broker: database broker object
+        :param http: ReplConnection object for the remote server
+        :param remote_id: database id for the remote replica
+        :param info: local database info
+
+        :returns: boolean indicating completion and success
+        """
+        self.stats['range_sync'] += 1
+        self.logger.increment('range_syncs')
+        self.logger.debug(_('Syncing ranges with %s'), http.host)
+        sync_table = broker.get_syncs()
+        ranges = [(None, None)]
+        diffs = 0
+        while ranges:
+            lower, upper = ranges.pop()
+            inner = broker.get_range_bounds(lower, upper, self.range_fanout)
+            bounds = [lower] + inner + [upper]
+            with Timeout(self.range_hash_timeout):
+                response = http.replicate('range_hashes', bounds,
+                                          self.range_hash_rows)
+            if not self._check_response(response, http):
+                return False
+            remote_hashes = simplejson.loads(response.data)
+            local_hashes = broker.get_range_hashes(bounds,
+                                                   self.range_hash_rows)
+            for i, ((count, hsh), (_junk, remote_hash)) in enumerate(
+                    zip(local_hashes, remote_hashes)):
+                if not count or (hsh is not None and hsh == remote_hash):
+                    continue
+                # ranges left unhashed are hashed on their own next round
+                if inner and (count > self.per_diff or hsh is None or
+                              remote_hash is None):
+                    ranges.append((bounds[i], bounds[i + 1]))
+                    continue
+                objects = broker.get_items_in_range(bounds[i], bounds[i + 1])
+                for start in xrange(0, len(objects), self.per_diff):
+                    if diffs >= self.max_diffs:
+                        self.logger.debug(_(
+                            'Synchronization of ranges for %s needs more '
+                            'than %s rows; moving on and will try again '
+                            'next pass.'),
+                            broker, self.max_diffs * self.per_diff)
+                        self.stats['diff_capped'] += 1
+                        self.logger.increment('diff_caps')
+                        return False
+                    diffs += 1
+                    # records are sent out of ROWID order, so no source is
+                    # given to advance the remote's sync point by
+                    with Timeout(self.node_timeout):
+                        response = http.replicate(
+                            'merge_items',
+                            objects[start:start + self.per_diff], None)
+                    if not self._check_response(response, http):
+                        return False
+        # the remote replica now has all the records up to max_row
+        with Timeout(self.node_timeout):
+            response = http.replicate(
+                'merge_syncs', sync_table + [{'remote_id': info['id'],
+                                              'sync_point': info['max_row']}])
+        if not self._check_response(response, http):
+            return False
+        broker.merge_syncs([{'remote_id': remote_id,
+                             'sync_point': info['max_row']}],
+                           incoming=False)
+        return True
+
+    def _check_response(self, response, http):
+        """
+        Checks a REPLICATE response, logging the bad ones.
+
+        :param response: response to the REPLICATE request, or None
+        :param http: ReplConnection object the request went through
+
+        :returns: True if the response is a success
+        """
+        if response and 200 <= response.status < 300:
+            return True
+        if response:
+            self.logger.error(_('ERROR Bad response %(status)s from '
+                                '%(host)s'),
+                              {'status': response.status, 'host': http.host})
+        return False
+
     def _in_sync(self, rinfo, info, broker, local_sync):
         """
         Determine whether or not two replicas of a databases are considered
@@ -345,7 +628,7 @@ class Replicator(Daemon):
         """
         return ReplConnection(node, partition,
                               os.path.basename(db_file).split('.', 1)[0],
-                              self.logger)
+                              self.logger, self.compress_replication)
 
     def _repl_to_node(self, node, broker, partition, info):
         """
@@ -392,9 +675,15 @@ class Replicator(Daemon):
                 return self._rsync_db(broker, node, http, info['id'],
                                       replicate_method='rsync_then_merge',
                                       replicate_timeout=(info['count'] / 2000))
+            point = max(rinfo['point'], local_sync)
+            # if more rows changed since the last sync than a pass sends,
+            # like when sync points were lost, find the ones that differ
+            if self.range_sync and \
+                    info['max_row'] - point > self.per_diff * self.max_diffs:
+                return self._range_sync_db(broker, http, rinfo['id'], info)
             # else send diffs over to the remote server
-            return self._usync_db(max(rinfo['point'], local_sync),
-                                  broker, http, rinfo['id'], info['id'])
+            return self._usync_db(point, broker, http, rinfo['id'],
+                                  info['id'])
 
     def _replicate_object(self, partition, object_file, node_id):
         """
@@ -412,8 +701,13 @@ class Replicator(Daemon):
         shouldbehere = True
         try:
             broker = self.brokerclass(object_file, pending_timeout=30)
-            broker.reclaim(time.time() - self.reclaim_age,
-                           time.time() - (self.reclaim_age * 2))
+            reclaimed, lock_time = broker.reclaim(
+                time.time() - self.reclaim_age,
+                time.time() - (self.reclaim_age * 2))
+            if reclaimed:
+                self.logger.update_stats('reclaimed', reclaimed)
+            self.logger.timing('reclaim.timing', lock_time * 1000)
+            broker.checkpoint(self.wal_checkpoint_size)
             info = broker.get_replication_info()
             full_info = broker.get_info()
             bpart = self.ring.get_part(
@@ -485,6 +779,9 @@ class Replicator(Daemon):
             # If the db shouldn't be on this node and has been successfully
             # synced to all of its peers, it can be removed.
             self.delete_db(object_file)
+        elif not all(responses):
+            # retry it on the next pass even if it doesn't change until then
+            mark_dirty(object_file, self.logger)
         self.logger.timing_since('timing', start_time)
 
     def delete_db(self, object_file):
@@ -540,13 +837,37 @@ class Replicator(Daemon):
                 if os.path.isdir(datadir):
                     dirs.append((datadir, node['id']))
         self.logger.info(_('Beginning replication run'))
-        for part, object_file, node_id in roundrobin_datadirs(dirs):
+        if swift.common.db.DB_DIRTY_TRACKING and \
+                time.time() - self.last_full_sweep < self.full_sweep_interval:
+            dbs = roundrobin_dirty(dirs)
+        else:
+            if swift.common.db.DB_DIRTY_TRACKING:
+                # a full sweep covers whatever was marked so far
+                for datadir, node_id in dirs:
+                    self._clear_dirty(datadir + '_dirty')
+            self.last_full_sweep = time.time()
+            dbs = roundrobin_datadirs(dirs)
+        for part, object_file, node_id in dbs:
             self.cpool.spawn_n(
                 self._replicate_object, part, object_file, node_id)
         self.cpool.waitall()
         self.logger.info(_('Replication run OVER'))
         self._report_stats()
 
+    def _clear_dirty(self, dirty_dir):
+        """
+        Empties a dirty index.
+
+        :param dirty_dir: path to the dirty index
+        """
+        for marker in list_dirty(dirty_dir):
+            try:
+                os.unlink(os.path.join(dirty_dir, marker))
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    self.logger.exception(
+                        _('ERROR while trying to clean up %s') % marker)
+
     def run_forever(self, *args, **kwargs):
         """
         Replicate dbs under the given root in an infinite loop.
@@ -654,6 +975,11 @@ class ReplicatorRpc(object):
         broker.merge_items(args[0], args[1])
         return HTTPAccepted()
 
+    def range_hashes(self, broker, args):
+        return Response(
+            body=simplejson.dumps(broker.get_range_hashes(*args[:2])),
+            content_type='application/json')
+
     def complete_rsync(self, drive, db_file, args):
         old_filename = os.path.join(self.root, drive, 'tmp', args[0])
         if os.path.exists(db_file):
@@ -662,15 +988,44 @@ class ReplicatorRpc(object):
             return HTTPNotFound()
         broker = self.broker_class(old_filename)
         broker.newid(args[0])
+        if not self._disable_wal(broker):
+            return HTTPInternalServerError()
         renamer(old_filename, db_file)
+        mark_dirty(db_file, self.logger)
         return HTTPNoContent()
 
+    def _disable_wal(self, broker):
+        """
+        Takes a DB received by rsync out of WAL mode before it is renamed.
+
+        :returns: True if the DB can be renamed
+        """
+        if broker.disable_wal():
+            return True
+        self.logger.error(_('Unable to take %s out of WAL mode'),
+                          broker.db_file)
+        return False
+
     def rsync_then_merge(self, drive, db_file, args):
         old_filename = os.path.join(self.root, drive, 'tmp', args[0])
         if not os.path.exists(db_file) or not os.path.exists(old_filename):
             return HTTPNotFound()
         new_broker = self.broker_class(old_filename)
         existing_broker = self.broker_class(db_file)
+        if swift.common.db.DB_WAL or os.path.exists(db_file + '-wal'):
+            # other connections to a db in WAL mode would pair their
+            # write-ahead log with a db file renamed over it, so the rsynced
+            # items are merged into the existing db instead
+            point = -1
+            objects = new_broker.get_items_since(point, 1000)
+            while len(objects):
+                existing_broker.merge_items(objects, args[0])
+                point = objects[-1]['ROWID']
+                objects = new_broker.get_items_since(point, 1000)
+                sleep()
+            existing_broker.merge_syncs(new_broker.get_syncs())
+            os.unlink(old_filename)
+            return HTTPNoContent()
         point = -1
         objects = existing_broker.get_items_since(point, 1000)
         while len(objects):
@@ -679,7 +1034,10 @@ class ReplicatorRpc(object):
             objects = existing_broker.get_items_since(point, 1000)
             sleep()
         new_broker.newid(args[0])
+        if not self._disable_wal(new_broker):
+            return HTTPInternalServerError()
         renamer(old_filename, db_file)
+        mark_dirty(db_file, self.logger)
         return HTTPNoContent()
 
 # Footnote [1]:
@@ -0,0 +1,189 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Middleware that sheds load when a proxy worker is overloaded.
+
+A proxy worker accepts up to ``max_clients`` requests at once; when the
+backends slow down, requests pile up in the worker and every one of them
+gets slower, until clients time out. With this middleware, each worker keeps
+track of its requests in flight and estimates how long a new request would
+take: the larger of the recent response time and the age of the oldest
+request still waiting for its response. The recent response time is the sum
+of two moving averages: the queueing delay, from the time the worker
+accepted the request (or its connection, for the first request on a
+connection) until the request reaches this middleware, and the service
+time, until the rest of the pipeline starts the response. When that
+estimate is above the target of the request's priority class, and at least
+``min_in_flight`` requests are in flight, the request is answered right away
+with a ``503 Service Unavailable`` and a ``Retry-After`` header.
+
+Requests that send a body (such as object PUTs), copies and bulk
+operations spend most of their time transferring data, which says nothing
+about how busy the worker is; they are counted as in flight but left out of
+both averages and of the oldest request's age.
+
+Requests fall in three priority classes:
+
+* ``high``: methods listed in ``high_priority_methods`` (GET and HEAD by
+  default); shed once the estimate is over twice ``target_delay``;
+* ``low``: bulk deletes and archive extractions, container sync requests
+  and requests whose User-Agent starts with one of
+  ``low_priority_user_agents``; shed once the estimate is over half
+  ``target_delay``;
+* ``normal``: everything else; shed once the estimate is over
+  ``target_delay``.
+
+Subrequests made by middleware further up the pipeline (which have their
+swift.source set) belong to a request that was already admitted and are
+never shed.
+
+The middleware should be placed early in the pipeline, after proxy-logging
+so that shed requests are logged::
+
+    [pipeline:main]
+    pipeline = catch_errors healthcheck proxy-logging admission_control
+               cache tempauth proxy-logging proxy-server
+
+    [filter:admission_control]
+    use = egg:swift#admission_control
+    # target_delay = 1.0
+    # min_in_flight = 32
+    # high_priority_methods = GET, HEAD
+    # low_priority_user_agents =
+
+Shed requests are counted in the StatsD metric
+``admission-control.<class>.shed``.
+"""
+
+import time
+from collections import deque
+from math import ceil
+
+from swift.common.swob import Request, HTTPServiceUnavailable
+from swift.common.utils import get_logger, list_from_csv
+
+#: weight of the latest sample in the moving averages
+LATENCY_WEIGHT = 0.1
+
+
+class AdmissionControlMiddleware(object):
+    """
+    Admission control middleware.
+
+    See above for a full description.
+
+    :param app: The next WSGI filter or app in the paste.deploy chain.
+    :param conf: The configuration dict for the middleware.
+    """
+
+    def __init__(self, app, conf, logger=None):
+        self.app = app
+        self.logger = logger or get_logger(conf, log_route='admission-control')
+        self.logger.set_statsd_prefix('admission-control')
+        self.target_delay = float(conf.get('target_delay', 1.0))
+        self.min_in_flight = int(conf.get('min_in_flight', 32))
+        self.high_priority_methods = set(
+            method.upper() for method in list_from_csv(
+                conf.get('high_priority_methods', 'GET, HEAD')))
+        self.low_priority_user_agents = tuple(list_from_csv(
+            conf.get('low_priority_user_agents', '')))
+        self.thresholds = {'high': self.target_delay * 2,
+                           'normal': self.target_delay,
+                           'low': self.target_delay / 2}
+        # start time of each request waiting for its response
+        self.in_flight = {}
+        # (start time, request) in start order of the requests measured;
+        # finished requests are dropped once they reach the left end, so the
+        # first one is the oldest measured request in flight
+        self.start_order = deque()
+        # moving averages of the queueing delay and of the service time
+        self.queue_delay = 0.0
+        self.latency = 0.0
+
+    def priority(self, req):
+        """Returns the priority class of a request."""
+        if 'bulk-delete' in req.params or 'extract-archive' in req.params or \
+                'x-container-sync-key' in req.headers:
+            return 'low'
+        if self.low_priority_user_agents and (req.user_agent or '').startswith(
+                self.low_priority_user_agents):
+            return 'low'
+        if req.method in self.high_priority_methods:
+            return 'high'
+        return 'normal'
+
+    def is_measured(self, req):
+        """
+        Returns False for the requests whose response time depends on the
+        data they transfer rather than on the load of the worker.
+        """
+        if req.method == 'COPY' or 'x-copy-from' in req.headers or \
+                'bulk-delete' in req.params or 'extract-archive' in req.params:
+            return False
+        return not (req.content_length or
+                    'chunked' in req.headers.get('transfer-encoding', ''))
+
+    def estimated_delay(self, now):
+        """
+        Returns the time, in seconds, a new request is expected to wait for
+        its response.
+        """
+        delay = self.queue_delay + self.latency
+        if not self.start_order:
+            return delay
+        return max(delay, now - self.start_order[0][0])
+
+    def __call__(self, env, start_response):
+        if env.get('swift.source'):
+            return self.app(env, start_response)
+        req = Request(env)
+        now = time.time()
+        if len(self.in_flight) >= self.min_in_flight:
+            delay = self.estimated_delay(now)
+            priority = self.priority(req)
+            if delay > self.thresholds[priority]:
+                self.logger.increment('%s.shed' % priority)
+                retry_after = str(int(max(1, ceil(delay))))
+                return HTTPServiceUnavailable(
+                    request=req, headers={'Retry-After': retry_after})(
+                        env, start_response)
+        measured = self.is_measured(req)
+        token = object()
+        self.in_flight[token] = now
+        if measured:
+            received = env.get('swift.request_received', now)
+            self.queue_delay += LATENCY_WEIGHT * (
+                max(now - received, 0) - self.queue_delay)
+            self.start_order.append((now, token))
+        try:
+            return self.app(env, start_response)
+        finally:
+            del self.in_flight[token]
+            while self.start_order and \
+                    self.start_order[0][1] not in self.in_flight:
+                self.start_order.popleft()
+            if measured:
+                self.latency += LATENCY_WEIGHT * (
+                    time.time() - now - self.latency)
+
+
+def filter_factory(global_conf, **local_conf):
+    conf = global_conf.copy()
+    conf.update(local_conf)
+
+    def admission_control_filter(app):
+        return AdmissionControlMiddleware(app, conf)
+    return admission_control_filter
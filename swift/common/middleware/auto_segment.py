@@ -0,0 +1,445 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Middleware that transparently splits large object PUTs into segments.
+
+A single object is written to the three (or number-of-replicas) disks of
+one partition, so the upload of a huge object is limited by those disks, and
+by ``MAX_FILE_SIZE``. With this middleware in the proxy pipeline, an object
+PUT larger than ``segment_size`` is stored as a
+:ref:`static large object <slo-doc>` instead:
+
+* the request body is cut into segments of ``segment_size`` bytes, stored in
+  the container ``<container><segment_container_suffix>`` (created when
+  needed) as ``<object>/<timestamp>/<index>``; every segment lands on a
+  different partition, and up to ``max_concurrent_segments`` segment PUTs are
+  in flight at once, so that a segment is committed by the object servers
+  while the next one is streamed to other disks;
+* once every segment is stored, a static large object manifest is written
+  under the requested name with the metadata of the original request.
+
+The client gets a ``201 Created`` whose ``Etag`` is the MD5 of the data it
+sent, as for a regular PUT; a later GET or HEAD of the object returns the
+static large object Etag. If the request has an ``Etag`` header it is checked
+against the data before the manifest is written. When anything fails, the
+segments uploaded so far are deleted and the error is returned.
+
+The size of a PUT using chunked transfer encoding is not known in advance.
+When ``segment_chunked`` is on, up to ``segment_size`` bytes of such a PUT are
+buffered in the proxy's memory: a body that fits is stored as a regular
+object, a longer one is segmented. Keep ``segment_size`` modest if you turn it
+on.
+
+Segments are written with the permissions of the client: a user who may
+create objects but not containers needs the segment container to exist.
+
+As with any static large object, deleting or overwriting the object only
+removes its manifest; its segments stay in the segment container. Clients
+remove them too by deleting the object with the ``multipart-manifest=delete``
+query parameter before it is overwritten or instead of a plain DELETE.
+
+The middleware must be placed after the authentication middleware and the
+``slo`` middleware in the pipeline, for example::
+
+    [pipeline:main]
+    pipeline = catch_errors healthcheck proxy-logging cache slo tempauth
+               auto_segment proxy-logging proxy-server
+
+    [filter:auto_segment]
+    use = egg:swift#auto_segment
+    # segment_size = 1073741824
+    # max_concurrent_segments = 4
+    # max_segments = 1000
+    # segment_container_suffix = _segments
+    # segment_chunked = false
+    # client_timeout = 60
+
+The subrequests have their swift.source set to "AS" in the proxy logs.
+"""
+
+import mimetypes
+import time
+from cStringIO import StringIO
+from datetime import datetime
+from hashlib import md5
+
+from eventlet import GreenPool, Timeout
+from eventlet.queue import Queue, Empty
+
+from swift import gettext_ as _
+from swift.common.constraints import MAX_FILE_SIZE
+from swift.common.http import is_success, HTTP_NOT_FOUND
+from swift.common.swob import Request, HTTPCreated, HTTPRequestTimeout, \
+    HTTPRequestEntityTooLarge, HTTPUnprocessableEntity, HTTPClientDisconnect
+from swift.common.utils import json, get_logger, config_true_value, \
+    normalize_timestamp
+
+#: request headers that describe the object, not its segments
+OBJECT_HEADERS = ('HTTP_ETAG', 'HTTP_TRANSFER_ENCODING', 'HTTP_X_COPY_FROM',
+                  'HTTP_IF_NONE_MATCH', 'HTTP_X_DETECT_CONTENT_TYPE',
+                  'HTTP_CONTENT_ENCODING', 'HTTP_CONTENT_DISPOSITION')
+OBJECT_HEADER_PREFIXES = ('HTTP_X_OBJECT_', 'HTTP_X_CONTAINER_',
+                          'HTTP_X_DELETE_', 'HTTP_X_REMOVE_',
+                          'HTTP_X_STATIC_LARGE_OBJECT')
+
+
+class SegmentInput(object):
+    """
+    File-like ``wsgi.input`` of a segment PUT, fed with the chunks read from
+    the client.
+
+    :param depth: number of chunks buffered before :meth:`put` blocks
+    """
+
+    def __init__(self, depth=10):
+        self.queue = Queue(depth)
+        self.buffer = ''
+        self.eof = False
+        self.finished = False
+
+    def put(self, chunk):
+        """
+        Queues a chunk of the segment; '' marks its end.
+
+        :returns: False if the segment PUT is over and takes no more data
+        """
+        if self.finished:
+            return False
+        self.queue.put(chunk)
+        return True
+
+    def finish(self):
+        """Called once the segment PUT is over, to unblock :meth:`put`."""
+        self.finished = True
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.queue.get()
+            if not chunk:
+                self.eof = True
+            self.buffer += chunk
+            if size >= 0:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class BufferedInput(object):
+    """
+    File-like ``wsgi.input`` returning the data already read from a request
+    body before the rest of it.
+
+    :param data: the data already read
+    :param wsgi_input: the request's ``wsgi.input``
+    """
+
+    def __init__(self, data, wsgi_input):
+        self.data = data
+        self.wsgi_input = wsgi_input
+
+    def read(self, size=-1):
+        if not self.data:
+            return self.wsgi_input.read(size)
+        if size < 0:
+            data, self.data = self.data, ''
+            return data + self.wsgi_input.read()
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+
+class AutoSegmentMiddleware(object):
+    """
+    Middleware storing large object PUTs as static large objects.
+
+    See above for a full description.
+    """
+
+    def __init__(self, app, conf, logger=None):
+        self.app = app
+        self.logger = logger or get_logger(conf, log_route='auto_segment')
+        self.segment_size = int(conf.get('segment_size', 1024 ** 3))
+        if not 0 < self.segment_size <= MAX_FILE_SIZE:
+            raise ValueError('segment_size must be between 1 and %d' %
+                             MAX_FILE_SIZE)
+        self.max_concurrent_segments = int(
+            conf.get('max_concurrent_segments', 4))
+        self.max_segments = int(conf.get('max_segments', 1000))
+        self.segment_container_suffix = conf.get(
+            'segment_container_suffix', '_segments')
+        self.segment_chunked = config_true_value(
+            conf.get('segment_chunked', 'false'))
+        self.client_timeout = int(conf.get('client_timeout', 60))
+        self.client_chunk_size = int(conf.get('client_chunk_size', 65536))
+
+    def should_segment(self, req):
+        """Returns True if the request is an object PUT to segment."""
+        if req.method != 'PUT' or 'swift.source' in req.environ or \
+                'X-Copy-From' in req.headers or \
+                'X-Object-Manifest' in req.headers or \
+                'multipart-manifest' in req.params:
+            return False
+        try:
+            req.split_path(4, 4, True)
+        except ValueError:
+            return False
+        if 'chunked' in req.headers.get('transfer-encoding', ''):
+            return self.segment_chunked
+        return req.content_length > self.segment_size
+
+    def _sub_request(self, req, method, path, body=None):
+        """
+        Returns a request made with the credentials of req but none of the
+        headers describing its object.
+
+        :param path: unquoted path of the request
+        """
+        env = req.environ.copy()
+        for key in env.keys():
+            if key in OBJECT_HEADERS or key.startswith(OBJECT_HEADER_PREFIXES):
+                del env[key]
+        env.pop('CONTENT_LENGTH', None)
+        env.pop('CONTENT_TYPE', None)
+        env.update({'REQUEST_METHOD': method, 'PATH_INFO': path,
+                    'SCRIPT_NAME': '', 'QUERY_STRING': '',
+                    'swift.source': 'AS', 'wsgi.input': StringIO(body or '')})
+        if body is not None:
+            env['CONTENT_LENGTH'] = str(len(body))
+        env['HTTP_USER_AGENT'] = '%s AutoSegment' % \
+            req.environ.get('HTTP_USER_AGENT', '')
+        return Request(env)
+
+    def _ensure_container(self, req, path):
+        """Returns an error response, or None once the container exists."""
+        resp = self._sub_request(req, 'HEAD', path).get_response(self.app)
+        if resp.status_int == HTTP_NOT_FOUND:
+            resp = self._sub_request(req, 'PUT', path, body='').get_response(
+                self.app)
+        if not is_success(resp.status_int):
+            return resp
+
+    def _put_segment(self, req, path, seg_input, length, results, index):
+        sub_req = self._sub_request(req, 'PUT', path)
+        sub_req.environ['wsgi.input'] = seg_input
+        sub_req.environ['CONTENT_TYPE'] = 'application/octet-stream'
+        if length is None:
+            sub_req.environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+        else:
+            sub_req.environ['CONTENT_LENGTH'] = str(length)
+        try:
+            results[index] = sub_req.get_response(self.app)
+        finally:
+            seg_input.finish()
+
+    def _delete_segments(self, req, paths):
+        pool = GreenPool(self.max_concurrent_segments)
+        for path in paths:
+            pool.spawn_n(lambda p: self._sub_request(
+                req, 'DELETE', p).get_response(self.app), path)
+        pool.waitall()
+
+    def _upload_segments(self, req, seg_prefix):
+        """
+        Streams the request body to segments.
+
+        :returns: a tuple of (response, segments, md5 of the body) where
+                  response is an error response or None, and segments is the
+                  list of (path, bytes, segment response) of the segments
+                  started, in order
+        """
+        pool = GreenPool(self.max_concurrent_segments)
+        results = {}
+        segments = []
+        body_etag = md5()
+        remaining = None
+        if 'chunked' not in req.headers.get('transfer-encoding', ''):
+            remaining = req.content_length
+        reader = req.environ['wsgi.input'].read
+        error = None
+        seg_input = None
+        try:
+            while remaining is None or remaining > 0:
+                if [resp for resp in results.values()
+                        if not resp.is_success]:
+                    # the upload fails anyway; stop reading the body
+                    break
+                seg_len = self.segment_size
+                if remaining is not None:
+                    seg_len = min(seg_len, remaining)
+                with Timeout(self.client_timeout):
+                    chunk = reader(min(self.client_chunk_size, seg_len))
+                if not chunk:
+                    break
+                if len(segments) >= self.max_segments:
+                    error = HTTPRequestEntityTooLarge(
+                        request=req, body='Object would need more than %d '
+                        'segments' % self.max_segments)
+                    break
+                path = '%s/%08d' % (seg_prefix, len(segments))
+                seg_input = SegmentInput()
+                pool.spawn_n(self._put_segment, req, path, seg_input,
+                             None if remaining is None else seg_len, results,
+                             len(segments))
+                seg_bytes = 0
+                while chunk and seg_input.put(chunk):
+                    body_etag.update(chunk)
+                    seg_bytes += len(chunk)
+                    if seg_bytes >= seg_len:
+                        break
+                    with Timeout(self.client_timeout):
+                        chunk = reader(min(self.client_chunk_size,
+                                           seg_len - seg_bytes))
+                seg_input.put('')
+                seg_input = None
+                segments.append([path, seg_bytes, None])
+                if remaining is not None:
+                    remaining -= seg_bytes
+                    if seg_bytes < seg_len:
+                        break
+        except Timeout:
+            self.logger.warning(_('ERROR Client read timeout (%ss)'),
+                                self.client_timeout)
+            error = HTTPRequestTimeout(request=req)
+        except (Exception, Timeout):
+            self.logger.exception(
+                _('ERROR Exception causing client disconnect'))
+            error = HTTPClientDisconnect(request=req)
+        if seg_input:
+            # end the segment being read, which then fails as too short
+            seg_input.put('')
+            segments.append([path, seg_bytes, None])
+        pool.waitall()
+        for index, segment in enumerate(segments):
+            segment[2] = results.get(index)
+            if error is None and not (segment[2] and segment[2].is_success):
+                error = segment[2] or HTTPClientDisconnect(request=req)
+        if error is None and remaining:
+            error = HTTPClientDisconnect(request=req)
+        return error, segments, body_etag.hexdigest()
+
+    def _buffer_chunked(self, req):
+        """
+        Reads a chunked request body until it is over or longer than
+        segment_size.
+
+        :returns: a tuple of (data read, True if the body is over)
+        """
+        reader = req.environ['wsgi.input'].read
+        chunks = []
+        size = 0
+        while size <= self.segment_size:
+            with Timeout(self.client_timeout):
+                chunk = reader(min(self.client_chunk_size,
+                                   self.segment_size + 1 - size))
+            if not chunk:
+                return ''.join(chunks), True
+            chunks.append(chunk)
+            size += len(chunk)
+        return ''.join(chunks), False
+
+    def handle_put(self, req):
+        vrs, account, container, obj = req.split_path(4, 4, True)
+        if 'chunked' in req.headers.get('transfer-encoding', ''):
+            try:
+                data, complete = self._buffer_chunked(req)
+            except Timeout:
+                self.logger.warning(_('ERROR Client read timeout (%ss)'),
+                                    self.client_timeout)
+                return HTTPRequestTimeout(request=req)
+            except (Exception, Timeout):
+                self.logger.exception(
+                    _('ERROR Exception causing client disconnect'))
+                return HTTPClientDisconnect(request=req)
+            if complete:
+                # small enough to be stored as is
+                req.environ['CONTENT_LENGTH'] = str(len(data))
+                req.environ.pop('HTTP_TRANSFER_ENCODING', None)
+                req.environ['wsgi.input'] = StringIO(data)
+                return req.get_response(self.app)
+            req.environ['wsgi.input'] = BufferedInput(
+                data, req.environ['wsgi.input'])
+        seg_container = container + self.segment_container_suffix
+        error = self._ensure_container(
+            req, '/'.join(['', vrs, account, seg_container]))
+        if error:
+            return error
+        seg_prefix = '/'.join(['', vrs, account, seg_container, obj,
+                               normalize_timestamp(time.time())])
+        error, segments, body_etag = self._upload_segments(req, seg_prefix)
+        client_etag = req.headers.get('etag', '').strip('"')
+        if not error and client_etag and client_etag != body_etag:
+            error = HTTPUnprocessableEntity(request=req)
+        if not error:
+            error = self._put_manifest(req, segments)
+        if error:
+            self.logger.info(
+                _('Deleting %(count)d segments of failed PUT to %(path)s'),
+                {'count': len(segments), 'path': req.path})
+            self._delete_segments(req, [path for path, _j, _r in segments])
+            return error
+        return HTTPCreated(request=req, etag=body_etag)
+
+    def _put_manifest(self, req, segments):
+        """Returns an error response, or None once the manifest is stored."""
+        manifest = []
+        total_size = 0
+        for path, size, resp in segments:
+            last_modified = resp.last_modified or datetime.now()
+            manifest.append({
+                'name': '/' + path.split('/', 3)[3].decode('utf-8'),
+                'bytes': size,
+                'hash': resp.etag,
+                'content_type': 'application/octet-stream',
+                'last_modified': last_modified.strftime(
+                    '%Y-%m-%dT%H:%M:%S.%f')})
+            total_size += size
+        body = json.dumps(manifest)
+        env = req.environ
+        content_type = env.get('CONTENT_TYPE')
+        if not content_type:
+            content_type = mimetypes.guess_type(req.path_info)[0] or \
+                'application/octet-stream'
+        env['CONTENT_TYPE'] = '%s;swift_bytes=%d' % (content_type, total_size)
+        env['swift.content_type_overriden'] = True
+        env['HTTP_X_STATIC_LARGE_OBJECT'] = 'True'
+        env['CONTENT_LENGTH'] = str(len(body))
+        env['wsgi.input'] = StringIO(body)
+        for key in ('HTTP_ETAG', 'HTTP_TRANSFER_ENCODING'):
+            env.pop(key, None)
+        resp = Request(env).get_response(self.app)
+        if not resp.is_success:
+            return resp
+
+    def __call__(self, env, start_response):
+        req = Request(env)
+        if not self.should_segment(req):
+            return self.app(env, start_response)
+        return self.handle_put(req)(env, start_response)
+
+
+def filter_factory(global_conf, **local_conf):
+    conf = global_conf.copy()
+    conf.update(local_conf)
+
+    def auto_segment_filter(app):
+        return AutoSegmentMiddleware(app, conf)
+    return auto_segment_filter
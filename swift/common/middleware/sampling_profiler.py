@@ -0,0 +1,226 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Sampling profiler middleware for live Swift servers.
+
+While profiling is enabled, the worker process receives a ``SIGPROF`` every
+``sample_interval`` seconds of CPU time and records the Python stack of
+whichever greenthread is running at that moment. Stacks are aggregated in
+memory, so the overhead is a dictionary increment per sample, and are written
+out in the "collapsed" format used by flame graph tools (one line per
+distinct stack, frames separated by ``;``, followed by the sample count)::
+
+    <log_dir>/<log_name>.<pid>.collapsed
+
+The middleware can be placed in the pipeline of any server (proxy, object,
+container or account)::
+
+    [pipeline:main]
+    pipeline = sampling_profiler object-server
+
+    [filter:sampling_profiler]
+    use = egg:swift#sampling_profiler
+    # log_dir = /var/cache/swift/profile
+    # sample_interval = 0.005
+    # toggle_signal = SIGUSR2
+    # profile_path = /__profile__
+    # allowed_ips = 127.0.0.1,::1
+
+Profiling is toggled at runtime without a restart, either:
+
+* by sending ``toggle_signal`` to the worker processes (for instance
+  ``pkill -USR2 -f swift-object-server``), which act on it within a second;
+  stopping writes the stacks to the file above, or
+* through ``profile_path`` from one of ``allowed_ips``:
+  ``GET <profile_path>/start`` and ``GET <profile_path>/stop`` control the
+  worker that accepted the request, and ``GET <profile_path>`` returns that
+  worker's collapsed stacks collected so far.
+
+Only the main thread of a worker is sampled; work handed to a thread pool
+(such as disk I/O in the object server) shows up as the greenthread waiting
+for it.
+"""
+
+import os
+import signal
+from collections import defaultdict
+
+from eventlet import sleep, spawn_n
+
+from swift.common.swob import Request, Response, HTTPNotFound
+from swift.common.utils import get_logger, list_from_csv, write_file
+
+#: seconds between checks for a toggle requested by signal
+TOGGLE_CHECK_INTERVAL = 1
+
+
+class StackSampler(object):
+    """
+    Records the running Python stack on every ``SIGPROF`` delivered by the
+    process CPU-time interval timer.
+
+    :param interval: seconds of CPU time between samples
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.running = False
+        self.stacks = defaultdict(int)
+
+    def start(self):
+        if self.running:
+            return
+        signal.signal(signal.SIGPROF, self.sample)
+        # restart interrupted system calls instead of failing with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.running = False
+
+    def reset(self):
+        self.stacks.clear()
+
+    def sample(self, signum, frame):
+        """SIGPROF handler; frame is the frame that was interrupted."""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('%s (%s:%d)' % (code.co_name, code.co_filename,
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        names.reverse()
+        self.stacks[';'.join(names)] += 1
+
+    def collapsed(self):
+        """Returns the samples in collapsed stack format."""
+        return ''.join('%s %d\n' % (stack, count)
+                       for stack, count in sorted(self.stacks.iteritems()))
+
+
+class SamplingProfilerMiddleware(object):
+    """
+    Middleware that profiles its worker on demand with a
+    :class:`StackSampler`.
+    """
+
+    def __init__(self, app, conf, logger=None):
+        self.app = app
+        self.logger = logger or get_logger(conf, log_route='sampling-profiler')
+        self.log_dir = conf.get('log_dir', '/var/cache/swift/profile')
+        self.log_name = conf.get('log_name', 'swift')
+        self.profile_path = conf.get('profile_path', '/__profile__')
+        self.allowed_ips = list_from_csv(
+            conf.get('allowed_ips', '127.0.0.1,::1'))
+        self.sampler = StackSampler(
+            float(conf.get('sample_interval', 0.005)))
+        self.toggle_signum = None
+        toggle_signal = conf.get('toggle_signal', 'SIGUSR2').strip()
+        if toggle_signal:
+            signum = getattr(signal, toggle_signal.upper(), None)
+            if not isinstance(signum, int):
+                raise ValueError('Invalid toggle_signal: %r' % toggle_signal)
+            self.toggle_signum = signum
+            # the handler is only installed in the workers (see __call__);
+            # until then, the signal must not kill the process
+            signal.signal(signum, signal.SIG_IGN)
+        self.toggle_requested = False
+        self.watching = False
+
+    @property
+    def profile_file(self):
+        return os.path.join(self.log_dir, '%s.%d.collapsed' %
+                            (self.log_name, os.getpid()))
+
+    def start(self):
+        self.sampler.reset()
+        self.sampler.start()
+        self.logger.info('Sampling profiler started')
+
+    def stop(self):
+        self.sampler.stop()
+        write_file(self.profile_file, self.sampler.collapsed())
+        self.logger.info('Sampling profiler stopped, stacks written to %s' %
+                         self.profile_file)
+
+    def toggle(self):
+        """Switches profiling on or off."""
+        try:
+            if self.sampler.running:
+                self.stop()
+            else:
+                self.start()
+        except Exception:
+            self.logger.exception('Error toggling the sampling profiler')
+
+    def request_toggle(self, *args):
+        """
+        Handler of ``toggle_signal``.  It only flags the request; the toggle
+        runs in a greenthread, outside of whatever the signal interrupted.
+        """
+        self.toggle_requested = True
+
+    def check_toggle(self):
+        if self.toggle_requested:
+            self.toggle_requested = False
+            self.toggle()
+
+    def watch_toggle(self):
+        while True:
+            sleep(TOGGLE_CHECK_INTERVAL)
+            self.check_toggle()
+
+    def GET(self, req):
+        action = req.path[len(self.profile_path):].strip('/')
+        if action == 'start':
+            self.start()
+            body = 'Profiling %d\n' % os.getpid()
+        elif action == 'stop':
+            self.stop()
+            body = 'Wrote %s\n' % self.profile_file
+        elif not action:
+            body = self.sampler.collapsed()
+        else:
+            return HTTPNotFound(request=req)
+        return Response(request=req, body=body, content_type='text/plain')
+
+    def __call__(self, env, start_response):
+        if self.toggle_signum and not self.watching:
+            # done on the first request, so only in the workers and not
+            # while the parent process validates the configuration
+            self.watching = True
+            signal.signal(self.toggle_signum, self.request_toggle)
+            spawn_n(self.watch_toggle)
+        req = Request(env)
+        if req.method == 'GET' and req.remote_addr in self.allowed_ips and \
+                (req.path == self.profile_path or
+                 req.path.startswith(self.profile_path + '/')):
+            return self.GET(req)(env, start_response)
+        return self.app(env, start_response)
+
+
+def filter_factory(global_conf, **local_conf):
+    conf = global_conf.copy()
+    conf.update(local_conf)
+
+    def sampling_profiler_filter(app):
+        return SamplingProfilerMiddleware(app, conf)
+    return sampling_profiler_filter
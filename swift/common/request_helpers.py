@@ -87,3 +87,33 @@ def split_and_validate_path(request, minsegs=1, maxsegs=None,
     except ValueError as err:
         raise HTTPBadRequest(body=str(err), request=request,
                              content_type='text/plain')
+
+
+def format_load_hint(active=0, queued=0, replicating=0):
+    """
+    Formats the value of the X-Backend-Load header storage servers add to
+    their responses, telling the proxy how busy the request's device is.
+
+    :param active: requests being handled for the device by this worker
+    :param queued: disk operations queued or running for the device
+    :param replicating: replication requests in progress on the server
+    :returns: header value, e.g. 'active=3 queued=1 replicating=0'
+    """
+    return 'active=%d queued=%d replicating=%d' % (
+        active, queued, replicating)
+
+
+def parse_load_hint(value):
+    """
+    Parses an X-Backend-Load header value.
+
+    :param value: header value, as made by :func:`format_load_hint`
+    :returns: total amount of outstanding work it reports, or None if the
+              value is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return sum(int(item.split('=', 1)[1]) for item in value.split())
+    except (IndexError, ValueError):
+        return None
@@ -0,0 +1,201 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Lightweight request tracing.
+
+Servers record timed spans for the phases of a request, tagged with the
+request's transaction id, so that the hops of a single request (proxy,
+object, container and account servers) can be put back together afterwards.
+Each span is one JSON object per line::
+
+    {"trans_id": "tx...", "server": "object-server", "host": "...",
+     "pid": 1234, "name": "disk.fsync", "start": 1380000000.123,
+     "duration": 0.0042, ...}
+
+Spans are appended to ``trace_file``, within a second or once 64 KiB of
+them are buffered, and/or sent as UDP datagrams to
+``trace_udp_host``:``trace_udp_port``. Tracing is off unless one of these is
+set. ``bin/swift-trace`` reassembles the spans of one transaction, read from
+the span files of every node involved, into a waterfall.
+"""
+
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+from eventlet import spawn_after
+
+from swift import gettext_ as _
+from swift.common.utils import json
+
+#: bytes of spans buffered before they are written to trace_file
+TRACE_BUFFER_SIZE = 65536
+#: seconds after which buffered spans are written to trace_file
+TRACE_FLUSH_INTERVAL = 1
+
+
+def node_to_string(node):
+    """Returns the ip:port/device string used to tag backend spans."""
+    return '%s:%s/%s' % (node['ip'], node['port'], node['device'])
+
+
+class Tracer(object):
+    """
+    Records spans for one server.
+
+    :param conf: server configuration dict
+    :param server: name of the server recording spans, e.g. 'proxy-server'
+    :param logger: logger for errors while writing or sending spans
+    """
+
+    def __init__(self, conf, server, logger=None):
+        self.server = server
+        self.logger = logger
+        self.trace_file = conf.get('trace_file')
+        self.udp_host = conf.get('trace_udp_host')
+        self.udp_port = int(conf.get('trace_udp_port', 8126))
+        self.enabled = bool(self.trace_file or self.udp_host)
+        self.hostname = socket.gethostname()
+        self.fd = None
+        self.buffer = []
+        self.buffered = 0
+        self.sock = None
+
+    def record(self, trans_id, name, start, end=None, **tags):
+        """
+        Records a span that ran from start to end (default now).
+
+        :param trans_id: transaction id the span belongs to; spans without
+                         one are dropped
+        :param name: name of the phase, e.g. 'disk.open'
+        :param start: start time of the phase, from time.time()
+        :param end: end time of the phase, from time.time()
+        :param tags: extra values stored with the span
+        """
+        if not self.enabled or not trans_id:
+            return
+        if end is None:
+            end = time.time()
+        span = {'trans_id': trans_id, 'server': self.server,
+                'host': self.hostname, 'pid': os.getpid(), 'name': name,
+                'start': start, 'duration': end - start}
+        span.update(tags)
+        self._emit(json.dumps(span))
+
+    @contextmanager
+    def span(self, trans_id, name, **tags):
+        """Context manager recording a span for the enclosed block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(trans_id, name, start, **tags)
+
+    def _emit(self, line):
+        # a span that can't be recorded must not fail the request
+        if self.trace_file:
+            if not self.buffer:
+                spawn_after(TRACE_FLUSH_INTERVAL, self.flush)
+            self.buffer.append(line + '\n')
+            self.buffered += len(line) + 1
+            if self.buffered >= TRACE_BUFFER_SIZE:
+                self.flush()
+        if self.udp_host:
+            try:
+                if self.sock is None:
+                    self.sock = socket.socket(socket.AF_INET,
+                                              socket.SOCK_DGRAM)
+                self.sock.sendto(line, (self.udp_host, self.udp_port))
+            except (IOError, OSError) as err:
+                self._error(_('Error sending trace span to %(host)s:%(port)s:'
+                              ' %(err)s'), host=self.udp_host,
+                            port=self.udp_port, err=err)
+
+    def flush(self):
+        """Writes the buffered spans to trace_file."""
+        if not self.buffer:
+            return
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        try:
+            if self.fd is None:
+                self.fd = os.open(self.trace_file,
+                                  os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            # workers share the file; one O_APPEND write per flush keeps
+            # their lines whole, which a buffered file object doesn't
+            os.write(self.fd, data)
+        except (IOError, OSError) as err:
+            self._error(_('Error writing trace spans to %(file)s: %(err)s'),
+                        file=self.trace_file, err=err)
+
+    def _error(self, msg, **kwargs):
+        if self.logger:
+            self.logger.error(msg % kwargs)
+
+
+def load_spans(files, trans_id):
+    """
+    Reads the spans of one transaction from span files.
+
+    :param files: iterable of open files or lists of lines
+    :param trans_id: transaction id to look for
+    :returns: list of span dicts, sorted by start time
+    """
+    spans = []
+    for fp in files:
+        for line in fp:
+            if trans_id not in line:
+                continue
+            try:
+                span = json.loads(line)
+            except ValueError:
+                continue
+            if span.get('trans_id') == trans_id:
+                spans.append(span)
+    spans.sort(key=lambda s: (s['start'], -s['duration']))
+    return spans
+
+
+def format_waterfall(spans, width=40):
+    """
+    Renders spans as a text waterfall, one span per line, with offsets and
+    durations in milliseconds relative to the earliest span.
+
+    :param spans: list of spans as returned by :func:`load_spans`
+    :param width: width of the bar column in characters
+    :returns: list of lines
+    """
+    if not spans:
+        return []
+    begin = min(s['start'] for s in spans)
+    total = max(s['start'] + s['duration'] for s in spans) - begin
+    scale = width / total if total > 0 else 0
+    lines = []
+    for span in spans:
+        offset = span['start'] - begin
+        bar_start = int(offset * scale)
+        bar_len = max(1, int(span['duration'] * scale))
+        bar = ' ' * bar_start + '#' * bar_len
+        tags = ' '.join(
+            '%s=%s' % (k, span[k]) for k in sorted(span)
+            if k not in ('trans_id', 'server', 'host', 'pid', 'name',
+                         'start', 'duration'))
+        lines.append('%9.2f %9.2f |%-*s| %s %s %s %s' % (
+            offset * 1000, span['duration'] * 1000, width, bar[:width],
+            span['host'], span['server'], span['name'], tags))
+    return [line.rstrip() for line in lines]
@@ -662,6 +662,9 @@ class StatsdClient(object):
     def timing(self, metric, timing_ms, sample_rate=None):
         return self._send(metric, timing_ms, 'ms', sample_rate)
 
+    def gauge(self, metric, value, sample_rate=None):
+        return self._send(metric, value, 'g', sample_rate)
+
     def timing_since(self, metric, orig_time, sample_rate=None):
         return self.timing(metric, (time.time() - orig_time) * 1000,
                            sample_rate)
@@ -825,6 +828,7 @@ class LogAdapter(logging.LoggerAdapter, object):
     increment = statsd_delegate('increment')
     decrement = statsd_delegate('decrement')
     timing = statsd_delegate('timing')
+    gauge = statsd_delegate('gauge')
     timing_since = statsd_delegate('timing_since')
     transfer_rate = statsd_delegate('transfer_rate')
 
@@ -1639,6 +1643,28 @@ class GreenAsyncPile(object):
             else:
                 return self._responses.get()
 
+    def waitall(self, timeout):
+        """
+        Waits at most timeout seconds for the jobs still running.
+
+        :param timeout: seconds to wait for results
+        :returns: list of the results that came in during that time; the
+                  jobs that did not finish in time keep running, and their
+                  results can still be retrieved by iterating over the pile
+        """
+        results = []
+        try:
+            with GreenAsyncPileWaitallTimeout(timeout):
+                while True:
+                    results.append(next(self))
+        except (GreenAsyncPileWaitallTimeout, StopIteration):
+            pass
+        return results
+
+
+class GreenAsyncPileWaitallTimeout(Timeout):
+    pass
+
 
 class ModifiedParseResult(ParseResult):
     "Parse results class for urlparse."
@@ -2181,6 +2207,11 @@ class ThreadPool(object):
         result = ev.wait()
         return result
 
+    @property
+    def pending(self):
+        """Number of calls queued or running in the pool's threads."""
+        return self._run_queue.unfinished_tasks
+
     def _run_in_eventlet_tpool(self, func, *args, **kwargs):
         """
         Really run something in an external thread, even if we haven't got any
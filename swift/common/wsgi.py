@@ -26,16 +26,19 @@ from StringIO import StringIO
 
 import eventlet
 import eventlet.debug
-from eventlet import greenio, GreenPool, sleep, wsgi, listen
+from eventlet import greenio, GreenPool, sleep, wsgi, listen, corolocal, \
+    Timeout
 from paste.deploy import loadwsgi
 from eventlet.green import socket, ssl
 from urllib import unquote
 
 from swift.common import utils
+from swift.common.ring import Ring
 from swift.common.swob import Request
 from swift.common.utils import capture_stdio, disable_fallocate, \
     drop_privileges, get_logger, NullLogger, config_true_value, \
-    validate_configuration, get_hub, config_auto_int_value
+    validate_configuration, get_hub, config_auto_int_value, json, \
+    list_from_csv, whataremyips
 
 try:
     import multiprocessing
@@ -112,6 +115,16 @@ appconfig = wrap_conf_type(loadwsgi.appconfig)
 loadapp = wrap_conf_type(loadwsgi.loadapp)
 
 
+def loadcontext(object_type, conf_path, *args, **kwargs):
+    """
+    Returns the paste.deploy context for object_type from the config at
+    conf_path (either a file or a directory) without creating the object.
+    """
+    def _loadcontext(conf_uri, *args, **kwargs):
+        return loadwsgi.loadcontext(object_type, conf_uri, *args, **kwargs)
+    return wrap_conf_type(_loadcontext)(conf_path, *args, **kwargs)
+
+
 def monkey_patch_mimetools():
     """
     mimetools.Message defaults content-type to "text/plain"
@@ -132,11 +145,31 @@ def monkey_patch_mimetools():
     mimetools.Message.parsetype = parsetype
 
 
-def get_socket(conf, default_port=8080):
+def _listen_reuse_port(bind_addr, backlog, family):
+    """
+    Like eventlet.listen, but the socket shares its address with the other
+    SO_REUSEPORT sockets bound to it; the kernel spreads the incoming
+    connections over them.
+    """
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(bind_addr)
+        sock.listen(backlog)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def get_socket(conf, default_port=8080, reuse_port=False):
     """Bind socket to bind ip:port in conf
 
     :param conf: Configuration dict to read settings from
     :param default_port: port to use if not specified in conf
+    :param reuse_port: if True, set SO_REUSEPORT so that several sockets,
+                       one per worker, can listen on the same address
 
     :returns : a socket object as returned from socket.listen or
                ssl.wrap_socket if conf specifies cert_file
@@ -152,8 +185,12 @@ def get_socket(conf, default_port=8080):
     warn_ssl = False
     while not sock and time.time() < retry_until:
         try:
-            sock = listen(bind_addr, backlog=int(conf.get('backlog', 4096)),
-                          family=address_family)
+            backlog = int(conf.get('backlog', 4096))
+            if reuse_port:
+                sock = _listen_reuse_port(bind_addr, backlog, address_family)
+            else:
+                sock = listen(bind_addr, backlog=backlog,
+                              family=address_family)
             if 'cert_file' in conf:
                 warn_ssl = True
                 sock = ssl.wrap_socket(sock, certfile=conf['cert_file'],
@@ -180,6 +217,27 @@ def get_socket(conf, default_port=8080):
     return sock
 
 
+def get_ring_ports(conf, ring_name='object'):
+    """
+    Returns the ports of the devices of this node in a ring, for running
+    dedicated workers per port (see ``servers_per_port``).
+
+    :param conf: server configuration dict; the ring is loaded from
+                 ``swift_dir``, and if ``bind_ip`` is set only the devices on
+                 that address are considered
+    :param ring_name: name of the ring
+    :returns: sorted list of ports
+    """
+    ring = Ring(conf.get('swift_dir', '/etc/swift'), ring_name=ring_name)
+    bind_ip = conf.get('bind_ip', '0.0.0.0')
+    if bind_ip in ('0.0.0.0', '::'):
+        my_ips = set(whataremyips())
+    else:
+        my_ips = set([bind_ip])
+    return sorted(set(dev['port'] for dev in ring.devs
+                      if dev and dev['ip'] in my_ips))
+
+
 class RestrictedGreenPool(GreenPool):
     """
     Works the same as GreenPool, but if the size is specified as one, then the
@@ -196,7 +254,370 @@ class RestrictedGreenPool(GreenPool):
             self.waitall()
 
 
-def run_server(conf, logger, sock, global_conf=None):
+class WorkerStats(object):
+    """
+    Connection and request counts of one worker process, kept by
+    :class:`SwiftHttpProtocol`.
+    """
+
+    def __init__(self):
+        self.accepted = 0
+        self.connections = 0
+        self.requests = 0
+        self.reported_accepted = 0
+
+    def report(self, logger, worker_index):
+        """
+        Sends the counts to StatsD as workers.<index>.accepted (counter) and
+        workers.<index>.connections and workers.<index>.requests (gauges of
+        the open connections and of the requests being handled).
+        """
+        prefix = 'workers.%d.' % worker_index
+        logger.update_stats(prefix + 'accepted',
+                            self.accepted - self.reported_accepted)
+        self.reported_accepted = self.accepted
+        logger.gauge(prefix + 'connections', self.connections)
+        logger.gauge(prefix + 'requests', self.requests)
+
+
+class SwiftHttpProtocol(wsgi.HttpProtocol):
+    """
+    HttpProtocol that bounds how long, and for how many requests, a
+    persistent (keep-alive) client connection is kept open, and counts
+    connections and requests in :attr:`stats`.
+
+    The time a request was received, which is when its connection was
+    accepted for the first request on a connection, is passed to the app
+    as ``swift.request_received`` so that the time the request waited in
+    the worker before being handled can be told from the time taken to
+    handle it.
+
+    The limits are class attributes, set from the configuration by
+    :func:`run_server`.
+    """
+    #: seconds to wait for the next request on an idle connection
+    keepalive_timeout = None
+    #: number of requests after which the connection is closed; 0 for no
+    #: limit
+    max_requests_per_connection = 0
+    #: counts of this worker process
+    stats = WorkerStats()
+
+    def handle(self):
+        self.request_received = time.time()
+        self.stats.accepted += 1
+        self.stats.connections += 1
+        try:
+            wsgi.HttpProtocol.handle(self)
+        finally:
+            self.stats.connections -= 1
+
+    def handle_one_request(self):
+        # Only the wait for a request line is bounded here; once a request
+        # has started, the client_timeout and node_timeout of the servers
+        # take over.
+        self.idle_timeout = Timeout(self.keepalive_timeout)
+        self.in_request = False
+        try:
+            wsgi.HttpProtocol.handle_one_request(self)
+        except Timeout as err:
+            if err is not self.idle_timeout:
+                raise
+            self.close_connection = 1
+        finally:
+            self.idle_timeout.cancel()
+            if self.in_request:
+                self.stats.requests -= 1
+
+    def parse_request(self):
+        self.idle_timeout.cancel()
+        if not wsgi.HttpProtocol.parse_request(self):
+            return False
+        self.in_request = True
+        self.stats.requests += 1
+        self.requests_handled = getattr(self, 'requests_handled', 0) + 1
+        if self.requests_handled > 1:
+            self.request_received = time.time()
+        if self.max_requests_per_connection and \
+                self.requests_handled >= self.max_requests_per_connection:
+            # answered with "Connection: close"
+            self.close_connection = 1
+        return True
+
+    def get_environ(self, *args, **kwargs):
+        env = wsgi.HttpProtocol.get_environ(self, *args, **kwargs)
+        env['swift.request_received'] = self.request_received
+        return env
+
+
+class PipelineTimingStats(object):
+    """
+    Per-worker aggregate of the time spent in each stage of a pipeline
+    loaded by :func:`loadapp_with_pipeline_timing`.
+
+    Stage times are wall clock and exclusive of any downstream stage
+    (including subrequests made through the rest of the pipeline), summed
+    over the request call and the iteration of its response body.
+    Time-to-first-byte is measured from the moment a stage is entered until
+    it yields its first non-empty chunk.
+
+    :param conf: configuration dict for the server
+    :param logger: logger used to emit StatsD timings
+    """
+
+    def __init__(self, conf, logger=None):
+        self.logger = logger or get_logger(conf, log_route='pipeline-timing')
+        self.path = conf.get('pipeline_timing_path',
+                             '/debug/pipeline_timing')
+        self.allowed_ips = list_from_csv(
+            conf.get('pipeline_timing_allowed_ips', '127.0.0.1,::1'))
+        self.stages = []
+        self.totals = {}
+
+    def add_stage(self, name):
+        """
+        Register a pipeline stage.  Stages must be added from the outermost
+        filter inward; names used more than once in a pipeline (like
+        proxy-logging) get a numeric suffix.
+
+        :param name: the config section name of the stage
+        :returns: the unique name the stage's timings are recorded under
+        """
+        unique_name = name
+        suffix = 1
+        while unique_name in self.totals:
+            suffix += 1
+            unique_name = '%s_%d' % (name, suffix)
+        self.stages.append(unique_name)
+        self.totals[unique_name] = {
+            'requests': 0, 'time': 0.0, 'max_time': 0.0,
+            'first_byte_requests': 0, 'first_byte_time': 0.0}
+        return unique_name
+
+    def record(self, name, elapsed, first_byte):
+        """
+        Record the timings of one request through a stage.
+
+        :param name: unique stage name as returned by add_stage
+        :param elapsed: seconds spent in the stage itself
+        :param first_byte: seconds until the stage yielded its first byte, or
+                           None if it never did
+        """
+        totals = self.totals[name]
+        totals['requests'] += 1
+        totals['time'] += elapsed
+        totals['max_time'] = max(totals['max_time'], elapsed)
+        self.logger.timing('pipeline.%s.timing' % name, elapsed * 1000)
+        if first_byte is not None:
+            totals['first_byte_requests'] += 1
+            totals['first_byte_time'] += first_byte
+            self.logger.timing('pipeline.%s.first-byte.timing' % name,
+                               first_byte * 1000)
+
+    def to_dict(self):
+        """
+        Returns the aggregated timings, in milliseconds, in pipeline order.
+        """
+        stages = []
+        for name in self.stages:
+            totals = self.totals[name]
+            requests = totals['requests']
+            first_byte_requests = totals['first_byte_requests']
+            stages.append({
+                'name': name,
+                'requests': requests,
+                'avg_ms': (totals['time'] * 1000 / requests
+                           if requests else 0.0),
+                'max_ms': totals['max_time'] * 1000,
+                'first_byte_avg_ms': (
+                    totals['first_byte_time'] * 1000 / first_byte_requests
+                    if first_byte_requests else 0.0)})
+        return {'pid': os.getpid(), 'stages': stages}
+
+    def is_stats_request(self, env):
+        """
+        Returns True if env is a request for the debug endpoint that this
+        worker should answer.
+        """
+        return (self.path and env.get('PATH_INFO') == self.path and
+                env.get('REQUEST_METHOD') == 'GET' and
+                env.get('REMOTE_ADDR') in self.allowed_ips)
+
+
+_stage_frames = corolocal.local()
+
+
+def _timed_call(elapsed, func, *args):
+    """
+    Calls func(*args), adding the time spent in it, less the time spent in
+    any nested _timed_call on the same greenthread, to elapsed[0].
+    """
+    frames = getattr(_stage_frames, 'frames', None)
+    if frames is None:
+        frames = _stage_frames.frames = []
+    downstream = [0.0]
+    frames.append(downstream)
+    begin = time.time()
+    try:
+        return func(*args)
+    finally:
+        spent = time.time() - begin
+        frames.pop()
+        if frames:
+            frames[-1][0] += spent
+        elapsed[0] += spent - downstream[0]
+
+
+class _TimedIterable(object):
+    """
+    Response iterable of a :class:`PipelineStageTimer`; keeps charging the
+    stage for the time its response body takes to produce, and records the
+    timings once the body is exhausted or closed, whichever comes first.
+    Other attributes, such as ``app_iter_range``, are those of the wrapped
+    iterable.
+    """
+
+    def __init__(self, timer, iterable, begin, elapsed):
+        self.timer = timer
+        self.iterable = iterable
+        self.iterator = None
+        self.begin = begin
+        self.elapsed = elapsed
+        self.first_byte = None
+        self.recorded = False
+        self.closed = False
+
+    def __getattr__(self, name):
+        return getattr(self.iterable, name)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.iterator is None:
+            self.iterator = _timed_call(self.elapsed, iter, self.iterable)
+        try:
+            chunk = _timed_call(self.elapsed, self.iterator.next)
+        except StopIteration:
+            # a filter above may never pass close() on
+            self._record()
+            raise
+        if chunk and self.first_byte is None:
+            self.first_byte = time.time() - self.begin
+        return chunk
+
+    def _record(self):
+        if not self.recorded:
+            self.recorded = True
+            self.timer.stats.record(self.timer.name, self.elapsed[0],
+                                    self.first_byte)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.iterable, 'close'):
+                _timed_call(self.elapsed, self.iterable.close)
+        finally:
+            self._record()
+
+
+class PipelineStageTimer(object):
+    """
+    Wraps one stage (filter or app) of a paste.deploy pipeline and records
+    the time spent in it to a :class:`PipelineTimingStats`.
+
+    :param app: the WSGI callable for the stage
+    :param name: the stage name, as returned by
+                 :meth:`PipelineTimingStats.add_stage`
+    :param stats: PipelineTimingStats shared by the whole pipeline
+    """
+
+    def __init__(self, app, name, stats):
+        self.app = app
+        self.name = name
+        self.stats = stats
+
+    def __call__(self, env, start_response):
+        begin = time.time()
+        elapsed = [0.0]
+        try:
+            iterable = _timed_call(elapsed, self.app, env, start_response)
+        except Exception:
+            self.stats.record(self.name, elapsed[0], None)
+            raise
+        return _TimedIterable(self, iterable, begin, elapsed)
+
+
+class PipelineTimingEndpoint(object):
+    """
+    Outermost wrapper of a timed pipeline; answers GETs to the configured
+    pipeline_timing_path with this worker's aggregated stage timings as JSON.
+    """
+
+    def __init__(self, app, stats):
+        self.app = app
+        self.stats = stats
+
+    def __call__(self, env, start_response):
+        if self.stats.is_stats_request(env):
+            body = json.dumps(self.stats.to_dict())
+            start_response('200 OK', [('Content-Type', 'application/json'),
+                                      ('Content-Length', str(len(body)))])
+            return [body]
+        return self.app(env, start_response)
+
+
+def loadapp_with_pipeline_timing(conf_file, global_conf, conf, logger=None):
+    """
+    Loads the WSGI app like :func:`loadapp`, but with every stage of the
+    pipeline wrapped in a :class:`PipelineStageTimer`.  A configuration that
+    is not a pipeline is loaded as-is.
+
+    :param conf_file: Path to paste.deploy style configuration file/directory
+    :param global_conf: global_conf passed through to the app and filters
+    :param conf: configuration dict for the server
+    :param logger: optional logger for the timing stats
+    :returns: the loaded application entry point
+    """
+    context = loadcontext(loadwsgi.APP, conf_file, global_conf=global_conf)
+    if context.object_type is not loadwsgi.PIPELINE:
+        return context.create()
+    stats = PipelineTimingStats(conf, logger)
+    # register stages outermost first so stats list them in pipeline order
+    filter_names = [stats.add_stage(ctx.name)
+                    for ctx in context.filter_contexts]
+    app_name = stats.add_stage(context.app_context.name)
+    app = PipelineStageTimer(context.app_context.create(), app_name, stats)
+    for ctx, name in reversed(zip(context.filter_contexts, filter_names)):
+        app = PipelineStageTimer(ctx.create()(app), name, stats)
+    return PipelineTimingEndpoint(app, stats)
+
+
+def load_server_app(conf, global_conf):
+    """
+    Loads the WSGI application a worker will serve, with pipeline timing
+    if it is enabled in conf.
+
+    :param conf: server configuration dict, as returned by appconfig
+    :param global_conf: global_conf passed to the paste.deploy factories
+    :returns: the WSGI application
+    """
+    if config_true_value(conf.get('pipeline_timing', 'no')):
+        return loadapp_with_pipeline_timing(conf['__file__'], global_conf,
+                                            conf)
+    return loadapp(conf['__file__'], global_conf=global_conf)
+
+
+def _report_worker_stats(logger, worker_index, interval):
+    while True:
+        sleep(interval)
+        SwiftHttpProtocol.stats.report(logger, worker_index)
+
+
+def run_server(conf, logger, sock, global_conf=None, app=None,
+               worker_index=None):
     # Ensure TZ environment variable exists to avoid stat('/etc/localtime') on
     # some platforms. This locks in reported times to the timezone in which
     # the server first starts running in locations that periodically change
@@ -210,6 +631,10 @@ def run_server(conf, logger, sock, global_conf=None):
     wsgi.HttpProtocol.log_message = \
         lambda s, f, *a: logger.error('ERROR WSGI: ' + f % a)
     wsgi.WRITE_TIMEOUT = int(conf.get('client_timeout') or 60)
+    keepalive_timeout = float(conf.get('keepalive_timeout', 60))
+    SwiftHttpProtocol.keepalive_timeout = keepalive_timeout or None
+    SwiftHttpProtocol.max_requests_per_connection = int(
+        conf.get('max_requests_per_connection', 0))
 
     eventlet.hubs.use_hub(get_hub())
     eventlet.patcher.monkey_patch(all=False, socket=True)
@@ -222,15 +647,25 @@ def run_server(conf, logger, sock, global_conf=None):
         else:
             log_name = logger.name
         global_conf = {'log_name': log_name}
-    app = loadapp(conf['__file__'], global_conf=global_conf)
+    if app is None:
+        app = load_server_app(conf, global_conf)
     max_clients = int(conf.get('max_clients', '1024'))
     pool = RestrictedGreenPool(size=max_clients)
+    stats_interval = float(conf.get('worker_stats_interval', 10))
+    reporter = None
+    if worker_index is not None and stats_interval > 0:
+        reporter = eventlet.spawn(_report_worker_stats, logger, worker_index,
+                                  stats_interval)
     try:
-        wsgi.server(sock, app, NullLogger(), custom_pool=pool)
+        wsgi.server(sock, app, NullLogger(), custom_pool=pool,
+                    protocol=SwiftHttpProtocol,
+                    keepalive=keepalive_timeout > 0)
     except socket.error as err:
         if err[0] != errno.EINVAL:
             raise
     pool.waitall()
+    if reporter:
+        reporter.kill()
 
 
 #TODO(clayg): pull more pieces of this to test more
@@ -250,7 +685,38 @@ def run_wsgi(conf_path, app_section, *args, **kwargs):
         return
 
     # bind to address and port
-    sock = get_socket(conf, default_port=kwargs.get('default_port', 8080))
+    default_port = kwargs.get('default_port', 8080)
+    servers_per_port = int(conf.get('servers_per_port', 0))
+    if servers_per_port > 0:
+        # e.g. the object ring for the object-server section
+        ports = get_ring_ports(conf, app_section.split('-', 1)[0])
+        if not ports:
+            logger.error(_('No local devices found in the ring for '
+                           'servers_per_port'))
+            return
+        # one address per device port, each with its own workers
+        listeners = [(dict(conf, bind_port=port), servers_per_port)
+                     for port in ports]
+    else:
+        listeners = [(conf, config_auto_int_value(conf.get('workers'),
+                                                  CPU_COUNT))]
+    reuse_port = config_true_value(conf.get('reuse_port', 'no'))
+    if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+        logger.warning(_('reuse_port is not supported on this platform'))
+        reuse_port = False
+    # the socket each worker accepts on, by worker index
+    worker_socks = []
+    for listen_conf, worker_count in listeners:
+        if reuse_port and worker_count > 0:
+            # every worker gets its own listen socket, and the kernel
+            # balances new connections between them
+            worker_socks.extend(
+                get_socket(listen_conf, default_port, reuse_port=True)
+                for _junk in xrange(worker_count))
+        else:
+            sock = get_socket(listen_conf, default_port)
+            worker_socks.extend([sock] * max(worker_count, 1))
+    no_fork = servers_per_port <= 0 and listeners[0][1] == 0
     # remaining tasks should not require elevated privileges
     drop_privileges(conf.get('user', 'swift'))
 
@@ -258,7 +724,15 @@ def run_wsgi(conf_path, app_section, *args, **kwargs):
     global_conf = {'log_name': log_name}
     if 'global_conf_callback' in kwargs:
         kwargs['global_conf_callback'](conf, global_conf)
-    loadapp(conf_path, global_conf=global_conf)
+    if config_true_value(conf.get('preload_app', 'no')):
+        # Build the pipeline (and load its rings) once, so the workers share
+        # it copy-on-write instead of each loading their own. Connections
+        # are only opened on first use, and run_server sets up a new hub, so
+        # nothing bound to a process is handed down.
+        app = load_server_app(conf, global_conf)
+    else:
+        app = None
+        loadapp(conf_path, global_conf=global_conf)
 
     # set utils.FALLOCATE_RESERVE if desired
     reserve = int(conf.get('fallocate_reserve', 0))
@@ -267,11 +741,10 @@ def run_wsgi(conf_path, app_section, *args, **kwargs):
     # redirect errors to logger and close stdio
     capture_stdio(logger)
 
-    worker_count = config_auto_int_value(conf.get('workers'), CPU_COUNT)
-
     # Useful for profiling [no forks].
-    if worker_count == 0:
-        run_server(conf, logger, sock, global_conf=global_conf)
+    if no_fork:
+        run_server(conf, logger, worker_socks[0], global_conf=global_conf,
+                   app=app)
         return
 
     def kill_children(*args):
@@ -290,32 +763,38 @@ def run_wsgi(conf_path, app_section, *args, **kwargs):
     running = [True]
     signal.signal(signal.SIGTERM, kill_children)
     signal.signal(signal.SIGHUP, hup)
-    children = []
+    # pid of each child -> its worker index
+    children = {}
     while running[0]:
-        while len(children) < worker_count:
+        running_workers = set(children.values())
+        for worker_index, sock in enumerate(worker_socks):
+            if worker_index in running_workers:
+                continue
             pid = os.fork()
             if pid == 0:
                 signal.signal(signal.SIGHUP, signal.SIG_DFL)
                 signal.signal(signal.SIGTERM, signal.SIG_DFL)
-                run_server(conf, logger, sock)
+                run_server(conf, logger, sock, global_conf=global_conf,
+                           app=app, worker_index=worker_index)
                 logger.notice('Child %d exiting normally' % os.getpid())
                 return
             else:
                 logger.notice('Started child %s' % pid)
-                children.append(pid)
+                children[pid] = worker_index
         try:
             pid, status = os.wait()
             if os.WIFEXITED(status) or os.WIFSIGNALED(status):
                 logger.error('Removing dead child %s' % pid)
-                children.remove(pid)
+                children.pop(pid, None)
         except OSError as err:
             if err.errno not in (errno.EINTR, errno.ECHILD):
                 raise
         except KeyboardInterrupt:
             logger.notice('User quit')
             break
-    greenio.shutdown_safe(sock)
-    sock.close()
+    for sock in set(worker_socks):
+        greenio.shutdown_safe(sock)
+        sock.close()
     logger.notice('Exited')
 
 
@@ -26,6 +26,7 @@ from swift.container.backend import ContainerBroker
 from swift.common.utils import get_logger, audit_location_generator, \
     config_true_value, dump_recon_cache, ratelimit_sleep
 from swift.common.daemon import Daemon
+from swift.common.db_auditor import DatabaseCompactor
 
 
 class ContainerAuditor(Daemon):
@@ -40,10 +41,14 @@ class ContainerAuditor(Daemon):
         self.container_passes = 0
         self.container_failures = 0
         self.containers_running_time = 0
+        self.compactor = DatabaseCompactor(conf, self.logger, 'container')
         self.max_containers_per_second = \
             float(conf.get('containers_per_second', 200))
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        swift.common.db.DB_WAL = config_true_value(conf.get('db_wal', 'f'))
+        swift.common.db.DB_BATCHED_STATS = \
+            config_true_value(conf.get('db_batched_stats', 'f'))
         self.recon_cache_path = conf.get('recon_cache_path',
                                          '/var/cache/swift')
         self.rcache = os.path.join(self.recon_cache_path, "container.recon")
@@ -62,11 +67,11 @@ class ContainerAuditor(Daemon):
                     {'time': time.ctime(reported),
                      'pass': self.container_passes,
                      'fail': self.container_failures})
-                dump_recon_cache(
-                    {'container_audits_since': reported,
-                     'container_audits_passed': self.container_passes,
-                     'container_audits_failed': self.container_failures},
-                    self.rcache, self.logger)
+                recon = {'container_audits_since': reported,
+                         'container_audits_passed': self.container_passes,
+                         'container_audits_failed': self.container_failures}
+                recon.update(self.compactor.report(reported))
+                dump_recon_cache(recon, self.rcache, self.logger)
                 reported = time.time()
                 self.container_passes = 0
                 self.container_failures = 0
@@ -116,9 +121,11 @@ class ContainerAuditor(Daemon):
             broker = ContainerBroker(path)
             if not broker.is_deleted():
                 broker.get_info()
+                broker.checkpoint()
                 self.logger.increment('passes')
                 self.container_passes += 1
                 self.logger.debug(_('Audit passed for %s'), broker)
+                self.compactor.compact(broker)
         except (Exception, Timeout):
             self.logger.increment('failures')
             self.container_failures += 1
@@ -17,6 +17,7 @@ Pluggable Back-ends for Container Server
 """
 
 import os
+from hashlib import md5
 from uuid import uuid4
 import time
 import cPickle as pickle
@@ -24,9 +25,29 @@ import errno
 
 import sqlite3
 
+import swift.common.db
 from swift.common.utils import normalize_timestamp, lock_parent_directory
 from swift.common.db import DatabaseBroker, DatabaseConnectionError, \
-    PENDING_CAP, PICKLE_PROTOCOL, utf8encode
+    PENDING_CAP, PICKLE_PROTOCOL, utf8encode, mark_dirty
+
+#: Triggers of version 1 DBs accounting for each object row in container_stat
+OBJECT_STAT_TRIGGERS = ('''
+    CREATE TRIGGER object_insert AFTER INSERT ON object
+    BEGIN
+        UPDATE container_stat
+        SET object_count = object_count + (1 - new.deleted),
+            bytes_used = bytes_used + new.size,
+            hash = chexor(hash, new.name, new.created_at);
+    END
+''', '''
+    CREATE TRIGGER object_delete AFTER DELETE ON object
+    BEGIN
+        UPDATE container_stat
+        SET object_count = object_count - (1 - old.deleted),
+            bytes_used = bytes_used - old.size,
+            hash = chexor(hash, old.name, old.created_at);
+    END
+''')
 
 
 class ContainerBroker(DatabaseBroker):
@@ -34,6 +55,7 @@ class ContainerBroker(DatabaseBroker):
     db_type = 'container'
     db_contains_type = 'object'
     db_reclaim_timestamp = 'created_at'
+    db_hash_value = 'created_at'
 
     def _initialize(self, conn, put_timestamp):
         """
@@ -53,6 +75,10 @@ class ContainerBroker(DatabaseBroker):
         Create the object table which is specifc to the container DB.
         Not a part of Pluggable Back-ends, internal to the baseline code.
 
+        With DB_BATCHED_STATS on there are no triggers updating
+        container_stat for each row; the changes are accounted for by
+        :func:`_update_stats` (version 2).
+
         :param conn: DB connection object
         """
         conn.executescript("""
@@ -68,27 +94,14 @@ class ContainerBroker(DatabaseBroker):
 
             CREATE INDEX ix_object_deleted_name ON object (deleted, name);
 
-            CREATE TRIGGER object_insert AFTER INSERT ON object
-            BEGIN
-                UPDATE container_stat
-                SET object_count = object_count + (1 - new.deleted),
-                    bytes_used = bytes_used + new.size,
-                    hash = chexor(hash, new.name, new.created_at);
-            END;
-
             CREATE TRIGGER object_update BEFORE UPDATE ON object
             BEGIN
                 SELECT RAISE(FAIL, 'UPDATE not allowed; DELETE and INSERT');
             END;
-
-            CREATE TRIGGER object_delete AFTER DELETE ON object
-            BEGIN
-                UPDATE container_stat
-                SET object_count = object_count - (1 - old.deleted),
-                    bytes_used = bytes_used - old.size,
-                    hash = chexor(hash, old.name, old.created_at);
-            END;
         """)
+        if not swift.common.db.DB_BATCHED_STATS:
+            for statement in OBJECT_STAT_TRIGGERS:
+                conn.execute(statement)
 
     def create_container_stat_table(self, conn, put_timestamp=None):
         """
@@ -119,7 +132,8 @@ class ContainerBroker(DatabaseBroker):
                 status_changed_at TEXT DEFAULT '0',
                 metadata TEXT DEFAULT '',
                 x_container_sync_point1 INTEGER DEFAULT -1,
-                x_container_sync_point2 INTEGER DEFAULT -1
+                x_container_sync_point2 INTEGER DEFAULT -1,
+                reclaim_point TEXT DEFAULT ''
             );
 
             INSERT INTO container_stat (object_count, bytes_used)
@@ -133,14 +147,80 @@ class ContainerBroker(DatabaseBroker):
               str(uuid4()), put_timestamp))
 
     def get_db_version(self, conn):
+        """
+        Returns the schema version of the DB: 0 for DBs without the
+        ix_object_deleted_name index, 1 for DBs whose triggers account for
+        every object row in container_stat, and 2 for DBs whose object rows
+        are accounted for by the broker, once per transaction.
+        """
         if self._db_version == -1:
-            self._db_version = 0
-            for row in conn.execute('''
-                    SELECT name FROM sqlite_master
-                    WHERE name = 'ix_object_deleted_name' '''):
+            names = [row[0] for row in conn.execute('''
+                SELECT name FROM sqlite_master
+                WHERE name IN ('ix_object_deleted_name', 'object_insert')
+            ''')]
+            if 'ix_object_deleted_name' not in names:
+                self._db_version = 0
+            elif 'object_insert' in names:
                 self._db_version = 1
+            else:
+                self._db_version = 2
         return self._db_version
 
+    def _batched_stats(self, conn):
+        """
+        Returns True if changes to the object table are to be accounted for
+        in container_stat with :func:`_update_stats`, False if the triggers
+        of the DB do it. With DB_BATCHED_STATS on, version 1 DBs are migrated
+        to version 2 on the way; with it off, version 2 DBs, made by a node
+        with it on, get their triggers back. So this is to be called with the
+        write lock held.
+
+        :param conn: DB connection object
+        """
+        # another process may have migrated the DB since it was looked at
+        self._db_version = -1
+        version = self.get_db_version(conn)
+        if swift.common.db.DB_BATCHED_STATS:
+            if version == 1:
+                conn.execute('DROP TRIGGER object_insert')
+                conn.execute('DROP TRIGGER object_delete')
+                self._db_version = 2
+        elif version == 2:
+            for statement in OBJECT_STAT_TRIGGERS:
+                conn.execute(statement)
+            self._db_version = 1
+        return self._db_version >= 2
+
+    def _update_stats(self, conn, removed, added):
+        """
+        Accounts for rows deleted from and inserted into the object table in
+        container_stat's object_count, bytes_used and hash.
+
+        :param conn: DB connection object
+        :param removed: list of (name, created_at, size, deleted) of the
+                        deleted rows, as read from the DB
+        :param added: list of (name, created_at, size, deleted) of the
+                      inserted rows, as read from the DB
+        """
+        if not removed and not added:
+            return
+        object_count = bytes_used = hash_delta = 0
+        for sign, rows in ((-1, removed), (1, added)):
+            for name, created_at, size, deleted in rows:
+                object_count += sign * (1 - deleted)
+                bytes_used += sign * size
+                # what chexor() does for each row, without going back and
+                # forth between hex and int
+                hash_delta ^= int(md5(
+                    '%s-%s' % (name, created_at)).hexdigest(), 16)
+        hash_ = conn.execute('SELECT hash FROM container_stat').fetchone()[0]
+        hash_ = '%032x' % (int(hash_, 16) ^ hash_delta)
+        conn.execute('''
+            UPDATE container_stat
+            SET object_count = object_count + ?,
+                bytes_used = bytes_used + ?, hash = ?
+        ''', (object_count, bytes_used, hash_))
+
     def _newid(self, conn):
         conn.execute('''
             UPDATE container_stat
@@ -161,6 +241,15 @@ class ContainerBroker(DatabaseBroker):
                 status_changed_at = ?
             WHERE delete_timestamp < ? """, (timestamp, timestamp, timestamp))
 
+    def _reclaim_items(self, conn, rows):
+        """See :func:`swift.common.db.DatabaseBroker._reclaim_items`"""
+        batched_stats = self._batched_stats(conn)
+        DatabaseBroker._reclaim_items(self, conn, rows)
+        if batched_stats:
+            self._update_stats(conn, [
+                (row['name'], row['created_at'], row['size'], row['deleted'])
+                for row in rows], [])
+
     def _commit_puts_load(self, item_list, entry):
         """See :func:`swift.common.db.DatabaseBroker._commit_puts_load`"""
         (name, timestamp, size, content_type, etag, deleted) = \
@@ -232,6 +321,7 @@ class ContainerBroker(DatabaseBroker):
                         (name, timestamp, size, content_type, etag, deleted),
                         protocol=PICKLE_PROTOCOL).encode('base64'))
                     fp.flush()
+            mark_dirty(self.db_file, self.logger)
 
     def is_deleted(self, timestamp=None):
         """
@@ -464,37 +554,77 @@ class ContainerBroker(DatabaseBroker):
                           'size', 'content_type', 'etag', 'deleted'}
         :param source: if defined, update incoming_sync with the source
         """
+        # Only the newest item for a name (the first of them on a tie) can
+        # replace the row in the table, so the batch is narrowed down to
+        # those before being merged in with a few set-based statements.
+        newest = {}
+        max_rowid = -1
+        for seq, rec in enumerate(item_list):
+            key = utf8encode(rec['name'])[0]
+            if key not in newest or rec['created_at'] > newest[key][2]:
+                newest[key] = (seq, rec['name'], rec['created_at'],
+                               rec['size'], rec['content_type'], rec['etag'],
+                               rec['deleted'])
+            if source:
+                max_rowid = max(max_rowid, rec['ROWID'])
         with self.get() as conn:
-            max_rowid = -1
-            for rec in item_list:
-                query = '''
-                    DELETE FROM object
-                    WHERE name = ? AND (created_at < ?)
-                '''
+            with self._immediate_transaction(conn):
+                batched_stats = self._batched_stats(conn)
                 if self.get_db_version(conn) >= 1:
-                    query += ' AND deleted IN (0, 1)'
-                conn.execute(query, (rec['name'], rec['created_at']))
-                query = 'SELECT 1 FROM object WHERE name = ?'
-                if self.get_db_version(conn) >= 1:
-                    query += ' AND deleted IN (0, 1)'
-                if not conn.execute(query, (rec['name'],)).fetchall():
-                    conn.execute('''
-                        INSERT INTO object (name, created_at, size,
-                            content_type, etag, deleted)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    ''', ([rec['name'], rec['created_at'], rec['size'],
-                          rec['content_type'], rec['etag'], rec['deleted']]))
+                    deleted_clause = ' AND object.deleted IN (0, 1)'
+                else:
+                    deleted_clause = ''
+                self._stage_merge_items(
+                    conn, ['name TEXT', 'created_at TEXT', 'size INTEGER',
+                           'content_type TEXT', 'etag TEXT',
+                           'deleted INTEGER'],
+                    newest.values())
+                # CROSS JOIN keeps merge_batch as the outer loop, so that
+                # each name is looked up in the index rather than the whole
+                # table being scanned
+                curs = conn.execute('''
+                    SELECT object.ROWID, object.name, object.created_at,
+                           object.size, object.deleted
+                    FROM merge_batch CROSS JOIN object
+                    ON object.name = merge_batch.name%s
+                    WHERE object.created_at < merge_batch.created_at
+                ''' % deleted_clause)
+                curs.row_factory = None
+                removed = curs.fetchall()
+                conn.executemany('DELETE FROM object WHERE ROWID = ?',
+                                 [row[:1] for row in removed])
+                curs = conn.execute('''
+                    SELECT name, created_at, size, content_type, etag, deleted
+                    FROM merge_batch
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM object
+                        WHERE object.name = merge_batch.name%s)
+                    ORDER BY seq
+                ''' % deleted_clause)
+                curs.row_factory = None
+                added = curs.fetchall()
+                conn.executemany('''
+                    INSERT INTO object (name, created_at, size, content_type,
+                        etag, deleted)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', added)
+                if batched_stats:
+                    self._update_stats(
+                        conn, [row[1:] for row in removed],
+                        [row[:3] + row[5:] for row in added])
                 if source:
-                    max_rowid = max(max_rowid, rec['ROWID'])
-            if source:
-                try:
-                    conn.execute('''
-                        INSERT INTO incoming_sync (sync_point, remote_id)
-                        VALUES (?, ?)
-                    ''', (max_rowid, source))
-                except sqlite3.IntegrityError:
-                    conn.execute('''
-                        UPDATE incoming_sync SET sync_point=max(?, sync_point)
-                        WHERE remote_id=?
-                    ''', (max_rowid, source))
-            conn.commit()
+                    try:
+                        conn.execute('''
+                            INSERT INTO incoming_sync (sync_point, remote_id)
+                            VALUES (?, ?)
+                        ''', (max_rowid, source))
+                    except sqlite3.IntegrityError:
+                        conn.execute('''
+                            UPDATE incoming_sync
+                            SET sync_point=max(?, sync_point)
+                            WHERE remote_id=?
+                        ''', (max_rowid, source))
+            conn.execute('DROP TABLE temp.merge_batch')
+        # a row is only removed for a newer one to be added
+        if added:
+            mark_dirty(self.db_file, self.logger)
@@ -16,6 +16,7 @@
 import os
 import time
 import traceback
+from collections import defaultdict
 from datetime import datetime
 from swift import gettext_ as _
 from xml.etree.cElementTree import Element, SubElement, tostring
@@ -26,7 +27,7 @@ import swift.common.db
 from swift.container.backend import ContainerBroker
 from swift.common.db import DatabaseAlreadyExists
 from swift.common.request_helpers import get_param, get_listing_content_type, \
-    split_and_validate_path
+    split_and_validate_path, format_load_hint
 from swift.common.utils import get_logger, hash_path, public, \
     normalize_timestamp, storage_directory, validate_sync_to, \
     config_true_value, json, timing_stats, replication, \
@@ -35,8 +36,10 @@ from swift.common.constraints import CONTAINER_LISTING_LIMIT, \
     check_mount, check_float, check_utf8
 from swift.common.bufferedhttp import http_connect
 from swift.common.exceptions import ConnectionTimeout
-from swift.common.db_replicator import ReplicatorRpc
-from swift.common.http import HTTP_NOT_FOUND, is_success
+from swift.common.db_replicator import ReplicatorRpc, load_replicate_args
+from swift.common.tracing import Tracer
+from swift.common.http import HTTP_NOT_FOUND, HTTP_NO_CONTENT, HTTP_OK, \
+    is_success
 from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPConflict, \
     HTTPCreated, HTTPInternalServerError, HTTPNoContent, HTTPNotFound, \
     HTTPPreconditionFailed, HTTPMethodNotAllowed, Request, Response, \
@@ -44,6 +47,87 @@ from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPConflict, \
 
 DATADIR = 'containers'
 
+#: Listings of DBs changed less than this many seconds before are not cached,
+#: as another change within the file system's timestamp granularity could
+#: leave the stats of the DB files as they were
+LISTING_CACHE_SETTLE_TIME = 1.0
+
+
+class ListingCache(object):
+    """
+    Least recently used cache of container listings, bounded by the total
+    size of their bodies. Each listing is cached with the stats of the files
+    of its DB, and is only returned while they stay the same; any update to
+    the DB, by this or another process, changes them.
+
+    :param max_size: maximum total size in bytes of the cached bodies
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = {}
+        # circular doubly linked list of the entries, as
+        # [prev, next, key, stats, size, listing] lists, most recently used
+        # first
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0, None]
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+    def _link_first(self, entry):
+        entry[0] = self.root
+        entry[1] = self.root[1]
+        self.root[1][0] = entry
+        self.root[1] = entry
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self._unlink(entry)
+        self.size -= entry[4]
+
+    def get(self, key, stats):
+        """
+        Gets a cached listing.
+
+        :param key: key of the listing
+        :param stats: current stats of the DB files, as returned by
+                      DatabaseBroker.get_file_stats()
+        :returns: the listing, or None if it isn't cached or the DB changed
+        """
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        if entry[3] != stats:
+            self._remove(key)
+            return None
+        self._unlink(entry)
+        self._link_first(entry)
+        return entry[5]
+
+    def set(self, key, stats, listing, size):
+        """
+        Caches a listing, making room for it by evicting the least recently
+        used ones.
+
+        :param key: key of the listing
+        :param stats: stats of the DB files from before the listing was read
+        :param listing: listing to cache
+        :param size: size of the listing in bytes
+        """
+        if key in self.entries:
+            self._remove(key)
+        if size > self.max_size:
+            return
+        entry = [None, None, key, stats, size, listing]
+        self._link_first(entry)
+        self.entries[key] = entry
+        self.size += size
+        while self.size > self.max_size:
+            self._remove(self.root[0][2])
+
 
 class ContainerController(object):
     """WSGI Controller for the container server."""
@@ -54,6 +138,9 @@ class ContainerController(object):
 
     def __init__(self, conf, logger=None):
         self.logger = logger or get_logger(conf, log_route='container-server')
+        self.tracer = Tracer(conf, 'container-server', self.logger)
+        self.load_hints = config_true_value(conf.get('load_hints', 'true'))
+        self.active_requests = defaultdict(int)
         self.root = conf.get('devices', '/srv/node/')
         self.mount_check = config_true_value(conf.get('mount_check', 'true'))
         self.node_timeout = int(conf.get('node_timeout', 3))
@@ -71,10 +158,19 @@ class ContainerController(object):
             logger=self.logger)
         self.auto_create_account_prefix = \
             conf.get('auto_create_account_prefix') or '.'
+        listing_cache_size = int(conf.get('listing_cache_size', 0))
+        self.listing_cache = None
+        if listing_cache_size > 0:
+            self.listing_cache = ListingCache(listing_cache_size)
         if config_true_value(conf.get('allow_versions', 'f')):
             self.save_headers.append('x-versions-location')
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        swift.common.db.DB_WAL = config_true_value(conf.get('db_wal', 'f'))
+        swift.common.db.DB_BATCHED_STATS = \
+            config_true_value(conf.get('db_batched_stats', 'f'))
+        swift.common.db.DB_DIRTY_TRACKING = \
+            config_true_value(conf.get('db_dirty_tracking', 'f'))
 
     def _get_container_broker(self, drive, part, account, container, **kwargs):
         """
@@ -363,8 +459,36 @@ class ContainerController(object):
         broker = self._get_container_broker(drive, part, account, container,
                                             pending_timeout=0.1,
                                             stale_reads_ok=True)
+        if not self.listing_cache:
+            return self._listing_response(
+                req, out_content_type, *self._get_listing(
+                    broker, container, limit, marker, end_marker, prefix,
+                    delimiter, path, out_content_type))
+        cache_key = (broker.db_file, limit, marker, end_marker, prefix,
+                     delimiter, path, out_content_type)
+        stats = broker.get_file_stats()
+        listing = self.listing_cache.get(cache_key, stats)
+        if listing:
+            self.logger.increment('listing_cache.hits')
+            return self._listing_response(req, out_content_type, *listing)
+        listing = self._get_listing(broker, container, limit, marker,
+                                    end_marker, prefix, delimiter, path,
+                                    out_content_type)
+        settled = time.time() - LISTING_CACHE_SETTLE_TIME
+        if stats[0] and all(stat is None or stat[2] < settled
+                            for stat in stats):
+            self.listing_cache.set(cache_key, stats, listing, len(listing[2]))
+        return self._listing_response(req, out_content_type, *listing)
+
+    def _get_listing(self, broker, container, limit, marker, end_marker,
+                     prefix, delimiter, path, out_content_type):
+        """
+        Reads a container listing from its DB.
+
+        :returns: a tuple of the status, headers and body of the response
+        """
         if broker.is_deleted():
-            return HTTPNotFound(request=req)
+            return HTTP_NOT_FOUND, {}, ''
         info = broker.get_info()
         resp_headers = {
             'X-Container-Object-Count': info['object_count'],
@@ -376,13 +500,11 @@ class ContainerController(object):
             if value and (key.lower() in self.save_headers or
                           key.lower().startswith('x-container-meta-')):
                 resp_headers[key] = value
-        ret = Response(request=req, headers=resp_headers,
-                       content_type=out_content_type, charset='utf-8')
         container_list = broker.list_objects_iter(limit, marker, end_marker,
                                                   prefix, delimiter, path)
         if out_content_type == 'application/json':
-            ret.body = json.dumps([self.update_data_record(record)
-                                   for record in container_list])
+            body = json.dumps([self.update_data_record(record)
+                               for record in container_list])
         elif out_content_type.endswith('/xml'):
             doc = Element('container', name=container.decode('utf-8'))
             for obj in container_list:
@@ -400,13 +522,28 @@ class ContainerController(object):
                     for field in sorted(record):
                         SubElement(obj_element, field).text = str(
                             record[field]).decode('utf-8')
-            ret.body = tostring(doc, encoding='UTF-8').replace(
+            body = tostring(doc, encoding='UTF-8').replace(
                 "<?xml version='1.0' encoding='UTF-8'?>",
                 '<?xml version="1.0" encoding="UTF-8"?>', 1)
         else:
             if not container_list:
-                return HTTPNoContent(request=req, headers=resp_headers)
-            ret.body = '\n'.join(rec[0] for rec in container_list) + '\n'
+                return HTTP_NO_CONTENT, resp_headers, ''
+            body = '\n'.join(rec[0] for rec in container_list) + '\n'
+        return HTTP_OK, resp_headers, body
+
+    def _listing_response(self, req, out_content_type, status, resp_headers,
+                          body):
+        """
+        Makes the response to a GET request from a listing read by
+        _get_listing().
+        """
+        if status == HTTP_NOT_FOUND:
+            return HTTPNotFound(request=req)
+        if status == HTTP_NO_CONTENT:
+            return HTTPNoContent(request=req, headers=resp_headers)
+        ret = Response(request=req, headers=resp_headers,
+                       content_type=out_content_type, charset='utf-8')
+        ret.body = body
         return ret
 
     @public
@@ -421,7 +558,7 @@ class ContainerController(object):
         if self.mount_check and not check_mount(self.root, drive):
             return HTTPInsufficientStorage(drive=drive, request=req)
         try:
-            args = json.load(req.environ['wsgi.input'])
+            args = load_replicate_args(req)
         except ValueError as err:
             return HTTPBadRequest(body=str(err), content_type='text/plain')
         ret = self.replicator_rpc.dispatch(post_args, args)
@@ -466,6 +603,8 @@ class ContainerController(object):
         start_time = time.time()
         req = Request(env)
         self.logger.txn_id = req.headers.get('x-trans-id', None)
+        device = req.path_info.lstrip('/').split('/', 1)[0]
+        self.active_requests[device] += 1
         if not check_utf8(req.path_info):
             res = HTTPPreconditionFailed(body='Invalid UTF8 or contains NULL')
         else:
@@ -489,7 +628,17 @@ class ContainerController(object):
                     'ERROR __call__ error with %(method)s %(path)s '),
                     {'method': req.method, 'path': req.path})
                 res = HTTPInternalServerError(body=traceback.format_exc())
-        trans_time = '%.4f' % (time.time() - start_time)
+        self.active_requests[device] -= 1
+        if not self.active_requests[device]:
+            del self.active_requests[device]
+        if self.load_hints:
+            res.headers['X-Backend-Load'] = format_load_hint(
+                self.active_requests.get(device, 0))
+        end_time = time.time()
+        self.tracer.record(req.headers.get('x-trans-id'), req.method,
+                           start_time, end_time, path=req.path,
+                           status=res.status_int)
+        trans_time = '%.4f' % (end_time - start_time)
         log_message = '%s - - [%s] "%s %s" %s %s "%s" "%s" "%s" %s' % (
             req.remote_addr,
             time.strftime('%d/%b/%Y:%H:%M:%S +0000',
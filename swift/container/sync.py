@@ -146,6 +146,9 @@ class ContainerSync(Daemon):
         self._myport = int(conf.get('bind_port', 6001))
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        swift.common.db.DB_WAL = config_true_value(conf.get('db_wal', 'f'))
+        swift.common.db.DB_BATCHED_STATS = \
+            config_true_value(conf.get('db_batched_stats', 'f'))
 
     def run_forever(self, *args, **kwargs):
         """
@@ -60,6 +60,9 @@ class ContainerUpdater(Daemon):
         self.new_account_suppressions = None
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        swift.common.db.DB_WAL = config_true_value(conf.get('db_wal', 'f'))
+        swift.common.db.DB_BATCHED_STATS = \
+            config_true_value(conf.get('db_batched_stats', 'f'))
         self.recon_cache_path = conf.get('recon_cache_path',
                                          '/var/cache/swift')
         self.rcache = os.path.join(self.recon_cache_path, "container.recon")
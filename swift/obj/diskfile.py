@@ -616,6 +616,9 @@ class DiskFileWriter(object):
         self._upload_size = 0
         self._last_sync = 0
         self._extension = '.data'
+        # (phase, start, end) of the steps of put(), for the object server's
+        # per-phase timing
+        self.put_timings = []
 
     def write(self, chunk):
         """
@@ -647,9 +650,11 @@ class DiskFileWriter(object):
         return self._upload_size
 
     def _finalize_put(self, metadata, target_path):
+        start = time.time()
         # Write the metadata before calling fsync() so that both data and
         # metadata are flushed to disk.
         write_metadata(self._fd, metadata)
+        xattr_done = time.time()
         # We call fsync() before calling drop_cache() to lower the amount of
         # redundant work the drop cache code will perform on the pages (now
         # that after fsync the pages will be all clean).
@@ -658,11 +663,15 @@ class DiskFileWriter(object):
         # drop_cache() after fsync() to avoid redundant work (pages all
         # clean).
         drop_buffer_cache(self._fd, 0, self._upload_size)
+        fsync_done = time.time()
         invalidate_hash(dirname(self._datadir))
         # After the rename completes, this object will be available for other
         # requests to reference.
         renamer(self._tmppath, target_path)
         hash_cleanup_listdir(self._datadir)
+        self.put_timings = [('xattr', start, xattr_done),
+                            ('fsync', xattr_done, fsync_done),
+                            ('rename', fsync_done, time.time())]
 
     def put(self, metadata):
         """
@@ -1222,6 +1231,9 @@ class DiskFile(object):
             sys_metadata = dict(
                 [(key, val) for key, val in datafile_metadata.iteritems()
                  if key.lower() in DATAFILE_SYSTEM_META])
+            if 'Content-Type' in self._metadata:
+                # the content type was changed by the fast-POST
+                sys_metadata.pop('Content-Type', None)
             self._metadata.update(sys_metadata)
         else:
             self._metadata = datafile_metadata
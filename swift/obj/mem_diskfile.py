@@ -26,6 +26,7 @@ from swift.common.utils import normalize_timestamp
 from swift.common.exceptions import DiskFileQuarantined, DiskFileNotExist, \
     DiskFileCollision, DiskFileDeleted, DiskFileNotOpen
 from swift.common.swob import multi_range_iterator
+from swift.obj.diskfile import DATAFILE_SYSTEM_META
 
 
 class InMemoryFileSystem(object):
@@ -386,9 +387,13 @@ class DiskFile(object):
         """
         Write a block of metadata to an object.
         """
-        cur_fp = self._filesystem.get(self._name)
-        if cur_fp is not None:
-            self._filesystem[self._name] = (cur_fp, metadata)
+        data, cur_metadata = self._filesystem.get_object(self._name)
+        if data is not None:
+            metadata = dict(metadata)
+            for key, val in cur_metadata.iteritems():
+                if key.lower() in DATAFILE_SYSTEM_META:
+                    metadata.setdefault(key, val)
+            self._filesystem.put_object(self._name, data, metadata)
 
     def delete(self, timestamp):
         """
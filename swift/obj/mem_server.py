@@ -40,6 +40,7 @@ class ObjectController(server.ObjectController):
         :param conf: WSGI configuration parameter
         """
         self._filesystem = InMemoryFileSystem()
+        self.replication_semaphore = None
 
     def get_diskfile(self, device, partition, account, container, obj,
                      **kwargs):
@@ -53,6 +54,13 @@ class ObjectController(server.ObjectController):
         """
         return self._filesystem.get_diskfile(account, container, obj, **kwargs)
 
+    def get_disk_queue_depth(self, device):
+        """
+        Returns the number of disk operations queued for a device, which is
+        always 0 for the in-memory version.
+        """
+        return 0
+
     def async_update(self, op, account, container, obj, host, partition,
                      contdevice, headers_out, objdevice):
         """
@@ -21,6 +21,7 @@ import multiprocessing
 import time
 import traceback
 import socket
+from collections import defaultdict
 from datetime import datetime
 from swift import gettext_ as _
 from hashlib import md5
@@ -37,7 +38,9 @@ from swift.common.exceptions import ConnectionTimeout, DiskFileQuarantined, \
     DiskFileDeviceUnavailable
 from swift.obj import ssync_receiver
 from swift.common.http import is_success
-from swift.common.request_helpers import split_and_validate_path
+from swift.common.request_helpers import split_and_validate_path, \
+    format_load_hint
+from swift.common.tracing import Tracer
 from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPCreated, \
     HTTPInternalServerError, HTTPNoContent, HTTPNotFound, HTTPNotModified, \
     HTTPPreconditionFailed, HTTPRequestTimeout, HTTPUnprocessableEntity, \
@@ -58,6 +61,7 @@ class ObjectController(object):
         /etc/swift/object-server.conf-sample.
         """
         self.logger = logger or get_logger(conf, log_route='object-server')
+        self.tracer = Tracer(conf, 'object-server', self.logger)
         self.node_timeout = int(conf.get('node_timeout', 3))
         self.conn_timeout = float(conf.get('conn_timeout', 0.5))
         self.client_timeout = int(conf.get('client_timeout', 60))
@@ -66,6 +70,10 @@ class ObjectController(object):
         self.log_requests = config_true_value(conf.get('log_requests', 'true'))
         self.max_upload_time = int(conf.get('max_upload_time', 86400))
         self.slow = int(conf.get('slow', 0))
+        self.slow_request_threshold = float(
+            conf.get('slow_request_threshold', 0))
+        self.load_hints = config_true_value(conf.get('load_hints', 'true'))
+        self.active_requests = defaultdict(int)
         self.keep_cache_private = \
             config_true_value(conf.get('keep_cache_private', 'false'))
         replication_server = conf.get('replication_server', None)
@@ -128,10 +136,13 @@ class ObjectController(object):
         # This is populated by global_conf_callback way below as the semaphore
         # is shared by all workers.
         if 'replication_semaphore' in conf:
-            # The value was put in a list so it could get past paste
-            self.replication_semaphore = conf['replication_semaphore'][0]
+            # The value was put in a list so it could get past paste, along
+            # with the limit it was created with, used for the load hints
+            self.replication_semaphore, self.replication_concurrency = \
+                conf['replication_semaphore']
         else:
             self.replication_semaphore = None
+            self.replication_concurrency = 0
         self.replication_failure_threshold = int(
             conf.get('replication_failure_threshold') or 100)
         self.replication_failure_ratio = float(
@@ -150,6 +161,62 @@ class ObjectController(object):
         return self._diskfile_mgr.get_diskfile(
             device, partition, account, container, obj, **kwargs)
 
+    def get_disk_queue_depth(self, device):
+        """
+        Returns the number of disk operations queued or running for a device.
+
+        An implementation of the object server that does not use per-device
+        thread pools would over-ride this method.
+        """
+        threadpool = self._diskfile_mgr.threadpools.get(device)
+        return threadpool.pending if threadpool else 0
+
+    def _load_hint(self, device):
+        """
+        Returns the X-Backend-Load header value for device: requests being
+        handled for it by this worker, disk operations queued for it and
+        replication requests running on the server.
+        """
+        replicating = 0
+        if self.replication_semaphore is not None:
+            try:
+                replicating = self.replication_concurrency - \
+                    self.replication_semaphore.get_value()
+            except NotImplementedError:
+                # not available on some platforms (e.g. OS X)
+                pass
+        return format_load_hint(self.active_requests.get(device, 0),
+                                self.get_disk_queue_depth(device),
+                                replicating)
+
+    def _record_phase(self, request, name, start=None, end=None,
+                      elapsed=None):
+        """
+        Records how long one phase of handling a request took: as a StatsD
+        timing (<METHOD>.phase.<name>.timing), in the breakdown given by the
+        slow request log and, for phases running from start to end, as a
+        trace span.
+
+        :param request: the request being handled
+        :param name: name of the phase
+        :param start: time the phase started
+        :param end: time the phase ended, defaults to now
+        :param elapsed: duration of a phase that did not run in one piece,
+                        such as the sum of all chunk writes
+        :returns: end time of the phase
+        """
+        if end is None:
+            end = time.time()
+        if elapsed is None:
+            elapsed = end - start
+            self.tracer.record(request.headers.get('x-trans-id'), name,
+                               start, end)
+        request.environ.setdefault('swift.phase_times', []).append(
+            (name, elapsed))
+        self.logger.timing('%s.phase.%s.timing' % (request.method, name),
+                           elapsed * 1000)
+        return end
+
     def async_update(self, op, account, container, obj, host, partition,
                      contdevice, headers_out, objdevice):
         """
@@ -342,6 +409,18 @@ class ObjectController(object):
             if header_key in request.headers:
                 header_caps = header_key.title()
                 metadata[header_caps] = request.headers[header_key]
+        if 'X-Static-Large-Object' in orig_metadata and \
+                'X-Static-Large-Object' not in metadata:
+            # the manifest still describes the segments; only a PUT can
+            # turn it into a regular object
+            metadata['X-Static-Large-Object'] = \
+                orig_metadata['X-Static-Large-Object']
+        # the .meta always carries the content type, so that one set by an
+        # earlier POST outlives the following ones
+        metadata['Content-Type'] = orig_metadata['Content-Type']
+        if 'content-type' in request.headers:
+            metadata['Content-Type'] = self._post_content_type(
+                request.headers['content-type'], metadata['Content-Type'])
         orig_delete_at = int(orig_metadata.get('X-Delete-At') or 0)
         if orig_delete_at != new_delete_at:
             if new_delete_at:
@@ -354,8 +433,22 @@ class ObjectController(object):
             disk_file.write_metadata(metadata)
         except (DiskFileNotExist, DiskFileQuarantined):
             return HTTPNotFound(request=request)
-        else:
-            return HTTPAccepted(request=request)
+        # No container update is sent: a container row has a single
+        # timestamp, and this replica may not have the newest .data yet, so
+        # a row with the POST timestamp could outlive a newer PUT with the
+        # size and etag of older data.
+        return HTTPAccepted(request=request)
+
+    def _post_content_type(self, content_type, orig_content_type):
+        """
+        Returns the content type to store for a fast-POST, keeping the
+        swift_bytes parameter of a manifest's original content type.
+        """
+        if 'swift_bytes=' not in content_type:
+            for param in orig_content_type.split(';')[1:]:
+                if param.strip().startswith('swift_bytes='):
+                    content_type += ';' + param.strip()
+        return content_type
 
     @public
     @timing_stats()
@@ -380,6 +473,7 @@ class ObjectController(object):
         except ValueError as e:
             return HTTPBadRequest(body=str(e), request=request,
                                   content_type='text/plain')
+        phase_start = time.time()
         try:
             disk_file = self.get_diskfile(
                 device, partition, account, container, obj)
@@ -389,6 +483,7 @@ class ObjectController(object):
             orig_metadata = disk_file.read_metadata()
         except (DiskFileNotExist, DiskFileQuarantined):
             orig_metadata = {}
+        self._record_phase(request, 'open', phase_start)
         orig_timestamp = orig_metadata.get('X-Timestamp')
         if orig_timestamp and orig_timestamp >= request.headers['x-timestamp']:
             return HTTPConflict(request=request)
@@ -396,8 +491,12 @@ class ObjectController(object):
         upload_expiration = time.time() + self.max_upload_time
         etag = md5()
         elapsed_time = 0
+        write_time = 0
+        phase_start = time.time()
         try:
             with disk_file.create(size=fsize) as writer:
+                phase_start = self._record_phase(request, 'create',
+                                                 phase_start)
                 upload_size = 0
                 reader = request.environ['wsgi.input'].read
                 for chunk in iter(lambda: reader(self.network_chunk_size), ''):
@@ -407,12 +506,15 @@ class ObjectController(object):
                         return HTTPRequestTimeout(request=request)
                     etag.update(chunk)
                     upload_size = writer.write(chunk)
+                    write_time += time.time() - start_time
                     sleep()
                     elapsed_time += time.time() - start_time
                 if upload_size:
                     self.logger.transfer_rate(
                         'PUT.' + device + '.timing', elapsed_time,
                         upload_size)
+                self._record_phase(request, 'upload', phase_start)
+                self._record_phase(request, 'write', elapsed=write_time)
                 if fsize is not None and fsize != upload_size:
                     return HTTPClientDisconnect(request=request)
                 etag = etag.hexdigest()
@@ -434,7 +536,11 @@ class ObjectController(object):
                     if header_key in request.headers:
                         header_caps = header_key.title()
                         metadata[header_caps] = request.headers[header_key]
+                phase_start = time.time()
                 writer.put(metadata)
+                self._record_phase(request, 'put', phase_start)
+                for name, start, end in getattr(writer, 'put_timings', ()):
+                    self._record_phase(request, name, start, end)
         except DiskFileNoSpace:
             return HTTPInsufficientStorage(drive=device, request=request)
         if orig_delete_at != new_delete_at:
@@ -448,6 +554,7 @@ class ObjectController(object):
                     request, device)
         if not orig_timestamp or \
                 orig_timestamp < request.headers['x-timestamp']:
+            phase_start = time.time()
             self.container_update(
                 'PUT', account, container, obj, request,
                 HeaderKeyDict({
@@ -456,6 +563,7 @@ class ObjectController(object):
                     'x-timestamp': metadata['X-Timestamp'],
                     'x-etag': metadata['ETag']}),
                 device)
+            self._record_phase(request, 'container_update', phase_start)
         return HTTPCreated(request=request, etag=etag)
 
     @public
@@ -472,9 +580,11 @@ class ObjectController(object):
                 device, partition, account, container, obj)
         except DiskFileDeviceUnavailable:
             return HTTPInsufficientStorage(drive=device, request=request)
+        phase_start = time.time()
         try:
             with disk_file.open():
                 metadata = disk_file.get_metadata()
+                self._record_phase(request, 'open', phase_start)
                 obj_size = int(metadata['Content-Length'])
                 if request.headers.get('if-match') not in (None, '*') and \
                         metadata['ETag'] not in request.if_match:
@@ -646,6 +756,8 @@ class ObjectController(object):
         start_time = time.time()
         req = Request(env)
         self.logger.txn_id = req.headers.get('x-trans-id', None)
+        device = req.path_info.lstrip('/').split('/', 1)[0]
+        self.active_requests[device] += 1
 
         if not check_utf8(req.path_info):
             res = HTTPPreconditionFailed(body='Invalid UTF8 or contains NULL')
@@ -672,7 +784,15 @@ class ObjectController(object):
                     'ERROR __call__ error with %(method)s'
                     ' %(path)s '), {'method': req.method, 'path': req.path})
                 res = HTTPInternalServerError(body=traceback.format_exc())
+        self.active_requests[device] -= 1
+        if not self.active_requests[device]:
+            del self.active_requests[device]
+        if self.load_hints:
+            res.headers['X-Backend-Load'] = self._load_hint(device)
         trans_time = time.time() - start_time
+        self.tracer.record(req.headers.get('x-trans-id'), req.method,
+                           start_time, start_time + trans_time,
+                           path=req.path, status=res.status_int)
         if self.log_requests:
             log_line = '%s - - [%s] "%s %s" %s %s "%s" "%s" "%s" %.4f' % (
                 req.remote_addr,
@@ -692,7 +812,67 @@ class ObjectController(object):
             slow = self.slow - trans_time
             if slow > 0:
                 sleep(slow)
-        return res(env, start_response)
+        if not self.slow_request_threshold:
+            return res(env, start_response)
+        # the body of a GET is streamed after we return, so the request is
+        # only timed once its response iterator is done with
+        return _SlowRequestIter(
+            res(env, start_response),
+            lambda: self._check_slow_request(req, res, start_time))
+
+    def _check_slow_request(self, req, res, start_time):
+        """
+        Logs a warning with the phase breakdown if the request, body
+        included, took longer than slow_request_threshold.
+        """
+        trans_time = time.time() - start_time
+        if trans_time <= self.slow_request_threshold:
+            return
+        phases = ' '.join('%s=%.1fms' % (name, elapsed * 1000)
+                          for name, elapsed in
+                          req.environ.get('swift.phase_times', ()))
+        self.logger.warning(
+            _('Slow request %(method)s %(path)s %(status)s took '
+              '%(time).4fs: %(phases)s'),
+            {'method': req.method, 'path': req.path,
+             'status': res.status.split()[0], 'time': trans_time,
+             'phases': phases or '-'})
+
+
+class _SlowRequestIter(object):
+    """
+    Wraps a response iterable and calls ``on_done`` once, when the iterable
+    is exhausted or closed, whichever comes first.
+    """
+
+    def __init__(self, iterable, on_done):
+        self.iterable = iterable
+        self.iterator = None
+        self.on_done = on_done
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.iterator is None:
+            self.iterator = iter(self.iterable)
+        try:
+            return self.iterator.next()
+        except StopIteration:
+            self._done()
+            raise
+
+    def _done(self):
+        on_done, self.on_done = self.on_done, None
+        if on_done:
+            on_done()
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self._done()
 
 
 def global_conf_callback(preloaded_app_conf, global_conf):
@@ -716,7 +896,8 @@ def global_conf_callback(preloaded_app_conf, global_conf):
     if replication_concurrency:
         # Have to put the value in a list so it can get past paste
         global_conf['replication_semaphore'] = [
-            multiprocessing.BoundedSemaphore(replication_concurrency)]
+            multiprocessing.BoundedSemaphore(replication_concurrency),
+            replication_concurrency]
 
 
 def app_factory(global_conf, **local_conf):
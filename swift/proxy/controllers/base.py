@@ -40,6 +40,7 @@ from swift.common.utils import normalize_timestamp, config_true_value, \
     public, split_path, list_from_csv, GreenthreadSafeIterator, \
     quorum_size, GreenAsyncPile
 from swift.common.bufferedhttp import http_connect
+from swift.common.tracing import node_to_string
 from swift.common.exceptions import ChunkReadTimeout, ChunkWriteTimeout, \
     ConnectionTimeout
 from swift.common.http import is_informational, is_success, is_redirection, \
@@ -62,6 +63,9 @@ def update_headers(response, headers):
     for name, value in headers:
         if name == 'etag':
             response.headers[name] = value.replace('"', '')
+        elif name.lower().startswith('x-backend-'):
+            # reserved for the proxy and backends, such as load hints
+            continue
         elif name not in ('date', 'content-length', 'content-type',
                           'connection', 'x-put-timestamp', 'x-delete-after'):
             response.headers[name] = value
@@ -708,12 +712,22 @@ class GetOrHeadHandler(object):
                         headers=self.backend_headers,
                         query_string=self.req_query_string)
                 self.app.set_node_timing(node, time.time() - start_node_timing)
+                self.app.tracer.record(
+                    self.backend_headers.get('x-trans-id'), 'backend.connect',
+                    start_node_timing, node=node_to_string(node))
 
                 with Timeout(self.app.node_timeout):
                     possible_source = conn.getresponse()
                     # See NOTE: swift_conn at top of file about this.
                     possible_source.swift_conn = conn
+                self.app.record_node_response(
+                    node, time.time() - start_node_timing,
+                    is_server_error(possible_source.status))
+                self.app.record_node_load(
+                    node, possible_source.getheader('x-backend-load'))
             except (Exception, Timeout):
+                self.app.record_node_response(
+                    node, time.time() - start_node_timing, error=True)
                 self.app.exception_occurred(
                     node, self.server_type,
                     _('Trying to %(method)s %(path)s') %
@@ -925,7 +939,8 @@ class Controller(object):
             env = getattr(req, 'environ', {})
         else:
             env = {}
-        info = get_info(self.app, env, account, container)
+        with self.app.tracer.span(self.trans_id, 'container_info'):
+            info = get_info(self.app, env, account, container)
         if not info:
             info = headers_to_container_info({}, 0)
             info['partition'] = None
@@ -965,8 +980,16 @@ class Controller(object):
                                         headers=headers, query_string=query)
                     conn.node = node
                 self.app.set_node_timing(node, time.time() - start_node_timing)
+                self.app.tracer.record(
+                    self.trans_id, 'backend.connect', start_node_timing,
+                    node=node_to_string(node))
                 with Timeout(self.app.node_timeout):
                     resp = conn.getresponse()
+                    self.app.record_node_response(
+                        node, time.time() - start_node_timing,
+                        is_server_error(resp.status))
+                    self.app.record_node_load(
+                        node, resp.getheader('x-backend-load'))
                     if not is_informational(resp.status) and \
                             not is_server_error(resp.status):
                         return resp.status, resp.reason, resp.getheaders(), \
@@ -975,6 +998,8 @@ class Controller(object):
                         self.app.error_limit(node,
                                              _('ERROR Insufficient Storage'))
             except (Exception, Timeout):
+                self.app.record_node_response(
+                    node, time.time() - start_node_timing, error=True)
                 self.app.exception_occurred(
                     node, self.server_type,
                     _('Trying to %(method)s %(path)s') %
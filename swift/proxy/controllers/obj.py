@@ -34,7 +34,7 @@ from urllib import unquote, quote
 from hashlib import md5
 from sys import exc_info
 
-from eventlet import sleep, GreenPile
+from eventlet import sleep, spawn_n, GreenPile
 from eventlet.queue import Queue
 from eventlet.timeout import Timeout
 
@@ -43,6 +43,7 @@ from swift.common.utils import ContextPool, normalize_timestamp, \
     quorum_size, split_path, override_bytes_from_content_type, \
     get_valid_utf8_str, GreenAsyncPile
 from swift.common.bufferedhttp import http_connect
+from swift.common.tracing import node_to_string
 from swift.common.constraints import check_metadata, check_object_creation, \
     CONTAINER_LISTING_LIMIT, MAX_FILE_SIZE
 from swift.common.exceptions import ChunkReadTimeout, \
@@ -805,9 +806,16 @@ class ObjectController(Controller):
                     conn = http_connect(
                         node['ip'], node['port'], node['device'], part, 'PUT',
                         path, headers)
-                self.app.set_node_timing(node, time.time() - start_time)
+                connect_time = time.time()
+                self.app.set_node_timing(node, connect_time - start_time)
+                self.app.tracer.record(
+                    self.trans_id, 'backend.connect', start_time,
+                    connect_time, node=node_to_string(node))
                 with Timeout(self.app.node_timeout):
                     resp = conn.getexpect()
+                self.app.tracer.record(
+                    self.trans_id, 'backend.expect', connect_time,
+                    node=node_to_string(node), status=resp.status)
                 if resp.status == HTTP_CONTINUE:
                     conn.resp = None
                     conn.node = node
@@ -833,38 +841,97 @@ class ObjectController(Controller):
             try:
                 with Timeout(self.app.node_timeout):
                     if conn.resp:
-                        return conn.resp
+                        resp = conn.resp
                     else:
-                        return conn.getresponse()
+                        resp = conn.getresponse()
+                self.app.record_node_load(
+                    conn.node, resp.getheader('x-backend-load'))
+                return conn, resp
             except (Exception, Timeout):
                 self.app.exception_occurred(
                     conn.node, _('Object'),
                     _('Trying to get final status of PUT to %s') % req.path)
+                return conn, None
+
+        def handle_response(conn, response):
+            statuses.append(response.status)
+            reasons.append(response.reason)
+            bodies.append(response.read())
+            if response.status >= HTTP_INTERNAL_SERVER_ERROR:
+                self.app.error_occurred(
+                    conn.node,
+                    _('ERROR %(status)d %(body)s From Object Server '
+                      're: %(path)s') %
+                    {'status': response.status,
+                     'body': bodies[-1][:1024], 'path': req.path})
+            elif is_success(response.status):
+                etags.add(response.getheader('etag').strip('"'))
+
         pile = GreenAsyncPile(len(conns))
         for conn in conns:
             pile.spawn(get_conn_response, conn)
-        for response in pile:
+        finished = 0
+        for conn, response in pile:
+            finished += 1
             if response:
-                statuses.append(response.status)
-                reasons.append(response.reason)
-                bodies.append(response.read())
-                if response.status >= HTTP_INTERNAL_SERVER_ERROR:
-                    self.app.error_occurred(
-                        conn.node,
-                        _('ERROR %(status)d %(body)s From Object Server '
-                          're: %(path)s') %
-                        {'status': response.status,
-                         'body': bodies[-1][:1024], 'path': req.path})
-                elif is_success(response.status):
-                    etags.add(response.getheader('etag').strip('"'))
+                handle_response(conn, response)
                 if self.have_quorum(statuses, len(nodes)):
                     break
+        # give the other object servers a chance to finish before replying
+        for conn, response in pile.waitall(self.app.post_quorum_timeout):
+            finished += 1
+            if response:
+                handle_response(conn, response)
+        if finished < len(conns):
+            spawn_n(self._finish_put_stragglers, req, pile, etags)
         while len(statuses) < len(nodes):
             statuses.append(HTTP_SERVICE_UNAVAILABLE)
             reasons.append('')
             bodies.append('')
         return statuses, reasons, bodies, etags
 
+    def _finish_put_stragglers(self, req, pile, etags):
+        """
+        Collects the final responses of the object servers that had not
+        answered a PUT by the time the client was replied to.
+
+        :param req: the client's PUT request
+        :param pile: :class:`GreenAsyncPile` of the pending responses
+        :param etags: set of the etags returned before replying
+        """
+        start = time.time()
+        for conn, response in pile:
+            if not response:
+                # the failure was logged and error limited already
+                self.app.logger.increment('stragglers.failure')
+                continue
+            body = response.read()
+            if is_success(response.status):
+                etag = response.getheader('etag').strip('"')
+                if etags and etag not in etags:
+                    self.app.logger.error(
+                        _('Object server %(node)s returned mismatched etag '
+                          '%(etag)s after replying to PUT of %(path)s'),
+                        {'node': node_to_string(conn.node), 'etag': etag,
+                         'path': req.path})
+                self.app.logger.increment('stragglers.success')
+            else:
+                if response.status >= HTTP_INTERNAL_SERVER_ERROR:
+                    self.app.error_occurred(
+                        conn.node,
+                        _('ERROR %(status)d %(body)s From Object Server '
+                          're: %(path)s') %
+                        {'status': response.status, 'body': body[:1024],
+                         'path': req.path})
+                else:
+                    self.app.logger.warning(
+                        _('Object server %(node)s returned %(status)d '
+                          'after replying to PUT of %(path)s'),
+                        {'node': node_to_string(conn.node),
+                         'status': response.status, 'path': req.path})
+                self.app.logger.increment('stragglers.failure')
+            self.app.logger.timing_since('stragglers.timing', start)
+
     @public
     @cors_validation
     @delay_denial
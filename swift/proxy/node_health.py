@@ -0,0 +1,146 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Node health state shared between the worker processes of a proxy server.
+
+The table is allocated in shared memory before the workers are forked (see
+:func:`swift.proxy.server.global_conf_callback`), so an error or slow
+response seen by one worker is immediately taken into account by the others.
+
+The table is a fixed size open addressing hash table keyed by device. When
+every slot a device could use is taken, the least recently updated one is
+reused. Workers update it without locking: a lost update only means one
+error or latency sample less, which the next request makes up for.
+"""
+
+import ctypes
+import struct
+from hashlib import md5
+from multiprocessing.sharedctypes import RawArray
+
+#: number of slots probed for a device before evicting one
+PROBES = 8
+
+
+class NodeHealthSlot(ctypes.Structure):
+    _fields_ = [('key', ctypes.c_uint64),
+                ('errors', ctypes.c_int),
+                ('last_error', ctypes.c_double),
+                ('latency', ctypes.c_double),
+                ('error_rate', ctypes.c_double),
+                ('updated', ctypes.c_double),
+                ('load', ctypes.c_int),
+                ('load_updated', ctypes.c_double)]
+
+
+def node_key(node):
+    """Returns the non-zero 64 bit key of a node's device."""
+    digest = md5('%s:%s/%s' % (node['ip'], node['port'],
+                               node['device'])).digest()
+    return struct.unpack('>Q', digest[:8])[0] or 1
+
+
+class SharedNodeHealth(object):
+    """
+    Error limiting, latency and load state of devices, shared by all
+    workers.
+
+    :param slots: number of devices the table can hold
+    """
+
+    def __init__(self, slots):
+        self.size = slots
+        self.slots = RawArray(NodeHealthSlot, slots)
+
+    def _find(self, node, create=False):
+        key = node_key(node)
+        index = key % self.size
+        oldest = None
+        for i in xrange(min(PROBES, self.size)):
+            slot = self.slots[(index + i) % self.size]
+            if slot.key == key:
+                return slot
+            if not create:
+                continue
+            if not slot.key:
+                oldest = slot
+                break
+            if oldest is None or \
+                    max(slot.updated, slot.last_error, slot.load_updated) < \
+                    max(oldest.updated, oldest.last_error,
+                        oldest.load_updated):
+                oldest = slot
+        if not create:
+            return None
+        ctypes.memset(ctypes.addressof(oldest), 0, ctypes.sizeof(oldest))
+        oldest.key = key
+        return oldest
+
+    def load_errors(self, node):
+        """
+        Sets the error limiting keys of the node dict ('errors' and
+        'last_error') from the shared state.
+        """
+        slot = self._find(node)
+        if slot is None or not slot.errors:
+            node.pop('errors', None)
+            node.pop('last_error', None)
+        else:
+            node['errors'] = slot.errors
+            node['last_error'] = slot.last_error
+
+    def store_errors(self, node):
+        """Saves the error limiting keys of the node dict."""
+        if 'errors' not in node:
+            slot = self._find(node)
+            if slot is not None:
+                slot.errors = 0
+                slot.last_error = 0
+            return
+        slot = self._find(node, create=True)
+        slot.errors = node['errors']
+        slot.last_error = node.get('last_error', 0)
+
+    def get_latency(self, node):
+        """
+        Returns a (latency, error_rate, updated) tuple for the node, or None
+        if nothing was recorded for it.
+        """
+        slot = self._find(node)
+        if slot is None or not slot.updated:
+            return None
+        return slot.latency, slot.error_rate, slot.updated
+
+    def set_latency(self, node, latency, error_rate, updated):
+        slot = self._find(node, create=True)
+        slot.latency = latency
+        slot.error_rate = error_rate
+        slot.updated = updated
+
+    def get_load(self, node):
+        """
+        Returns a (load, updated) tuple for the node, or None if no load was
+        reported for it.
+        """
+        slot = self._find(node)
+        if slot is None or not slot.load_updated:
+            return None
+        return slot.load, slot.load_updated
+
+    def set_load(self, node, load, updated):
+        slot = self._find(node, create=True)
+        slot.load = load
+        slot.load_updated = updated
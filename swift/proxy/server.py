@@ -17,7 +17,7 @@ import mimetypes
 import os
 import socket
 from swift import gettext_ as _
-from random import shuffle
+from random import sample, shuffle
 from time import time
 import itertools
 
@@ -28,6 +28,9 @@ from swift.common.utils import cache_from_env, get_logger, \
     get_remote_client, split_path, config_true_value, generate_trans_id, \
     affinity_key_function, affinity_locality_predicate
 from swift.common.constraints import check_utf8
+from swift.common.request_helpers import parse_load_hint
+from swift.common.tracing import Tracer
+from swift.proxy.node_health import SharedNodeHealth
 from swift.proxy.controllers import AccountController, ObjectController, \
     ContainerController
 from swift.common.swob import HTTPBadRequest, HTTPForbidden, \
@@ -46,12 +49,14 @@ class Application(object):
             self.logger = get_logger(conf, log_route='proxy-server')
         else:
             self.logger = logger
+        self.tracer = Tracer(conf, 'proxy-server', self.logger)
 
         swift_dir = conf.get('swift_dir', '/etc/swift')
         self.node_timeout = int(conf.get('node_timeout', 10))
         self.conn_timeout = float(conf.get('conn_timeout', 0.5))
         self.client_timeout = int(conf.get('client_timeout', 60))
         self.put_queue_depth = int(conf.get('put_queue_depth', 10))
+        self.post_quorum_timeout = float(conf.get('post_quorum_timeout', 0))
         self.object_chunk_size = int(conf.get('object_chunk_size', 65536))
         self.client_chunk_size = int(conf.get('client_chunk_size', 65536))
         self.trans_id_suffix = conf.get('trans_id_suffix', '')
@@ -103,6 +108,19 @@ class Application(object):
         self.node_timings = {}
         self.timing_expiry = int(conf.get('timing_expiry', 300))
         self.sorting_method = conf.get('sorting_method', 'shuffle').lower()
+        self.node_latencies = {}
+        # set up by global_conf_callback to share node health between workers
+        self.node_health = conf.get('node_health', [None])[0]
+        self.latency_ewma_alpha = float(conf.get('latency_ewma_alpha', 0.3))
+        self.latency_half_life = float(conf.get('latency_half_life', 60))
+        if self.latency_half_life <= 0:
+            raise ValueError(
+                'Invalid latency_half_life value: %r' % self.latency_half_life)
+        self.latency_error_penalty = float(
+            conf.get('latency_error_penalty', 1.0))
+        self.node_loads = {}
+        self.load_hint_penalty = float(conf.get('load_hint_penalty', 0.01))
+        self.load_hint_expiry = float(conf.get('load_hint_expiry', 10))
         self.allow_static_large_object = config_true_value(
             conf.get('allow_static_large_object', 'true'))
         self.max_large_object_get_time = float(
@@ -297,7 +315,9 @@ class Application(object):
             # gets mutated during handling.  This way logging can display the
             # method the client actually sent.
             req.environ['swift.orig_req_method'] = req.method
-            return handler(req)
+            with self.tracer.span(controller.trans_id, req.method,
+                                  path=req.path):
+                return handler(req)
         except HTTPException as error_response:
             return error_response
         except (Exception, Timeout):
@@ -324,6 +344,23 @@ class Application(object):
             nodes.sort(key=key_func)
         elif self.sorting_method == 'affinity':
             nodes.sort(key=self.read_affinity_sort_key)
+        elif self.sorting_method == 'latency':
+            now = time()
+            nodes.sort(key=lambda node: self.node_latency_score(node, now))
+        elif self.sorting_method == 'power_of_two':
+            # Repeatedly pick two of the remaining nodes at random and take
+            # the faster one; this mostly avoids slow devices without sending
+            # every request to the single fastest one.
+            now = time()
+            remaining = nodes[:]
+            del nodes[:]
+            while len(remaining) > 1:
+                i, j = sample(xrange(len(remaining)), 2)
+                if self.node_latency_score(remaining[j], now) < \
+                        self.node_latency_score(remaining[i], now):
+                    i = j
+                nodes.append(remaining.pop(i))
+            nodes.extend(remaining)
         return nodes
 
     def set_node_timing(self, node, timing):
@@ -333,6 +370,106 @@ class Application(object):
         timing = round(timing, 3)  # sort timings to the millisecond
         self.node_timings[node['ip']] = (timing, now + self.timing_expiry)
 
+    def record_node_response(self, node, elapsed, error=False):
+        """
+        Updates the exponentially weighted moving averages of the response
+        time and error rate of a node's device, used by the "latency" and
+        "power_of_two" sorting methods.
+
+        :param node: dictionary of the node that was sent a request
+        :param elapsed: seconds from sending the request until getting the
+                        response status or failing
+        :param error: True if the request failed or got a server error
+        """
+        if self.sorting_method not in ('latency', 'power_of_two'):
+            return
+        alpha = self.latency_ewma_alpha
+        error = 1.0 if error else 0.0
+        now = time()
+        stats = self._get_node_latency(node)
+        if stats is None:
+            self._set_node_latency(node, elapsed, error, now)
+        else:
+            # old samples count for less the longer ago they were taken
+            latency, error_rate = self._decay_node_latency(stats, now)
+            self._set_node_latency(
+                node, alpha * elapsed + (1 - alpha) * latency,
+                alpha * error + (1 - alpha) * error_rate, now)
+
+    def record_node_load(self, node, load_hint):
+        """
+        Remembers the load a node's device reported in its last response's
+        X-Backend-Load header, used by the "latency" and "power_of_two"
+        sorting methods.
+
+        :param node: dictionary of the node that responded
+        :param load_hint: value of the X-Backend-Load header, if any
+        """
+        if self.sorting_method not in ('latency', 'power_of_two'):
+            return
+        load = parse_load_hint(load_hint)
+        if load is not None:
+            self._set_node_load(node, load, time())
+
+    def node_latency_score(self, node, now=None):
+        """
+        Returns the expected cost in seconds of sending a request to a node's
+        device: its average response time plus latency_error_penalty times
+        its error rate. The score halves every latency_half_life seconds
+        without new responses, so that devices that were slow are tried
+        again eventually; devices without statistics score 0. The load the
+        device last reported, if less than load_hint_expiry seconds ago,
+        adds load_hint_penalty per outstanding operation.
+
+        :param node: dictionary of the node to score
+        :param now: current time, defaults to time()
+        """
+        if now is None:
+            now = time()
+        score = 0.0
+        stats = self._get_node_latency(node)
+        if stats is not None:
+            latency, error_rate = self._decay_node_latency(stats, now)
+            score = latency + error_rate * self.latency_error_penalty
+        load = self._get_node_load(node)
+        if load is not None and now - load[1] < self.load_hint_expiry:
+            score += load[0] * self.load_hint_penalty
+        return score
+
+    def _decay_node_latency(self, stats, now):
+        """
+        Returns the latency and error rate of stored node statistics, halved
+        for every latency_half_life seconds since they were last updated.
+        """
+        latency, error_rate, updated = stats
+        decay = 0.5 ** (max(now - updated, 0) / self.latency_half_life)
+        return latency * decay, error_rate * decay
+
+    def _get_node_latency(self, node):
+        if self.node_health is not None:
+            return self.node_health.get_latency(node)
+        return self.node_latencies.get(
+            (node['ip'], node['port'], node['device']))
+
+    def _set_node_latency(self, node, latency, error_rate, updated):
+        if self.node_health is not None:
+            self.node_health.set_latency(node, latency, error_rate, updated)
+        else:
+            self.node_latencies[(node['ip'], node['port'], node['device'])] = \
+                (latency, error_rate, updated)
+
+    def _get_node_load(self, node):
+        if self.node_health is not None:
+            return self.node_health.get_load(node)
+        return self.node_loads.get((node['ip'], node['port'], node['device']))
+
+    def _set_node_load(self, node, load, updated):
+        if self.node_health is not None:
+            self.node_health.set_load(node, load, updated)
+        else:
+            self.node_loads[(node['ip'], node['port'], node['device'])] = \
+                (load, updated)
+
     def error_limited(self, node):
         """
         Check if the node is currently error limited.
@@ -341,6 +478,8 @@ class Application(object):
         :returns: True if error limited, False otherwise
         """
         now = time()
+        if self.node_health is not None:
+            self.node_health.load_errors(node)
         if 'errors' not in node:
             return False
         if 'last_error' in node and node['last_error'] < \
@@ -348,6 +487,8 @@ class Application(object):
             del node['last_error']
             if 'errors' in node:
                 del node['errors']
+            if self.node_health is not None:
+                self.node_health.store_errors(node)
             return False
         limited = node['errors'] > self.error_suppression_limit
         if limited:
@@ -367,6 +508,8 @@ class Application(object):
         """
         node['errors'] = self.error_suppression_limit + 1
         node['last_error'] = time()
+        if self.node_health is not None:
+            self.node_health.store_errors(node)
         self.logger.error(_('%(msg)s %(ip)s:%(port)s/%(device)s'),
                           {'msg': msg, 'ip': node['ip'],
                           'port': node['port'], 'device': node['device']})
@@ -378,8 +521,12 @@ class Application(object):
         :param node: dictionary of node to handle errors for
         :param msg: error message
         """
+        if self.node_health is not None:
+            self.node_health.load_errors(node)
         node['errors'] = node.get('errors', 0) + 1
         node['last_error'] = time()
+        if self.node_health is not None:
+            self.node_health.store_errors(node)
         self.logger.error(_('%(msg)s %(ip)s:%(port)s/%(device)s'),
                           {'msg': msg, 'ip': node['ip'],
                           'port': node['port'], 'device': node['device']})
@@ -454,6 +601,27 @@ class Application(object):
              'device': node['device'], 'info': additional_info})
 
 
+def global_conf_callback(preloaded_app_conf, global_conf):
+    """
+    Callback for swift.common.wsgi.run_wsgi during the global_conf
+    creation so that we can set up the node health table shared by all
+    workers, when node_health_slots is set.
+
+    :param preloaded_app_conf: The preloaded conf for the WSGI app.
+                               This conf instance will go away, so
+                               just read from it, don't write.
+    :param global_conf: The global conf that will eventually be
+                        passed to the app_factory function later.
+                        This conf is created before the worker
+                        subprocesses are forked, so can be useful to
+                        set up semaphores, shared memory, etc.
+    """
+    node_health_slots = int(preloaded_app_conf.get('node_health_slots') or 0)
+    if node_health_slots:
+        # Have to put the value in a list so it can get past paste
+        global_conf['node_health'] = [SharedNodeHealth(node_health_slots)]
+
+
 def app_factory(global_conf, **local_conf):
     """paste.deploy app factory for creating WSGI proxy apps."""
     conf = global_conf.copy()
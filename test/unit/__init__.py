@@ -268,7 +268,9 @@ class FakeLogger(logging.Logger):
     increment = _store_in('increment')
     decrement = _store_in('decrement')
     timing = _store_in('timing')
+    gauge = _store_in('gauge')
     timing_since = _store_in('timing_since')
+    transfer_rate = _store_in('transfer_rate')
     update_stats = _store_in('update_stats')
     set_statsd_prefix = _store_in('set_statsd_prefix')
 
@@ -40,6 +40,17 @@ class FakeAccountBroker(object):
         if self.file.startswith('true'):
             return 'ok'
 
+    def checkpoint(self):
+        return True
+
+    def get_free_ratio(self):
+        return 0.5
+
+    def compact(self):
+        if self.file.startswith('bad'):
+            raise ValueError
+        return 100
+
 
 class TestAuditor(unittest.TestCase):
 
@@ -117,5 +128,20 @@ class TestAuditor(unittest.TestCase):
         self.assertEqual(test_auditor.account_failures, 2)
         self.assertEqual(test_auditor.account_passes, 3)
 
+    @mock.patch('swift.account.auditor.AccountBroker', FakeAccountBroker)
+    def test_account_auditor_compaction(self):
+        conf = {'compaction_free_ratio': '0.25', 'compaction_min_size': '0'}
+        test_auditor = auditor.AccountAuditor(conf)
+        test_auditor.logger = test_auditor.compactor.logger = FakeLogger()
+        files = os.listdir(self.testdir)
+        for f in files:
+            path = os.path.join(self.testdir, f)
+            test_auditor.account_audit(path)
+        self.assertEqual(test_auditor.account_passes, 3)
+        self.assertEqual(test_auditor.compactor.compactions, 3)
+        self.assertEqual(test_auditor.compactor.report(0),
+                         {'account_compactions': 3,
+                          'account_compacted_bytes': 300})
+
 if __name__ == '__main__':
     unittest.main()
@@ -16,10 +16,18 @@
 """ Tests for swift.account.backend """
 
 import hashlib
+import os
+import sqlite3
 import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
 from time import sleep, time
 from uuid import uuid4
 
+import mock
+
+import swift.common.db
+from swift.account import backend
 from swift.account.backend import AccountBroker
 from swift.common.utils import normalize_timestamp
 
@@ -133,6 +141,21 @@ class TestAccountBroker(unittest.TestCase):
         # containers, account_name = res
         # self.assertEqual(account_name, 'test_account')
         # self.assertEqual(len(containers), 3)
+
+    def test_reclaim_batches(self):
+        broker = AccountBroker(':memory:', account='a')
+        broker.initialize(normalize_timestamp('1'))
+        for name in 'abcde':
+            broker.put_container(name, 0, normalize_timestamp(2), 0, 0)
+        broker.put_container('f', 0, normalize_timestamp(4), 0, 0)
+        self.assertEqual(
+            broker.reclaim(normalize_timestamp(3), normalize_timestamp(3),
+                           batch_size=2)[0], 5)
+        with broker.get() as conn:
+            self.assertEqual([row[0] for row in conn.execute(
+                'SELECT name FROM container')], ['f'])
+            self.assertEqual(conn.execute(
+                'SELECT reclaim_point FROM account_stat').fetchone()[0], '')
         # self.assert_('x' in containers)
         # self.assert_('y' in containers)
         # self.assert_('z' in containers)
@@ -452,6 +475,22 @@ class TestAccountBroker(unittest.TestCase):
             ''.join(('%02x' % (ord(a) ^ ord(b)) for a, b in zip(hasha, hashb)))
         self.assertEqual(broker.get_info()['hash'], hashc)
 
+    def test_range_hashes(self):
+        broker = AccountBroker(':memory:', account='a')
+        broker.initialize(normalize_timestamp('1'))
+        for i in xrange(5):
+            broker.put_container('c%d' % i, normalize_timestamp(i + 1),
+                                 0, i, i * 10)
+        broker.put_container(u'c\u00e9', normalize_timestamp(6), 0, 1, 2)
+        broker.put_container('c3', normalize_timestamp(1),
+                             normalize_timestamp(7), 0, 0)
+        ranges = broker.get_range_hashes([None, 'c1', None])
+        self.assertEquals([count for count, hsh in ranges], [2, 4])
+        # the ranges cover the whole DB, so their hashes make up its hash
+        self.assertEquals(
+            '%032x' % (int(ranges[0][1], 16) ^ int(ranges[1][1], 16)),
+            broker.get_info()['hash'])
+
     def test_merge_items(self):
         broker1 = AccountBroker(':memory:', account='a')
         broker1.initialize(normalize_timestamp('1'))
@@ -473,6 +512,83 @@ class TestAccountBroker(unittest.TestCase):
         self.assertEqual(['a', 'b', 'c'],
                          sorted([rec['name'] for rec in items]))
 
+    def test_merge_items_concurrent_writer(self):
+        # merge_items holds the write lock from its first read, so another
+        # writer waits for it rather than making it fail to turn its read
+        # into a write
+        testdir = mkdtemp()
+        orig_wal = swift.common.db.DB_WAL
+        swift.common.db.DB_WAL = True
+        try:
+            broker = AccountBroker(os.path.join(testdir, 'a.db'),
+                                   account='a')
+            broker.initialize(normalize_timestamp('1'))
+            broker.put_container('c', normalize_timestamp(1), 0, 0, 0)
+            self.assertEqual(broker.get_info()['container_count'], 1)
+            locked = []
+            orig_merge_record = backend._merge_container_record
+
+            def merge_record(record, row):
+                other = sqlite3.connect(broker.db_file, timeout=0.01)
+                try:
+                    other.execute("UPDATE account_stat SET status = 'x'")
+                    other.commit()
+                except sqlite3.OperationalError as err:
+                    locked.append(str(err))
+                finally:
+                    other.close()
+                orig_merge_record(record, row)
+
+            with mock.patch('swift.account.backend._merge_container_record',
+                            merge_record):
+                broker.merge_items([
+                    {'name': 'c', 'put_timestamp': normalize_timestamp(2),
+                     'delete_timestamp': normalize_timestamp(0),
+                     'object_count': 1, 'bytes_used': 10, 'deleted': 0}])
+            self.assertEqual(locked, ['database is locked'])
+            info = broker.get_info()
+            self.assertEqual(info['container_count'], 1)
+            self.assertEqual(info['object_count'], 1)
+            self.assertEqual(info['bytes_used'], 10)
+        finally:
+            swift.common.db.DB_WAL = orig_wal
+            rmtree(testdir, ignore_errors=True)
+
+    def test_merge_items_batch_with_duplicates(self):
+        broker = AccountBroker(':memory:', account='a')
+        broker.initialize(normalize_timestamp('1'))
+        broker.put_container('a', normalize_timestamp(2), 0, 1, 10)
+        broker.put_container('b', normalize_timestamp(1), 0, 2, 20)
+
+        def item(name, put_timestamp, delete_timestamp, object_count,
+                 bytes_used):
+            return {'name': name,
+                    'put_timestamp': normalize_timestamp(put_timestamp),
+                    'delete_timestamp': normalize_timestamp(delete_timestamp),
+                    'object_count': object_count, 'bytes_used': bytes_used,
+                    'deleted': 0, 'ROWID': put_timestamp}
+
+        # records for a name are merged into each other and the existing
+        # row, and the row ends up where the last of them came in
+        broker.merge_items([item('b', 0, 3, 0, 0), item('a', 4, 0, 3, 30),
+                            item('c', 5, 0, 1, 1), item('b', 0, 0, 0, 0),
+                            item('a', 1, 0, 4, 40)], 'remote')
+        items = broker.get_items_since(-1, 1000)
+        self.assertEqual([(rec['name'], rec['put_timestamp'],
+                           rec['delete_timestamp'], rec['object_count'],
+                           rec['deleted']) for rec in items],
+                         [('c', normalize_timestamp(5), normalize_timestamp(0),
+                           1, 0),
+                          ('b', normalize_timestamp(1), normalize_timestamp(3),
+                           0, 1),
+                          ('a', normalize_timestamp(4), normalize_timestamp(0),
+                           4, 0)])
+        info = broker.get_info()
+        self.assertEqual(info['container_count'], 2)
+        self.assertEqual(info['object_count'], 5)
+        self.assertEqual(info['bytes_used'], 41)
+        self.assertEqual(broker.get_sync('remote'), 5)
+
 
 def premetadata_create_account_stat_table(self, conn, put_timestamp):
     """
@@ -0,0 +1,199 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import mock
+
+from swift.common.middleware import admission_control
+from swift.common.swob import Request, Response
+from test.unit import FakeLogger
+
+
+class FakeApp(object):
+
+    def __init__(self, duration=0):
+        self.calls = 0
+        self.duration = duration
+
+    def __call__(self, env, start_response):
+        self.calls += 1
+        # time.time() is mocked to return the value of env['now']
+        env['now'][0] += self.duration
+        return Response(body='ok')(env, start_response)
+
+
+class TestAdmissionControl(unittest.TestCase):
+
+    def setUp(self):
+        self.app = FakeApp()
+        self.logger = FakeLogger()
+        self.mw = admission_control.AdmissionControlMiddleware(
+            self.app, {'target_delay': '1', 'min_in_flight': '2',
+                       'low_priority_user_agents': 'Swift Container Sync'},
+            logger=self.logger)
+        self.now = [1000.0]
+
+    def fill(self, count, age=0.0, measured=True):
+        for i in xrange(count):
+            token = object()
+            self.mw.in_flight[token] = self.now[0] - age
+            if measured:
+                self.mw.start_order.append((self.now[0] - age, token))
+
+    def request(self, path='/v1/a/c/o', method='GET', headers=None,
+                environ=None):
+        env = {'REQUEST_METHOD': method, 'now': self.now}
+        env.update(environ or {})
+        req = Request.blank(path, environ=env, headers=headers)
+        with mock.patch('time.time', lambda: self.now[0]):
+            return req.get_response(self.mw)
+
+    def test_admits_below_min_in_flight(self):
+        self.mw.latency = 10
+        self.fill(1)
+        resp = self.request(method='PUT')
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(self.app.calls, 1)
+
+    def test_sheds_by_priority(self):
+        self.fill(2)
+        self.mw.latency = 1.5
+        resp = self.request(method='PUT')
+        self.assertEquals(resp.status_int, 503)
+        self.assertEquals(resp.headers['Retry-After'], '2')
+        resp = self.request(method='GET')
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(self.app.calls, 1)
+
+        self.mw.latency = 0.7
+        self.assertEquals(self.request(method='PUT').status_int, 200)
+        resp = self.request('/v1/a?bulk-delete', method='DELETE')
+        self.assertEquals(resp.status_int, 503)
+        self.assertEquals(resp.headers['Retry-After'], '1')
+
+        self.mw.latency = 2.5
+        self.assertEquals(self.request(method='HEAD').status_int, 503)
+        self.assertEquals(self.logger.log_dict['set_statsd_prefix'],
+                          [(('admission-control',), {})])
+        self.assertEquals(self.logger.get_increment_counts(),
+                          {'normal.shed': 1, 'low.shed': 1, 'high.shed': 1})
+
+    def test_oldest_request_age(self):
+        self.fill(1, age=3)
+        self.fill(1)
+        self.assertEquals(self.mw.estimated_delay(self.now[0]), 3)
+        self.assertEquals(self.request().status_int, 503)
+        self.assertEquals(self.app.calls, 0)
+
+    def test_subrequests_not_shed(self):
+        self.fill(2, age=10)
+        resp = self.request(method='PUT', environ={'swift.source': 'SLO'})
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(len(self.mw.in_flight), 2)
+
+    def test_tracks_in_flight_and_latency(self):
+        self.app.duration = 1.0
+        self.assertEquals(self.request().status_int, 200)
+        self.assertEquals(self.mw.in_flight, {})
+        self.assertEquals(len(self.mw.start_order), 0)
+        self.assertAlmostEquals(self.mw.latency, 0.1)
+        self.assertEquals(self.request().status_int, 200)
+        self.assertAlmostEquals(self.mw.latency, 0.19)
+
+        # finished requests behind the oldest one are kept until it ends
+        self.fill(1, age=1)
+        self.assertEquals(self.request().status_int, 200)
+        self.assertEquals(len(self.mw.start_order), 2)
+        self.mw.in_flight.clear()
+        self.assertEquals(self.request().status_int, 200)
+        self.assertEquals(len(self.mw.start_order), 0)
+
+    def test_queue_delay(self):
+        self.assertEquals(self.request(environ={
+            'swift.request_received': self.now[0] - 2.0}).status_int, 200)
+        self.assertAlmostEquals(self.mw.queue_delay, 0.2)
+        self.assertAlmostEquals(self.mw.latency, 0.0)
+        self.mw.latency = 0.9
+        self.assertAlmostEquals(self.mw.estimated_delay(self.now[0]), 1.1)
+        self.fill(2)
+        self.assertEquals(self.request(method='PUT').status_int, 503)
+
+    def test_body_requests_not_measured(self):
+        self.app.duration = 10.0
+        resp = self.request(method='PUT', headers={'Content-Length': '5'},
+                            environ={'swift.request_received':
+                                     self.now[0] - 2.0})
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(self.mw.queue_delay, 0.0)
+        self.assertEquals(self.mw.latency, 0.0)
+        self.assertEquals(self.request(method='COPY').status_int, 200)
+        self.assertEquals(self.mw.latency, 0.0)
+
+        # they count as in flight, but their age is not a delay
+        self.fill(2, age=10, measured=False)
+        self.assertEquals(self.mw.estimated_delay(self.now[0]), 0.0)
+        self.app.duration = 0
+        self.assertEquals(self.request(method='PUT').status_int, 200)
+
+    def test_is_measured(self):
+        def is_measured(path='/v1/a/c/o', method='GET', headers=None):
+            return self.mw.is_measured(Request.blank(
+                path, environ={'REQUEST_METHOD': method}, headers=headers))
+
+        self.assertTrue(is_measured())
+        self.assertTrue(is_measured(method='HEAD'))
+        self.assertTrue(is_measured(method='DELETE'))
+        self.assertTrue(is_measured(method='PUT',
+                                    headers={'Content-Length': '0'}))
+        self.assertFalse(is_measured(method='PUT',
+                                     headers={'Content-Length': '1'}))
+        self.assertFalse(is_measured(method='PUT', headers={
+            'Transfer-Encoding': 'chunked'}))
+        self.assertFalse(is_measured(method='COPY'))
+        self.assertFalse(is_measured(method='PUT', headers={
+            'X-Copy-From': 'c/o2', 'Content-Length': '0'}))
+        self.assertFalse(is_measured('/v1/a?bulk-delete', method='DELETE'))
+        self.assertFalse(is_measured('/v1/a/c?extract-archive=tar',
+                                     method='PUT'))
+
+    def test_priority(self):
+        def priority(path='/v1/a/c/o', method='GET', headers=None):
+            return self.mw.priority(Request.blank(
+                path, environ={'REQUEST_METHOD': method}, headers=headers))
+
+        self.assertEquals(priority(), 'high')
+        self.assertEquals(priority(method='HEAD'), 'high')
+        self.assertEquals(priority(method='PUT'), 'normal')
+        self.assertEquals(priority(method='POST'), 'normal')
+        self.assertEquals(priority('/v1/a?bulk-delete', method='POST'), 'low')
+        self.assertEquals(priority('/v1/a/c?extract-archive=tar',
+                                   method='PUT'), 'low')
+        self.assertEquals(priority(method='PUT', headers={
+            'X-Container-Sync-Key': 'secret'}), 'low')
+        self.assertEquals(priority(headers={
+            'User-Agent': 'Swift Container Sync 1.0'}), 'low')
+
+    def test_filter_factory(self):
+        mw = admission_control.filter_factory(
+            {}, target_delay='0.5', high_priority_methods='get')(self.app)
+        self.assertEquals(mw.thresholds,
+                          {'high': 1.0, 'normal': 0.5, 'low': 0.25})
+        self.assertEquals(mw.high_priority_methods, set(['GET']))
+        self.assertEquals(mw.min_in_flight, 32)
+
+
+if __name__ == '__main__':
+    unittest.main()
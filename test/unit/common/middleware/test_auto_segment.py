@@ -0,0 +1,329 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from cStringIO import StringIO
+from hashlib import md5
+
+from swift.common.middleware import auto_segment
+from swift.common.swob import Request, Response
+from swift.common.utils import json
+from test.unit import FakeLogger
+
+
+class FakeSwift(object):
+    """Stores objects in memory, reading bodies like the proxy does."""
+
+    def __init__(self):
+        self.objects = {}
+        self.containers = set()
+        self.calls = []
+        self.fail_paths = set()
+
+    def __call__(self, env, start_response):
+        req = Request(env)
+        path = req.path_info
+        self.calls.append((req.method, path, env.get('swift.source')))
+        if any(path.endswith(fail_path) for fail_path in self.fail_paths):
+            return Response(status=503)(env, start_response)
+        vrs, account, container, obj = req.split_path(3, 4, True)
+        if not obj:
+            if req.method == 'PUT':
+                self.containers.add(container)
+                return Response(status=201)(env, start_response)
+            status = 204 if container in self.containers else 404
+            return Response(status=status)(env, start_response)
+        if req.method == 'PUT':
+            body = ''
+            while True:
+                chunk = env['wsgi.input'].read(4)
+                if not chunk:
+                    break
+                body += chunk
+            if req.content_length is not None and \
+                    len(body) != req.content_length:
+                return Response(status=499)(env, start_response)
+            self.objects[path] = (dict(req.headers), body)
+            resp = Response(status=201, etag=md5(body).hexdigest(),
+                            headers={'Last-Modified':
+                                     'Fri, 01 Feb 2012 20:38:36 GMT'})
+            return resp(env, start_response)
+        if req.method == 'DELETE':
+            self.objects.pop(path, None)
+            return Response(status=204)(env, start_response)
+        return Response(status=405)(env, start_response)
+
+
+class TestAutoSegment(unittest.TestCase):
+
+    def setUp(self):
+        self.app = FakeSwift()
+        self.segmenter = auto_segment.filter_factory(
+            {}, segment_size='10', max_segments='3',
+            segment_chunked='true')(self.app)
+        self.segmenter.logger = FakeLogger()
+
+    def put(self, path, body, chunked=False, headers=None):
+        env = {'REQUEST_METHOD': 'PUT', 'wsgi.input': StringIO(body)}
+        if chunked:
+            env['HTTP_TRANSFER_ENCODING'] = 'chunked'
+        else:
+            env['CONTENT_LENGTH'] = str(len(body))
+        req = Request.blank(path, environ=env, headers=headers or {})
+        return req.get_response(self.segmenter)
+
+    def segments(self):
+        return sorted(path for path in self.app.objects
+                      if path.startswith('/v1/a/c_segments/'))
+
+    def test_small_put_passes_through(self):
+        resp = self.put('/v1/a/c/o', 'x' * 10)
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(self.app.calls, [('PUT', '/v1/a/c/o', None)])
+        self.assertEquals(self.app.objects['/v1/a/c/o'][1], 'x' * 10)
+
+    def test_large_put(self):
+        body = ''.join(chr(ord('a') + i) * 10 for i in xrange(2)) + 'c'
+        resp = self.put('/v1/a/c/o', body,
+                        headers={'X-Object-Meta-Color': 'blue',
+                                 'Content-Type': 'text/plain',
+                                 'Etag': md5(body).hexdigest()})
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(resp.etag, md5(body).hexdigest())
+        self.assertEquals(self.app.containers, set(['c_segments']))
+        segments = self.segments()
+        self.assertEquals(len(segments), 3)
+        self.assertEquals([self.app.objects[s][1] for s in segments],
+                          ['a' * 10, 'b' * 10, 'c'])
+        for path in segments:
+            headers = self.app.objects[path][0]
+            self.assertTrue(path.startswith('/v1/a/c_segments/o/'))
+            self.assertTrue('X-Object-Meta-Color' not in headers)
+            self.assertTrue('Etag' not in headers)
+        for method, path, source in self.app.calls:
+            self.assertEquals(source, 'AS' if path != '/v1/a/c/o' else None)
+
+        headers, manifest = self.app.objects['/v1/a/c/o']
+        self.assertEquals(headers['X-Static-Large-Object'], 'True')
+        self.assertEquals(headers['Content-Type'], 'text/plain;swift_bytes=21')
+        self.assertEquals(headers['X-Object-Meta-Color'], 'blue')
+        manifest = json.loads(manifest)
+        self.assertEquals([seg['name'] for seg in manifest],
+                          [path[len('/v1/a'):] for path in segments])
+        self.assertEquals([seg['bytes'] for seg in manifest], [10, 10, 1])
+        self.assertEquals(manifest[2]['hash'], md5('c').hexdigest())
+        self.assertEquals(manifest[0]['last_modified'],
+                          '2012-02-01T20:38:36.000000')
+
+    def test_chunked_put(self):
+        resp = self.put('/v1/a/c/o', 'x' * 15, chunked=True)
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals([self.app.objects[s][1] for s in self.segments()],
+                          ['x' * 10, 'x' * 5])
+        for path in self.segments():
+            self.assertEquals(
+                self.app.objects[path][0]['Transfer-Encoding'], 'chunked')
+        manifest = json.loads(self.app.objects['/v1/a/c/o'][1])
+        self.assertEquals([seg['bytes'] for seg in manifest], [10, 5])
+
+    def test_small_chunked_put(self):
+        for body in ('', 'x' * 10):
+            resp = self.put('/v1/a/c/o', body, chunked=True,
+                            headers={'Etag': md5(body).hexdigest()})
+            self.assertEquals(resp.status_int, 201)
+            self.assertEquals(self.segments(), [])
+            self.assertEquals(self.app.containers, set())
+            headers, stored = self.app.objects['/v1/a/c/o']
+            self.assertEquals(stored, body)
+            self.assertEquals(headers['Content-Length'], str(len(body)))
+            self.assertTrue('Transfer-Encoding' not in headers)
+            self.assertTrue('X-Static-Large-Object' not in headers)
+
+    def test_chunked_put_timeout(self):
+        class SlowInput(object):
+            def read(self, size=-1):
+                raise auto_segment.Timeout()
+
+        req = Request.blank('/v1/a/c/o', environ={
+            'REQUEST_METHOD': 'PUT', 'HTTP_TRANSFER_ENCODING': 'chunked',
+            'wsgi.input': SlowInput()})
+        resp = req.get_response(self.segmenter)
+        self.assertEquals(resp.status_int, 408)
+        self.assertEquals(self.app.calls, [])
+
+    def test_chunked_not_segmented_by_default(self):
+        segmenter = auto_segment.filter_factory(
+            {}, segment_size='10')(self.app)
+        resp = Request.blank('/v1/a/c/o', environ={
+            'REQUEST_METHOD': 'PUT', 'HTTP_TRANSFER_ENCODING': 'chunked',
+            'wsgi.input': StringIO('x' * 15)}).get_response(segmenter)
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(self.segments(), [])
+        self.assertEquals(self.app.objects['/v1/a/c/o'][1], 'x' * 15)
+
+    def test_segment_failure(self):
+        self.app.fail_paths.add('/00000001')
+        resp = self.put('/v1/a/c/o', 'x' * 25)
+        self.assertEquals(resp.status_int, 503)
+        self.assertEquals(self.segments(), [])
+        self.assertTrue('/v1/a/c/o' not in self.app.objects)
+
+    def test_manifest_failure_deletes_segments(self):
+        self.app.fail_paths.add('/v1/a/c/o')
+        resp = self.put('/v1/a/c/o', 'x' * 25)
+        self.assertEquals(resp.status_int, 503)
+        self.assertEquals(self.segments(), [])
+        deleted = [path for method, path, source in self.app.calls
+                   if method == 'DELETE']
+        self.assertEquals(len(deleted), 3)
+        self.assertEquals(
+            len(self.segmenter.logger.get_lines_for_level('info')), 1)
+
+    def test_etag_mismatch(self):
+        resp = self.put('/v1/a/c/o', 'x' * 25, headers={'Etag': 'bogus'})
+        self.assertEquals(resp.status_int, 422)
+        self.assertEquals(self.segments(), [])
+        self.assertTrue('/v1/a/c/o' not in self.app.objects)
+
+    def test_too_many_segments(self):
+        resp = self.put('/v1/a/c/o', 'x' * 35, chunked=True)
+        self.assertEquals(resp.status_int, 413)
+        self.assertEquals(self.segments(), [])
+        self.assertTrue('/v1/a/c/o' not in self.app.objects)
+
+    def test_client_disconnect(self):
+        env = {'REQUEST_METHOD': 'PUT', 'CONTENT_LENGTH': '30',
+               'wsgi.input': StringIO('x' * 25)}
+        resp = Request.blank('/v1/a/c/o', environ=env).get_response(
+            self.segmenter)
+        self.assertEquals(resp.status_int, 499)
+        self.assertEquals(self.segments(), [])
+
+    def test_client_read_error(self):
+        class BrokenInput(object):
+            def __init__(self, size):
+                self.data = StringIO('x' * size)
+
+            def read(self, size=-1):
+                data = self.data.read(size)
+                if not data:
+                    raise IOError('connection reset')
+                return data
+
+        # the segments started are deleted, including the one being read
+        for size, env, started in (
+                (15, {'CONTENT_LENGTH': '30'}, 2),
+                (15, {'HTTP_TRANSFER_ENCODING': 'chunked'}, 2),
+                (5, {'HTTP_TRANSFER_ENCODING': 'chunked'}, 0)):
+            self.app.calls = []
+            self.segmenter.logger = FakeLogger()
+            env.update({'REQUEST_METHOD': 'PUT',
+                        'wsgi.input': BrokenInput(size)})
+            resp = Request.blank('/v1/a/c/o', environ=env).get_response(
+                self.segmenter)
+            self.assertEquals(resp.status_int, 499)
+            self.assertEquals(self.segments(), [])
+            self.assertTrue('/v1/a/c/o' not in self.app.objects)
+            self.assertEquals(
+                len(self.segmenter.logger.log_dict['exception']), 1)
+            self.assertEquals(
+                len([path for method, path, source in self.app.calls
+                     if method == 'DELETE']), started)
+
+    def test_segment_failure_stops_upload(self):
+        segmenter = auto_segment.filter_factory(
+            {}, segment_size='10', max_segments='100')(self.app)
+        self.app.fail_paths.add('/00000000')
+        body = StringIO('x' * 995)
+        env = {'REQUEST_METHOD': 'PUT', 'CONTENT_LENGTH': '995',
+               'wsgi.input': body}
+        resp = Request.blank('/v1/a/c/o', environ=env).get_response(
+            segmenter)
+        self.assertEquals(resp.status_int, 503)
+        self.assertEquals(self.segments(), [])
+        # no more of the body was read once the first segment failed
+        self.assertTrue(body.tell() < 100)
+        puts = [path for method, path, source in self.app.calls
+                if method == 'PUT' and path.startswith('/v1/a/c_segments/')]
+        self.assertTrue(len(puts) < 10)
+
+    def test_container_failure(self):
+        self.app.fail_paths.add('/v1/a/c_segments')
+        resp = self.put('/v1/a/c/o', 'x' * 25)
+        self.assertEquals(resp.status_int, 503)
+        self.assertEquals(self.app.objects, {})
+
+    def test_should_segment(self):
+        def should_segment(path, method='PUT', length=11, headers=None):
+            req = Request.blank(path, environ={'REQUEST_METHOD': method},
+                                headers=headers or {})
+            req.content_length = length
+            return self.segmenter.should_segment(req)
+
+        self.assertTrue(should_segment('/v1/a/c/o'))
+        self.assertFalse(should_segment('/v1/a/c/o', length=10))
+        self.assertFalse(should_segment('/v1/a/c/o', method='POST'))
+        self.assertFalse(should_segment('/v1/a/c'))
+        self.assertFalse(should_segment('/v1/a/c/o?multipart-manifest=put'))
+        self.assertFalse(should_segment(
+            '/v1/a/c/o', headers={'X-Copy-From': 'c/o2'}))
+        self.assertFalse(should_segment(
+            '/v1/a/c/o', headers={'X-Object-Manifest': 'c/o_'}))
+        self.assertTrue(should_segment(
+            '/v1/a/c/o', length=None,
+            headers={'Transfer-Encoding': 'chunked'}))
+        self.segmenter.segment_chunked = False
+        self.assertFalse(should_segment(
+            '/v1/a/c/o', length=None,
+            headers={'Transfer-Encoding': 'chunked'}))
+
+    def test_bad_segment_size(self):
+        self.assertRaises(ValueError, auto_segment.AutoSegmentMiddleware,
+                          self.app, {'segment_size': '0'})
+
+
+class TestBufferedInput(unittest.TestCase):
+
+    def test_read(self):
+        buffered = auto_segment.BufferedInput('abc', StringIO('defg'))
+        self.assertEquals(buffered.read(2), 'ab')
+        self.assertEquals(buffered.read(2), 'c')
+        self.assertEquals(buffered.read(2), 'de')
+        self.assertEquals(buffered.read(), 'fg')
+        buffered = auto_segment.BufferedInput('abc', StringIO('defg'))
+        self.assertEquals(buffered.read(), 'abcdefg')
+
+
+class TestSegmentInput(unittest.TestCase):
+
+    def test_read(self):
+        seg_input = auto_segment.SegmentInput()
+        seg_input.put('abc')
+        seg_input.put('defg')
+        seg_input.put('')
+        self.assertEquals(seg_input.read(2), 'ab')
+        self.assertEquals(seg_input.read(2), 'cd')
+        self.assertEquals(seg_input.read(), 'efg')
+        self.assertEquals(seg_input.read(2), '')
+
+    def test_finish(self):
+        seg_input = auto_segment.SegmentInput(depth=1)
+        self.assertTrue(seg_input.put('abc'))
+        seg_input.finish()
+        self.assertFalse(seg_input.put('def'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import unittest
+
+import mock
+
+from swift.common.swob import Request, Response
+from swift.common.middleware import sampling_profiler
+from test.unit import FakeLogger
+
+
+class FakeApp(object):
+    def __call__(self, env, start_response):
+        req = Request(env)
+        return Response(request=req, body='FAKE APP')(
+            env, start_response)
+
+
+class TestStackSampler(unittest.TestCase):
+
+    def test_sample(self):
+        sampler = sampling_profiler.StackSampler()
+
+        def inner():
+            sampler.sample(signal.SIGPROF, sys._getframe())
+
+        def outer():
+            inner()
+
+        outer()
+        outer()
+        self.assertEquals(len(sampler.stacks), 1)
+        stack, count = sampler.stacks.items()[0]
+        self.assertEquals(count, 2)
+        frames = stack.split(';')
+        self.assertTrue(frames[-1].startswith('inner ('))
+        self.assertTrue(frames[-2].startswith('outer ('))
+        self.assertTrue(frames[-3].startswith('test_sample ('))
+        self.assertEquals(sampler.collapsed(), '%s 2\n' % stack)
+        sampler.reset()
+        self.assertEquals(sampler.collapsed(), '')
+
+    def test_start_stop(self):
+        sampler = sampling_profiler.StackSampler(0.001)
+        orig_handler = signal.getsignal(signal.SIGPROF)
+        try:
+            sampler.start()
+            self.assertTrue(sampler.running)
+            self.assertEquals(signal.getsignal(signal.SIGPROF),
+                              sampler.sample)
+            self.assertNotEquals(signal.getitimer(signal.ITIMER_PROF),
+                                 (0.0, 0.0))
+            sampler.stop()
+            self.assertFalse(sampler.running)
+            self.assertEquals(signal.getitimer(signal.ITIMER_PROF),
+                              (0.0, 0.0))
+            self.assertEquals(signal.getsignal(signal.SIGPROF),
+                              signal.SIG_DFL)
+            # stopping twice is harmless
+            sampler.stop()
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, orig_handler)
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.orig_usr2 = signal.getsignal(signal.SIGUSR2)
+        self.got_statuses = []
+        # no watcher greenthreads left behind by the tests
+        self.spawn_n_patcher = mock.patch.object(sampling_profiler, 'spawn_n')
+        self.spawn_n = self.spawn_n_patcher.start()
+
+    def tearDown(self):
+        self.spawn_n_patcher.stop()
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR2, self.orig_usr2)
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def get_app(self, **local_conf):
+        conf = {'log_dir': self.tempdir, 'log_name': 'test'}
+        conf.update(local_conf)
+        app = sampling_profiler.filter_factory({}, **conf)(FakeApp())
+        app.logger = FakeLogger()
+        return app
+
+    def start_response(self, status, headers):
+        self.got_statuses.append(status)
+
+    def request(self, app, path, remote_addr='127.0.0.1'):
+        req = Request.blank(path, environ={'REQUEST_METHOD': 'GET',
+                                           'REMOTE_ADDR': remote_addr})
+        return ''.join(app(req.environ, self.start_response))
+
+    def test_passthrough(self):
+        app = self.get_app()
+        self.assertEquals(self.request(app, '/'), 'FAKE APP')
+        self.assertEquals(self.request(app, '/__profile__x'), 'FAKE APP')
+        self.assertEquals(self.request(app, '/__profile__',
+                                       remote_addr='10.0.0.1'), 'FAKE APP')
+
+    def test_start_stop_over_http(self):
+        app = self.get_app()
+        body = self.request(app, '/__profile__/start')
+        self.assertEquals(body, 'Profiling %d\n' % os.getpid())
+        self.assertTrue(app.sampler.running)
+        app.sampler.stacks['a;b'] = 3
+        self.assertEquals(self.request(app, '/__profile__'), 'a;b 3\n')
+        self.request(app, '/__profile__/stop')
+        self.assertFalse(app.sampler.running)
+        path = os.path.join(self.tempdir, 'test.%d.collapsed' % os.getpid())
+        with open(path) as fp:
+            self.assertEquals(fp.read(), 'a;b 3\n')
+        self.request(app, '/__profile__/bogus')
+        self.assertEquals(self.got_statuses[-1], '404 Not Found')
+
+    def test_toggle_signal(self):
+        app = self.get_app()
+        # the handler is left to the workers, which install it on their
+        # first request
+        self.assertEquals(signal.getsignal(signal.SIGUSR2), signal.SIG_IGN)
+        self.request(app, '/')
+        self.request(app, '/')
+        self.assertEquals(self.spawn_n.call_args_list,
+                          [mock.call(app.watch_toggle)])
+        self.assertEquals(signal.getsignal(signal.SIGUSR2),
+                          app.request_toggle)
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertFalse(app.sampler.running)
+        app.check_toggle()
+        self.assertTrue(app.sampler.running)
+        app.check_toggle()
+        self.assertTrue(app.sampler.running)
+        os.kill(os.getpid(), signal.SIGUSR2)
+        app.check_toggle()
+        self.assertFalse(app.sampler.running)
+        self.assertTrue(os.path.exists(app.profile_file))
+
+    def test_toggle_error_logged(self):
+        app = self.get_app(log_dir=os.path.join(self.tempdir, 'file'))
+        open(app.log_dir, 'w').close()
+        app.toggle()
+        self.assertTrue(app.sampler.running)
+        app.toggle()
+        self.assertFalse(app.sampler.running)
+        self.assertEquals(len(app.logger.log_dict['exception']), 1)
+
+    def test_toggle_signal_config(self):
+        app = self.get_app(toggle_signal='')
+        self.request(app, '/')
+        self.assertEquals(signal.getsignal(signal.SIGUSR2), self.orig_usr2)
+        self.assertRaises(ValueError, self.get_app, toggle_signal='SIGBOGUS')
+
+
+if __name__ == '__main__':
+    unittest.main()
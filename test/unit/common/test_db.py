@@ -18,6 +18,7 @@
 import os
 import unittest
 from shutil import rmtree, copy
+from tempfile import mkdtemp
 from uuid import uuid4
 
 import simplejson
@@ -29,10 +30,12 @@ from eventlet.timeout import Timeout
 import swift.common.db
 from swift.common.db import chexor, dict_factory, get_db_connection, \
     DatabaseBroker, DatabaseConnectionError, DatabaseAlreadyExists, \
-    GreenDBConnection
+    GreenDBConnection, dirty_marker, mark_dirty
 from swift.common.utils import normalize_timestamp
 from swift.common.exceptions import LockTimeout
 
+from test.unit import FakeLogger
+
 
 class TestDatabaseConnectionError(unittest.TestCase):
 
@@ -81,6 +84,13 @@ class TestChexor(unittest.TestCase):
                           'd41d8cd98f00b204e9800998ecf8427e', None,
                           normalize_timestamp(1))
 
+    def test_utf8_name(self):
+        self.assertEquals(
+            chexor('d41d8cd98f00b204e9800998ecf8427e',
+                   '\xe2\x98\x83', normalize_timestamp(1)),
+            chexor('d41d8cd98f00b204e9800998ecf8427e',
+                   u'\u2603', normalize_timestamp(1)))
+
 
 class TestGreenDBConnection(unittest.TestCase):
 
@@ -145,6 +155,113 @@ class TestGetDBConnection(unittest.TestCase):
                              list((mock_db_cmd.call_args,) *
                                   mock_db_cmd.call_count))
 
+    def test_wal_mode(self):
+        testdir = mkdtemp()
+        db_file = os.path.join(testdir, '1.db')
+        try:
+            with patch('swift.common.db.DB_WAL', True):
+                conn = get_db_connection(db_file, okay_to_create=True)
+                conn.execute('CREATE TABLE test (one TEXT)')
+                conn.commit()
+                self.assertEquals(
+                    conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+                self.assertEquals(
+                    conn.execute('PRAGMA wal_autocheckpoint').fetchone()[0],
+                    swift.common.db.WAL_AUTOCHECKPOINT)
+            # the journal mode can't change while the DB is in use
+            conn2 = get_db_connection(db_file, timeout=0.1)
+            self.assertEquals(
+                conn2.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            conn.close()
+            conn2.close()
+            self.assertFalse(os.path.exists(db_file + '-wal'))
+            conn = get_db_connection(db_file)
+            self.assertEquals(
+                conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+        finally:
+            rmtree(testdir, ignore_errors=1)
+
+
+class TestDirtyTracking(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.datadir = os.path.join(self.testdir, 'sda', 'containers')
+        self.db_file = os.path.join(self.datadir, '7', 'abc',
+                                    'fedabc', 'fedabc.db')
+
+    def tearDown(self):
+        rmtree(self.testdir, ignore_errors=1)
+
+    def test_dirty_marker(self):
+        self.assertEquals(
+            dirty_marker(self.db_file),
+            os.path.join(self.testdir, 'sda', 'containers_dirty',
+                         '7-fedabc'))
+        self.assertEquals(dirty_marker(':memory:'), None)
+        self.assertEquals(
+            dirty_marker(os.path.join(self.testdir, 'sda', 'tmp', 'x.db')),
+            None)
+        self.assertEquals(
+            dirty_marker(os.path.join(self.datadir, '7', 'abc', 'fedabc',
+                                      'other.db')), None)
+        self.assertEquals(
+            dirty_marker(os.path.join(self.datadir, '7', 'def', 'fedabc',
+                                      'fedabc.db')), None)
+
+    def test_mark_dirty(self):
+        logger = FakeLogger()
+        marker = dirty_marker(self.db_file)
+        mark_dirty(self.db_file, logger)
+        self.assertFalse(os.path.exists(marker))
+        with patch('swift.common.db.DB_DIRTY_TRACKING', True):
+            mark_dirty(self.db_file, logger)
+            self.assertTrue(os.path.exists(marker))
+            # marking it again is fine
+            mark_dirty(self.db_file, logger)
+            self.assertTrue(os.path.exists(marker))
+        self.assertEquals(logger.log_dict['exception'], [])
+
+    def test_mark_dirty_error(self):
+        logger = FakeLogger()
+        # a file in the way of the dirty index
+        os.makedirs(os.path.join(self.testdir, 'sda'))
+        open(os.path.join(self.testdir, 'sda', 'containers_dirty'),
+             'w').close()
+        with patch('swift.common.db.DB_DIRTY_TRACKING', True):
+            mark_dirty(self.db_file, logger)
+        self.assertEquals(len(logger.log_dict['exception']), 1)
+
+    def test_broker_changes_mark_dirty(self):
+        marker = dirty_marker(self.db_file)
+        os.makedirs(os.path.dirname(self.db_file))
+        with patch('swift.common.db.DB_DIRTY_TRACKING', True):
+            broker = DatabaseBroker(self.db_file)
+            broker.db_type = 'test'
+            broker.db_contains_type = 'test'
+
+            def stub(*args):
+                pass
+            broker._initialize = stub
+            broker.initialize(normalize_timestamp('1'))
+            with broker.get() as conn:
+                conn.execute("""
+                    CREATE TABLE test_stat (
+                        put_timestamp TEXT, metadata TEXT DEFAULT '')""")
+                conn.execute("INSERT INTO test_stat (put_timestamp) "
+                             "VALUES ('1')")
+                conn.commit()
+            self.assertTrue(os.path.exists(marker))
+            os.unlink(marker)
+            broker.update_metadata({'X-Test': ('1', normalize_timestamp(2))})
+            self.assertTrue(os.path.exists(marker))
+            os.unlink(marker)
+            # nothing newer, nothing changed
+            broker.update_metadata({'X-Test': ('1', normalize_timestamp(2))})
+            self.assertFalse(os.path.exists(marker))
+            broker.update_put_timestamp(normalize_timestamp(3))
+            self.assertTrue(os.path.exists(marker))
+
 
 class TestDatabaseBroker(unittest.TestCase):
 
@@ -380,6 +497,68 @@ class TestDatabaseBroker(unittest.TestCase):
         with broker.lock():
             pass
 
+    def test_checkpoint(self):
+        db_file = os.path.join(self.testdir, '1.db')
+        broker = DatabaseBroker(db_file)
+        broker.db_type = 'test'
+
+        def _initialize(conn, timestamp):
+            conn.execute('CREATE TABLE test (one TEXT)')
+        broker._initialize = _initialize
+        broker.initialize(normalize_timestamp('1'))
+        # not in WAL mode
+        self.assertTrue(broker.checkpoint())
+        with patch('swift.common.db.DB_WAL', True):
+            broker = DatabaseBroker(db_file)
+            with broker.get() as conn:
+                conn.execute('INSERT INTO test (one) VALUES ("1")')
+                conn.commit()
+            wal_size = os.path.getsize(db_file + '-wal')
+            self.assertFalse(broker.checkpoint(wal_size + 1))
+            self.assertTrue(broker.checkpoint(wal_size))
+            # a copy of the DB file alone has the changes
+            copy(db_file, db_file + '.copy')
+            conn = sqlite3.connect(db_file + '.copy')
+            self.assertEquals(
+                conn.execute('SELECT one FROM test').fetchall(), [('1',)])
+            conn.close()
+
+            # readers of an older snapshot keep a checkpoint from completing
+            broker2 = DatabaseBroker(db_file)
+            with broker2.get() as conn2:
+                conn2.execute('BEGIN')
+                conn2.execute('SELECT * FROM test').fetchall()
+                with broker.get() as conn:
+                    conn.execute('INSERT INTO test (one) VALUES ("2")')
+                    conn.commit()
+                self.assertFalse(broker.checkpoint())
+            self.assertTrue(broker.checkpoint())
+
+    def test_disable_wal(self):
+        db_file = os.path.join(self.testdir, '1.db')
+        broker = DatabaseBroker(db_file)
+        broker.db_type = 'test'
+
+        def _initialize(conn, timestamp):
+            conn.execute('CREATE TABLE test (one TEXT)')
+        broker._initialize = _initialize
+        broker.initialize(normalize_timestamp('1'))
+        with patch('swift.common.db.DB_WAL', True):
+            broker = DatabaseBroker(db_file)
+            with broker.get() as conn:
+                conn.execute('INSERT INTO test (one) VALUES ("1")')
+                conn.commit()
+            self.assertTrue(os.path.exists(db_file + '-wal'))
+            self.assertTrue(broker.disable_wal())
+            self.assertFalse(os.path.exists(db_file + '-wal'))
+            self.assertFalse(os.path.exists(db_file + '-shm'))
+            os.rename(db_file, db_file + '.moved')
+        conn = sqlite3.connect(db_file + '.moved')
+        self.assertEquals(
+            conn.execute('SELECT one FROM test').fetchall(), [('1',)])
+        self.assertEquals(
+            conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+
     def test_newid(self):
         broker = DatabaseBroker(':memory:')
         broker.db_type = 'test'
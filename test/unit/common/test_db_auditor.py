@@ -0,0 +1,124 @@
+# Copyright (c) 2010-2012 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from swift.common.db_auditor import DatabaseCompactor
+from test.unit import FakeLogger
+
+
+class FakeBroker(object):
+    def __init__(self, path, free_ratio=0.5):
+        self.db_file = path
+        self.free_ratio = free_ratio
+        self.compacted = False
+
+    def get_free_ratio(self):
+        return self.free_ratio
+
+    def compact(self):
+        if os.path.basename(self.db_file).startswith('bad'):
+            raise ValueError
+        self.compacted = True
+        return 100
+
+
+class TestDatabaseCompactor(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.path = os.path.join(self.testdir, 'c.db')
+        with open(self.path, 'w') as f:
+            f.write(' ' * 10)
+
+    def tearDown(self):
+        rmtree(self.testdir, ignore_errors=1)
+
+    def compactor(self, **conf):
+        conf.setdefault('compaction_free_ratio', '0.25')
+        conf.setdefault('compaction_min_size', '0')
+        return DatabaseCompactor(conf, FakeLogger(), 'container')
+
+    def test_compact(self):
+        compactor = self.compactor()
+        broker = FakeBroker(self.path)
+        compactor.compact(broker)
+        self.assert_(broker.compacted)
+        self.assertEquals(compactor.compactions, 1)
+        self.assertEquals(compactor.compacted_bytes, 100)
+        self.assertEquals(compactor.logger.log_dict['increment'],
+                          [(('compactions',), {})])
+        self.assertEquals(compactor.logger.log_dict['update_stats'],
+                          [(('compacted_bytes', 100), {})])
+
+    def test_compact_skipped(self):
+        # compaction is off by default
+        compactor = DatabaseCompactor({}, FakeLogger(), 'container')
+        broker = FakeBroker(self.path)
+        compactor.compact(broker)
+        self.assertFalse(broker.compacted)
+        # not enough free pages
+        broker = FakeBroker(self.path, 0.2)
+        self.compactor().compact(broker)
+        self.assertFalse(broker.compacted)
+        # too small
+        broker = FakeBroker(self.path)
+        self.compactor(compaction_min_size='11').compact(broker)
+        self.assertFalse(broker.compacted)
+        # too big to hold up updates for while compacting
+        compactor = self.compactor(compaction_max_size='9')
+        compactor.compact(broker)
+        self.assertFalse(broker.compacted)
+        self.assertEquals(compactor.compactions, 0)
+
+    def test_compact_failure(self):
+        compactor = self.compactor()
+        path = os.path.join(self.testdir, 'bad.db')
+        with open(path, 'w') as f:
+            f.write(' ')
+        compactor.compact(FakeBroker(path))
+        self.assertEquals(compactor.compactions, 0)
+        self.assertEquals(len(compactor.logger.log_dict['exception']), 1)
+        self.assertEquals(compactor.logger.log_dict['increment'],
+                          [(('compaction_failures',), {})])
+        # a missing DB
+        compactor.compact(FakeBroker(os.path.join(self.testdir, 'gone.db')))
+        self.assertEquals(len(compactor.logger.log_dict['exception']), 2)
+
+    def test_report(self):
+        compactor = self.compactor()
+        compactor.compact(FakeBroker(self.path))
+        compactor.compact(FakeBroker(self.path))
+        self.assertEquals(compactor.report(0),
+                          {'container_compactions': 2,
+                           'container_compacted_bytes': 200})
+        self.assertEquals(
+            len(compactor.logger.get_lines_for_level('info')), 1)
+        self.assertEquals(compactor.report(0),
+                          {'container_compactions': 0,
+                           'container_compacted_bytes': 0})
+        # nothing is logged with compaction off
+        compactor = DatabaseCompactor({}, FakeLogger(), 'account')
+        self.assertEquals(compactor.report(0),
+                          {'account_compactions': 0,
+                           'account_compacted_bytes': 0})
+        self.assertEquals(compactor.logger.get_lines_for_level('info'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,16 +19,21 @@ import os
 import logging
 import errno
 import math
+import time
+import zlib
 from mock import patch
-from shutil import rmtree
+from shutil import rmtree, copyfile
 from tempfile import mkdtemp, NamedTemporaryFile
 import mock
 import simplejson
+from eventlet import sleep
 
 from swift.common import db_replicator
 from swift.common.utils import normalize_timestamp
 from swift.container import server as container_server
+from swift.container.backend import ContainerBroker
 from swift.common.exceptions import DriveNotMounted
+from swift.common.swob import HTTPServerError, Request
 
 from test.unit import FakeLogger
 
@@ -145,6 +150,41 @@ class ReplHttp:
         return Response()
 
 
+class LocalReplHttp(object):
+    """Sends REPLICATE calls straight to a ReplicatorRpc for a broker."""
+    host = 'remote'
+    node = {'device': 'sda1'}
+    partition = '0'
+
+    def __init__(self, broker, latency=0, sent=None):
+        self.broker = broker
+        self.latency = latency
+        self.rpc = db_replicator.ReplicatorRpc(
+            '/', '/', ContainerBroker, False)
+        self.sent = [] if sent is None else sent
+
+    def replicate(self, op, *args):
+        if self.latency:
+            sleep(self.latency)
+        if op == 'merge_items':
+            self.sent.extend(item['name'] for item in args[0])
+        resp = getattr(self.rpc, op)(self.broker, list(args))
+
+        class Response(object):
+            status = resp.status_int
+            data = resp.body
+        return Response()
+
+    def close(self):
+        pass
+
+
+def items(names, timestamp):
+    return [{'name': name, 'created_at': normalize_timestamp(timestamp),
+             'size': 0, 'content_type': 'text/plain', 'etag': 'etag',
+             'deleted': 0} for name in names]
+
+
 class ChangingMtimesOs:
     def __init__(self):
         self.mtime = 0
@@ -196,7 +236,10 @@ class FakeBroker:
         return {'delete_timestamp': 0, 'put_timestamp': 1, 'count': 0}
 
     def reclaim(self, item_timestamp, sync_timestamp):
-        pass
+        return 0, 0
+
+    def checkpoint(self, min_size=0):
+        return True
 
     def get_info(self):
         return self.info
@@ -257,6 +300,27 @@ class TestDBReplicator(unittest.TestCase):
         conn.request = other_req
         self.assertEquals(conn.replicate(1, 2, 3), None)
 
+    def test_repl_connection_compress(self):
+        node = {'replication_ip': '127.0.0.1', 'replication_port': 80,
+                'device': 'sdb1'}
+        conn = db_replicator.ReplConnection(node, '1234567890', 'abcdefg',
+                                            logging.getLogger(), True)
+        requests = []
+
+        def req(method, path, body, headers):
+            requests.append((body, headers))
+
+        class Resp:
+            def read(self):
+                return 'data'
+        conn.request = req
+        conn.getresponse = lambda *args: Resp()
+        conn.replicate('merge_items', [{'name': 'o'}], 'id')
+        body, headers = requests[0]
+        self.assertEquals(headers['Content-Encoding'], 'deflate')
+        self.assertEquals(simplejson.loads(zlib.decompress(body)),
+                          ['merge_items', [{'name': 'o'}], 'id'])
+
     def test_rsync_file(self):
         replicator = TestReplicator({})
         with _mock_process(-1):
@@ -391,6 +455,59 @@ class TestDBReplicator(unittest.TestCase):
                 replicator._rsync_db(broker, fake_device, ReplHttp(), 'abcd')
                 self.assertEquals(2, replicator._rsync_file_call_count)
 
+    def test_rsync_db_wal(self):
+        testdir = mkdtemp()
+        db_file = os.path.join(testdir, '1.db')
+        copies = []
+
+        class MyTestReplicator(TestReplicator):
+            def _rsync_file(self_, db_file, remote_file, whole_file=True):
+                copy_file = os.path.join(testdir, 'copy%d.db' % len(copies))
+                copyfile(db_file, copy_file)
+                copies.append((copy_file, whole_file))
+                return True
+
+        fake_device = {'ip': '127.0.0.1', 'replication_ip': '127.0.0.1',
+                       'device': 'sda1'}
+        try:
+            with patch('swift.common.db.DB_WAL', True):
+                broker = ContainerBroker(db_file, account='a', container='c')
+                broker.initialize(normalize_timestamp(1))
+                broker.put_object('o', normalize_timestamp(2), 0,
+                                  'text/plain', 'etag')
+                broker.get_info()
+                self.assertTrue(os.path.exists(db_file + '-wal'))
+                replicator = MyTestReplicator({})
+                self.assertTrue(replicator._rsync_db(
+                    broker, fake_device, ReplHttp(), 'abcd'))
+                # the write-ahead log was checkpointed before the db file
+                # was sent, so once was enough
+                self.assertEquals([whole_file for copy_file, whole_file
+                                   in copies], [True])
+                copy_broker = ContainerBroker(copies[0][0])
+                self.assertEquals(
+                    [row[0] for row in copy_broker.list_objects_iter(
+                        10, '', None, None, '')], ['o'])
+
+                # changes left in the write-ahead log are sent again under
+                # lock once checkpointed
+                del copies[:]
+                results = [False, True]
+                broker.checkpoint = lambda min_size=0: results.pop(0)
+                self.assertTrue(replicator._rsync_db(
+                    broker, fake_device, ReplHttp(), 'abcd'))
+                self.assertEquals([whole_file for copy_file, whole_file
+                                   in copies], [True, False])
+
+                # an unfinished checkpoint under lock fails the sync
+                del copies[:]
+                results = [False, False]
+                self.assertFalse(replicator._rsync_db(
+                    broker, fake_device, ReplHttp(), 'abcd'))
+                self.assertEquals(len(copies), 1)
+        finally:
+            rmtree(testdir, ignore_errors=1)
+
     def test_in_sync(self):
         replicator = TestReplicator({})
         self.assertEquals(replicator._in_sync(
@@ -410,11 +527,255 @@ class TestDBReplicator(unittest.TestCase):
         replicator = TestReplicator({})
         replicator.run_once()
 
+    def _dirty_dbs(self, root):
+        datadir = os.path.join(root, 'sda', 'containers')
+        db_files = []
+        for part, hsh in (('0', 'aaa'), ('1', 'bbbccc')):
+            db_file = os.path.join(datadir, part, hsh[-3:], hsh, hsh + '.db')
+            os.makedirs(os.path.dirname(db_file))
+            open(db_file, 'w').close()
+            db_files.append(db_file)
+        os.makedirs(datadir + '_dirty')
+        return datadir, db_files
+
+    def test_roundrobin_dirty(self):
+        root = mkdtemp()
+        try:
+            datadir, db_files = self._dirty_dbs(root)
+            dirty_dir = datadir + '_dirty'
+            # the second db is dirty, so is one that is gone
+            for marker in ('1-bbbccc', '2-dddeee'):
+                open(os.path.join(dirty_dir, marker), 'w').close()
+            self.assertEquals(
+                list(db_replicator.roundrobin_dirty([(datadir, 1)])),
+                [('1', db_files[1], 1)])
+            self.assertEquals(os.listdir(dirty_dir), [])
+            # no dirty index yet
+            self.assertEquals(list(db_replicator.roundrobin_dirty(
+                [(os.path.join(root, 'sdb', 'containers'), 2)])), [])
+        finally:
+            rmtree(root, ignore_errors=1)
+
+    def test_run_once_dirty_tracking(self):
+        root = mkdtemp()
+        try:
+            datadir, db_files = self._dirty_dbs(root)
+            dirty_dir = datadir + '_dirty'
+            replicator = TestReplicator({'devices': root,
+                                         'mount_check': 'false',
+                                         'db_dirty_tracking': 'true'})
+            replicator.ring.devs = [{'id': 1, 'device': 'sda',
+                                     'replication_ip': '127.0.0.1',
+                                     'replication_port': 1000}]
+            replicated = []
+            replicator._replicate_object = \
+                lambda part, object_file, node_id: \
+                replicated.append(object_file)
+            self._patch(patch.object, db_replicator, 'whataremyips',
+                        lambda: ['127.0.0.1'])
+            # the first pass is a full sweep, clearing the dirty index
+            open(os.path.join(dirty_dir, '1-bbbccc'), 'w').close()
+            replicator.run_once()
+            self.assertEquals(sorted(replicated), db_files)
+            self.assertEquals(os.listdir(dirty_dir), [])
+            # then only the changed dbs are replicated
+            del replicated[:]
+            replicator.run_once()
+            self.assertEquals(replicated, [])
+            open(os.path.join(dirty_dir, '0-aaa'), 'w').close()
+            replicator.run_once()
+            self.assertEquals(replicated, [db_files[0]])
+            self.assertEquals(os.listdir(dirty_dir), [])
+            # until the next full sweep is due
+            del replicated[:]
+            replicator.last_full_sweep -= replicator.full_sweep_interval
+            replicator.run_once()
+            self.assertEquals(sorted(replicated), db_files)
+        finally:
+            db_replicator.swift.common.db.DB_DIRTY_TRACKING = False
+            rmtree(root, ignore_errors=1)
+
     def test_usync(self):
         fake_http = ReplHttp()
         replicator = TestReplicator({})
         replicator._usync_db(0, FakeBroker(), fake_http, '12345', '67890')
 
+    def _usync_brokers(self, count):
+        local = ContainerBroker(':memory:', account='a', container='c')
+        local.initialize(normalize_timestamp(1))
+        local.merge_items(items(['o%04d' % i for i in xrange(count)], 2))
+        remote = ContainerBroker(':memory:', account='a', container='c')
+        remote.initialize(normalize_timestamp(1))
+        return local, remote
+
+    def _timed_usync(self, replicator, latency):
+        local, remote = self._usync_brokers(200)
+        http = LocalReplHttp(remote, latency)
+        replicator._http_connect = lambda *args: LocalReplHttp(
+            remote, latency, http.sent)
+        info = local.get_replication_info()
+        remote_id = remote.get_replication_info()['id']
+        start = time.time()
+        self.assertTrue(replicator._usync_db(-1, local, http, remote_id,
+                                             info['id']))
+        elapsed = time.time() - start
+        self.assertEquals(len(http.sent), 200)
+        self.assertEquals(remote.get_info()['object_count'], 200)
+        self.assertEquals(remote.get_sync(info['id']), info['max_row'])
+        self.assertEquals(local.get_sync(remote_id, incoming=False),
+                          info['max_row'])
+        return 200 / elapsed
+
+    def test_usync_pipelined(self):
+        # 20 batches over a link with a 20ms round trip
+        sequential = self._timed_usync(
+            TestReplicator({'per_diff': '10'}), 0.02)
+        pipelined = self._timed_usync(
+            TestReplicator({'per_diff': '10', 'usync_concurrency': '8'}),
+            0.02)
+        self.assertTrue(pipelined > 2 * sequential,
+                        'pipelined %.1f rows/s, sequential %.1f rows/s' %
+                        (pipelined, sequential))
+
+    def test_usync_pipelined_failure(self):
+        local, remote = self._usync_brokers(50)
+        http = LocalReplHttp(remote)
+        replicator = TestReplicator({'per_diff': '10',
+                                     'usync_concurrency': '4'})
+        replicator.logger = FakeLogger()
+        replicator._http_connect = lambda *args: LocalReplHttp(
+            remote, sent=http.sent)
+        calls = []
+        orig_merge_items = db_replicator.ReplicatorRpc.merge_items
+
+        def merge_items(rpc, broker, args):
+            calls.append(args)
+            if len(calls) == 2:
+                return HTTPServerError()
+            return orig_merge_items(rpc, broker, args)
+        info = local.get_replication_info()
+        with patch.object(db_replicator.ReplicatorRpc, 'merge_items',
+                          merge_items):
+            self.assertFalse(replicator._usync_db(
+                -1, local, http, 'remote', info['id']))
+        # the batches carried no source, nor was the sync point sent
+        self.assertEquals(remote.get_sync(info['id']), -1)
+        self.assertEquals(local.get_sync('remote', incoming=False), -1)
+        self.assertEquals(
+            len(replicator.logger.get_lines_for_level('error')), 1)
+
+    def test_usync_pipelined_capped(self):
+        local, remote = self._usync_brokers(50)
+        http = LocalReplHttp(remote)
+        replicator = TestReplicator({'per_diff': '10', 'max_diffs': '2',
+                                     'usync_concurrency': '4'})
+        replicator._http_connect = lambda *args: LocalReplHttp(
+            remote, sent=http.sent)
+        info = local.get_replication_info()
+        self.assertFalse(replicator._usync_db(
+            -1, local, http, 'remote', info['id']))
+        self.assertEquals(len(http.sent), 20)
+        # the next pass carries on from there
+        self.assertEquals(remote.get_sync(info['id']), 20)
+        self.assertEquals(replicator.stats['diff_capped'], 1)
+
+    def test_load_replicate_args(self):
+        args = ['merge_items', [{'name': 'o'}], 'id']
+        req = Request.blank('/sda1/0/abc', method='REPLICATE',
+                            body=simplejson.dumps(args))
+        self.assertEquals(db_replicator.load_replicate_args(req), args)
+        req = Request.blank('/sda1/0/abc', method='REPLICATE',
+                            body=zlib.compress(simplejson.dumps(args)),
+                            headers={'Content-Encoding': 'deflate'})
+        self.assertEquals(db_replicator.load_replicate_args(req), args)
+        req = Request.blank('/sda1/0/abc', method='REPLICATE',
+                            body=simplejson.dumps(args),
+                            headers={'Content-Encoding': 'deflate'})
+        self.assertRaises(ValueError, db_replicator.load_replicate_args, req)
+
+    def test_range_sync_db(self):
+        names = ['o%04d' % i for i in xrange(3000)]
+        local = ContainerBroker(':memory:', account='a', container='c')
+        local.initialize(normalize_timestamp(1))
+        local.merge_items(items(names, 2))
+        remote = ContainerBroker(':memory:', account='a', container='c')
+        remote.initialize(normalize_timestamp(1))
+        remote.merge_items(items(names[:100] + names[101:], 2) +
+                           items(['x'], 2))
+        local.merge_items(items(['o2000'], 3))
+        http = LocalReplHttp(remote)
+        replicator = TestReplicator({'per_diff': '10'})
+        info = local.get_replication_info()
+        remote_info = remote.get_replication_info()
+        self.assertTrue(replicator._range_sync_db(
+            local, http, remote_info['id'], info))
+        # only the rows in the three small ranges that differ were sent,
+        # including the one where the remote has an extra row
+        self.assertTrue('o0100' in http.sent)
+        self.assertTrue('o2000' in http.sent)
+        self.assertTrue('o2999' in http.sent)
+        self.assertTrue(len(http.sent) <= 3 * replicator.range_fanout)
+        self.assertEquals(
+            [item['name'] for item in remote.get_items_since(-1, 4000)
+             if item['name'] != 'x' and
+             item['created_at'] == normalize_timestamp(3)], ['o2000'])
+        self.assertEquals(remote.get_info()['object_count'], 3001)
+        self.assertEquals(remote.get_sync(info['id']), info['max_row'])
+        self.assertEquals(local.get_sync(remote_info['id'], incoming=False),
+                          info['max_row'])
+        self.assertEquals(replicator.stats['range_sync'], 1)
+
+        # only the range with the remote's extra row still differs
+        http.sent = []
+        self.assertTrue(replicator._range_sync_db(
+            local, http, remote_info['id'], info))
+        self.assertTrue(http.sent)
+        self.assertFalse([name for name in http.sent if name < 'o2900'])
+
+        # bad responses stop the sync
+        replicator.logger = FakeLogger()
+        local.merge_items(items(['o0001'], 4))
+        http.rpc.range_hashes = lambda broker, args: HTTPServerError()
+        self.assertFalse(replicator._range_sync_db(
+            local, http, remote_info['id'], local.get_replication_info()))
+        self.assertEquals(len(replicator.logger.get_lines_for_level('error')),
+                          1)
+
+    def test_range_sync_db_hash_rows(self):
+        names = ['o%04d' % i for i in xrange(1000)]
+        local = ContainerBroker(':memory:', account='a', container='c')
+        local.initialize(normalize_timestamp(1))
+        local.merge_items(items(names, 2))
+        remote = ContainerBroker(':memory:', account='a', container='c')
+        remote.initialize(normalize_timestamp(1))
+        remote.merge_items(items(names, 2))
+        local.merge_items(items(['o0500'], 3))
+        http = LocalReplHttp(remote)
+        hashed = []
+        orig_range_hashes = http.rpc.range_hashes
+
+        def range_hashes(broker, args):
+            self.assertEquals(args[1], 10)
+            resp = orig_range_hashes(broker, args)
+            hashed.append(sum(count for count, hsh in
+                              simplejson.loads(resp.body) if hsh))
+            return resp
+        http.rpc.range_hashes = range_hashes
+        replicator = TestReplicator({'per_diff': '10',
+                                     'range_hash_rows': '10'})
+        info = local.get_replication_info()
+        self.assertTrue(replicator._range_sync_db(
+            local, http, remote.get_replication_info()['id'], info))
+        # no call hashed more than range_hash_rows rows; the bigger ranges
+        # were split further instead
+        self.assertTrue(len(hashed) > 1)
+        self.assertTrue(max(hashed) <= 10)
+        self.assertTrue('o0500' in http.sent)
+        self.assertTrue(len(http.sent) <= 10)
+        self.assertEquals(
+            [item['name'] for item in remote.get_items_since(-1, 2000)
+             if item['created_at'] == normalize_timestamp(3)], ['o0500'])
+
     def test_stats(self):
         # I'm not sure how to test that this logs the right thing,
         # but we can at least make sure it gets covered.
@@ -429,6 +790,34 @@ class TestDBReplicator(unittest.TestCase):
         replicator._replicate_object('0', '/path/to/file', 'node_id')
         self.assertEquals([], self.delete_db_calls)
 
+    def test_replicate_object_marks_dirty_on_failure(self):
+        db_replicator.ring = FakeRingWithNodes()
+        replicator = TestReplicator({})
+        replicator.delete_db = self.stub_delete_db
+        marked = []
+        self._patch(patch.object, db_replicator, 'mark_dirty',
+                    lambda db_file, logger: marked.append(db_file))
+        replicator._repl_to_node = lambda *args: True
+        replicator._replicate_object('0', '/path/to/file', 1)
+        self.assertEquals(marked, [])
+        replicator._repl_to_node = lambda *args: False
+        replicator._replicate_object('0', '/path/to/file', 1)
+        self.assertEquals(marked, ['/path/to/file'])
+        self.assertEquals([], self.delete_db_calls)
+
+    def test_replicate_object_reclaim_stats(self):
+        db_replicator.ring = FakeRingWithNodes()
+        replicator = TestReplicator({})
+        replicator.delete_db = self.stub_delete_db
+        replicator.logger = FakeLogger()
+        self._patch(patch.object, replicator.brokerclass, 'reclaim',
+                    lambda *args: (3, 0.25))
+        replicator._replicate_object('0', '/path/to/file', 'node_id')
+        self.assertEquals(replicator.logger.log_dict['update_stats'],
+                          [(('reclaimed', 3), {})])
+        self.assertEquals(replicator.logger.log_dict['timing'],
+                          [(('reclaim.timing', 250), {})])
+
     def test_replicate_object_quarantine(self):
         replicator = TestReplicator({})
         self._patch(patch.object, replicator.brokerclass, 'db_file',
@@ -586,6 +975,98 @@ class TestDBReplicator(unittest.TestCase):
         rpc = db_replicator.ReplicatorRpc('/', '/', FakeBroker, False)
         rpc.rsync_then_merge('sda1', '/srv/swift/blah', ('a', 'b'))
 
+    def _rsynced_broker(self, root, local_id, objects):
+        tmp_file = os.path.join(root, 'sda1', 'tmp', local_id)
+        if not os.path.exists(os.path.dirname(tmp_file)):
+            os.makedirs(os.path.dirname(tmp_file))
+        broker = ContainerBroker(tmp_file, account='a', container='c')
+        broker.initialize(normalize_timestamp(1))
+        for obj in objects:
+            broker.put_object(obj, normalize_timestamp(2), 0,
+                              'text/plain', 'etag')
+        broker.get_info()
+        return tmp_file
+
+    def test_complete_rsync_wal(self):
+        root = mkdtemp()
+        db_file = os.path.join(root, 'sda1', 'containers', '0', '1.db')
+        os.makedirs(os.path.dirname(db_file))
+        try:
+            with patch('swift.common.db.DB_WAL', True):
+                self._rsynced_broker(root, 'remote', ['o1', 'o2'])
+                rpc = db_replicator.ReplicatorRpc(
+                    root, 'containers', ContainerBroker, False)
+                resp = rpc.complete_rsync('sda1', db_file, ['remote'])
+                self.assertEquals(resp.status_int, 204)
+                # the db left WAL mode before it was moved
+                self.assertFalse([name for name in os.listdir(
+                    os.path.join(root, 'sda1', 'tmp'))
+                    if name.startswith('remote-')])
+                broker = ContainerBroker(db_file)
+                self.assertEquals(broker.get_sync('remote'), 2)
+                self.assertEquals(
+                    [row[0] for row in broker.list_objects_iter(
+                        10, '', None, None, '')], ['o1', 'o2'])
+
+                # a db still in WAL mode is not moved
+                os.unlink(db_file)
+                tmp_file = self._rsynced_broker(root, 'remote2', ['o3'])
+                rpc.logger = FakeLogger()
+                with patch.object(ContainerBroker, 'disable_wal',
+                                  return_value=False):
+                    resp = rpc.complete_rsync('sda1', db_file, ['remote2'])
+                self.assertEquals(resp.status_int, 500)
+                self.assertTrue(os.path.exists(tmp_file))
+                self.assertFalse(os.path.exists(db_file))
+                self.assertEquals(
+                    len(rpc.logger.get_lines_for_level('error')), 1)
+        finally:
+            rmtree(root, ignore_errors=1)
+
+    def test_complete_rsync_marks_dirty(self):
+        root = mkdtemp()
+        db_file = os.path.join(root, 'sda1', 'containers', '0', 'abc',
+                               'fedabc', 'fedabc.db')
+        os.makedirs(os.path.dirname(db_file))
+        try:
+            with patch('swift.common.db.DB_DIRTY_TRACKING', True):
+                self._rsynced_broker(root, 'remote', ['o1'])
+                rpc = db_replicator.ReplicatorRpc(
+                    root, 'containers', ContainerBroker, False)
+                resp = rpc.complete_rsync('sda1', db_file, ['remote'])
+                self.assertEquals(resp.status_int, 204)
+                self.assertEquals(os.listdir(os.path.join(
+                    root, 'sda1', 'containers_dirty')), ['0-fedabc'])
+        finally:
+            rmtree(root, ignore_errors=1)
+
+    def test_rsync_then_merge_wal(self):
+        root = mkdtemp()
+        db_file = os.path.join(root, 'sda1', 'containers', '0', '1.db')
+        os.makedirs(os.path.dirname(db_file))
+        try:
+            with patch('swift.common.db.DB_WAL', True):
+                tmp_file = self._rsynced_broker(root, 'remote', ['o1', 'o2'])
+                broker = ContainerBroker(db_file, account='a', container='c')
+                broker.initialize(normalize_timestamp(1))
+                broker.put_object('o3', normalize_timestamp(2), 0,
+                                  'text/plain', 'etag')
+                # a server still has the db open
+                info = broker.get_info()
+                rpc = db_replicator.ReplicatorRpc(
+                    root, 'containers', ContainerBroker, False)
+                resp = rpc.rsync_then_merge('sda1', db_file, ['remote'])
+                self.assertEquals(resp.status_int, 204)
+                self.assertFalse(os.path.exists(tmp_file))
+                # the items were merged into the existing db
+                self.assertEquals(
+                    [row[0] for row in broker.list_objects_iter(
+                        10, '', None, None, '')], ['o1', 'o2', 'o3'])
+                self.assertEquals(broker.get_info()['id'], info['id'])
+                self.assertEquals(broker.get_sync('remote'), 2)
+        finally:
+            rmtree(root, ignore_errors=1)
+
     def test_merge_items(self):
         rpc = db_replicator.ReplicatorRpc('/', '/', FakeBroker, False)
         fake_broker = FakeBroker()
@@ -765,7 +1246,7 @@ class TestDBReplicator(unittest.TestCase):
         db_replicator.ReplConnection.assert_has_calls(
             mock.call(node, partition,
                       os.path.basename(db_file).split('.', 1)[0],
-                      replicator.logger))
+                      replicator.logger, False))
 
 
 class TestReplToNode(unittest.TestCase):
@@ -797,6 +1278,25 @@ class TestReplToNode(unittest.TestCase):
                       self.http, rinfo['id'], self.fake_info['id'])
         ])
 
+    def test_repl_to_node_range_sync(self):
+        rinfo = {"id": 3, "point": -1, "max_row": 8, "hash": "c"}
+        self.http = ReplHttp(simplejson.dumps(rinfo))
+        self.replicator.range_sync = True
+        self.replicator._range_sync_db = mock.Mock(return_value=True)
+        # a pass sends all the rows since the sync point
+        self.assertEquals(self.replicator._repl_to_node(
+            self.fake_node, self.broker, '0', self.fake_info), True)
+        self.assertEquals(self.replicator._range_sync_db.call_count, 0)
+        self.assertEquals(self.replicator._usync_db.call_count, 1)
+        # it doesn't
+        self.replicator.per_diff = 1
+        self.replicator.max_diffs = 4
+        self.assertEquals(self.replicator._repl_to_node(
+            self.fake_node, self.broker, '0', self.fake_info), True)
+        self.replicator._range_sync_db.assert_has_calls([
+            mock.call(self.broker, self.http, rinfo['id'], self.fake_info)])
+        self.assertEquals(self.replicator._usync_db.call_count, 1)
+
     def test_repl_to_node_rsync_success(self):
         rinfo = {"id": 3, "point": -1, "max_row": 4, "hash": "c"}
         self.http = ReplHttp(simplejson.dumps(rinfo))
@@ -0,0 +1,41 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for swift.common.request_helpers"""
+
+import unittest
+
+from swift.common import request_helpers as rh
+
+
+class TestRequestHelpers(unittest.TestCase):
+
+    def test_format_load_hint(self):
+        self.assertEquals(rh.format_load_hint(),
+                          'active=0 queued=0 replicating=0')
+        self.assertEquals(rh.format_load_hint(3, 2, 1),
+                          'active=3 queued=2 replicating=1')
+
+    def test_parse_load_hint(self):
+        self.assertEquals(rh.parse_load_hint(rh.format_load_hint(3, 2, 1)), 6)
+        self.assertEquals(rh.parse_load_hint('active=4'), 4)
+        self.assertEquals(rh.parse_load_hint(None), None)
+        self.assertEquals(rh.parse_load_hint(''), None)
+        self.assertEquals(rh.parse_load_hint('active'), None)
+        self.assertEquals(rh.parse_load_hint('active=lots'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
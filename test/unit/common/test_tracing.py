@@ -0,0 +1,163 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import socket
+import unittest
+from contextlib import nested
+
+import mock
+
+from swift.common import tracing
+from swift.common.utils import json
+from test.unit import temptree, FakeLogger
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_disabled_by_default(self):
+        tracer = tracing.Tracer({}, 'object-server')
+        self.assertFalse(tracer.enabled)
+        with mock.patch.object(tracer, '_emit') as emit:
+            tracer.record('tx1', 'disk.open', 1.0, 2.0)
+            with tracer.span('tx1', 'disk.write'):
+                pass
+        self.assertFalse(emit.called)
+
+    def test_record_to_file(self):
+        with temptree([]) as t:
+            path = os.path.join(t, 'spans')
+            tracer = tracing.Tracer({'trace_file': path}, 'object-server')
+            with mock.patch.object(tracing, 'spawn_after') as spawn_after:
+                tracer.record('tx1', 'disk.open', 1.0, 1.5, device='sda1')
+                tracer.record(None, 'disk.open', 1.0, 1.5)
+                with mock.patch('time.time', return_value=3.0):
+                    with tracer.span('tx1', 'disk.write', bytes=10):
+                        pass
+            # spans are buffered until the scheduled flush
+            self.assertFalse(os.path.exists(path))
+            self.assertEquals(spawn_after.call_args_list, [
+                mock.call(tracing.TRACE_FLUSH_INTERVAL, tracer.flush)])
+            tracer.flush()
+            with open(path) as fp:
+                spans = [json.loads(line) for line in fp]
+        self.assertEquals(len(spans), 2)
+        self.assertEquals(spans[0]['trans_id'], 'tx1')
+        self.assertEquals(spans[0]['server'], 'object-server')
+        self.assertEquals(spans[0]['pid'], os.getpid())
+        self.assertEquals(spans[0]['name'], 'disk.open')
+        self.assertEquals(spans[0]['start'], 1.0)
+        self.assertEquals(spans[0]['duration'], 0.5)
+        self.assertEquals(spans[0]['device'], 'sda1')
+        self.assertEquals(spans[1]['name'], 'disk.write')
+        self.assertEquals(spans[1]['duration'], 0)
+        self.assertEquals(spans[1]['bytes'], 10)
+
+    def test_flush_when_buffer_full(self):
+        with temptree([]) as t:
+            path = os.path.join(t, 'spans')
+            tracer = tracing.Tracer({'trace_file': path}, 'object-server')
+            with mock.patch.object(tracing, 'spawn_after'):
+                tracer.record('tx1', 'disk.open', 1.0, 1.5)
+                self.assertFalse(os.path.exists(path))
+                with mock.patch.object(tracing, 'TRACE_BUFFER_SIZE',
+                                       tracer.buffered + 1):
+                    tracer.record('tx1', 'disk.write', 1.0, 1.5)
+            with open(path) as fp:
+                self.assertEquals(len(fp.readlines()), 2)
+            self.assertEquals(tracer.buffer, [])
+
+    def test_errors_logged(self):
+        logger = FakeLogger()
+        tracer = tracing.Tracer({'trace_file': '/nonexistent/dir/spans',
+                                 'trace_udp_host': '10.0.0.1'},
+                                'object-server', logger)
+        with nested(
+                mock.patch.object(tracing, 'spawn_after'),
+                mock.patch('socket.socket')) as (_junk, fake_socket):
+            fake_socket.return_value.sendto.side_effect = \
+                socket.error(errno.ENETUNREACH, 'Network is unreachable')
+            tracer.record('tx1', 'GET', 1.0, 2.0)
+            tracer.flush()
+        errors = logger.get_lines_for_level('error')
+        self.assertEquals(len(errors), 2)
+        self.assertTrue('10.0.0.1:8126' in errors[0])
+        self.assertTrue('/nonexistent/dir/spans' in errors[1])
+
+    def test_span_records_on_exception(self):
+        tracer = tracing.Tracer({'trace_udp_host': '127.0.0.1'},
+                                'proxy-server')
+        with mock.patch.object(tracer, '_emit') as emit:
+            try:
+                with tracer.span('tx1', 'container_info'):
+                    raise ValueError()
+            except ValueError:
+                pass
+        self.assertEquals(emit.call_count, 1)
+        self.assertEquals(json.loads(emit.call_args[0][0])['name'],
+                          'container_info')
+
+    def test_record_to_udp(self):
+        tracer = tracing.Tracer({'trace_udp_host': '10.0.0.1',
+                                 'trace_udp_port': '9999'}, 'proxy-server')
+        with mock.patch('socket.socket') as fake_socket:
+            tracer.record('tx1', 'GET', 1.0, 2.0)
+        sendto = fake_socket.return_value.sendto
+        self.assertEquals(sendto.call_count, 1)
+        payload, target = sendto.call_args[0]
+        self.assertEquals(target, ('10.0.0.1', 9999))
+        self.assertEquals(json.loads(payload)['name'], 'GET')
+
+
+class TestWaterfall(unittest.TestCase):
+
+    def _span(self, name, start, duration, trans_id='tx1', **tags):
+        span = {'trans_id': trans_id, 'server': 'object-server',
+                'host': 'node1', 'pid': 1, 'name': name, 'start': start,
+                'duration': duration}
+        span.update(tags)
+        return json.dumps(span)
+
+    def test_load_spans(self):
+        file1 = [self._span('PUT', 10.0, 1.0),
+                 self._span('PUT', 10.0, 1.0, trans_id='tx2'),
+                 'garbage tx1\n']
+        file2 = [self._span('disk.write', 10.5, 0.25),
+                 self._span('disk.open', 10.0, 0.5)]
+        spans = tracing.load_spans([file1, file2], 'tx1')
+        self.assertEquals([s['name'] for s in spans],
+                          ['PUT', 'disk.open', 'disk.write'])
+
+    def test_format_waterfall(self):
+        spans = tracing.load_spans([[
+            self._span('PUT', 10.0, 1.0),
+            self._span('disk.fsync', 10.5, 0.5, device='sda1')]], 'tx1')
+        lines = tracing.format_waterfall(spans, width=10)
+        self.assertEquals(lines, [
+            '     0.00   1000.00 |##########| node1 object-server PUT',
+            '   500.00    500.00 |     #####| node1 object-server '
+            'disk.fsync device=sda1'])
+        self.assertEquals(tracing.format_waterfall([]), [])
+
+    def test_node_to_string(self):
+        self.assertEquals(
+            tracing.node_to_string({'ip': '1.2.3.4', 'port': 6000,
+                                    'device': 'sda1'}),
+            '1.2.3.4:6000/sda1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2172,6 +2172,8 @@ class TestStatsdLoggingDelegation(unittest.TestCase):
                         'some.counter')
         self.assertStat('some-name.some.operation:4900.0|ms',
                         self.logger.timing, 'some.operation', 4.9 * 1000)
+        self.assertStat('some-name.some.gauge:7|g',
+                        self.logger.gauge, 'some.gauge', 7)
         self.assertStatMatches('some-name\.another\.operation:\d+\.\d+\|ms',
                                self.logger.timing_since, 'another.operation',
                                time.time())
@@ -2414,6 +2416,13 @@ class TestThreadpool(unittest.TestCase):
             caught = True
         self.assertTrue(caught)
 
+    def test_pending(self):
+        tp = utils.ThreadPool(1)
+        self.assertEquals(tp.pending, 0)
+        pending = tp.run_in_thread(lambda: tp.pending)
+        self.assertEquals(pending, 1)
+        self.assertEquals(tp.pending, 0)
+
     def test_force_run_in_thread_with_threads(self):
         # with nthreads > 0, force_run_in_thread looks just like run_in_thread
         tp = utils.ThreadPool(1)
@@ -2567,6 +2576,22 @@ class TestGreenAsyncPile(unittest.TestCase):
         self.assertEqual(next(pile), None)
         self.assertRaises(StopIteration, lambda: next(pile))
 
+    def test_waitall(self):
+        def run_test(index):
+            events[index].wait()
+            return index
+
+        events = [eventlet.event.Event() for x in xrange(3)]
+        pile = utils.GreenAsyncPile(3)
+        for x in xrange(3):
+            pile.spawn(run_test, x)
+        events[1].send()
+        self.assertEqual(pile.waitall(0.01), [1])
+        events[0].send()
+        events[2].send()
+        self.assertEqual(sorted(pile.waitall(0.01)), [0, 2])
+        self.assertEqual(pile.waitall(0.01), [])
+
 
 if __name__ == '__main__':
     unittest.main()
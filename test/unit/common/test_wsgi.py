@@ -22,6 +22,7 @@ import socket
 import unittest
 import os
 import pickle
+import time
 from textwrap import dedent
 from gzip import GzipFile
 from contextlib import nested
@@ -30,17 +31,20 @@ from collections import defaultdict
 from contextlib import closing
 from urllib import quote
 
+import eventlet
 from eventlet import listen
+from eventlet.green import httplib
 
 import mock
 
 import swift.common.middleware.catch_errors
 import swift.proxy.server
 
-from swift.common.swob import Request
+from swift.common.swob import Request, Response
 from swift.common import wsgi, utils, ring
+from swift.common.utils import json
 
-from test.unit import temptree
+from test.unit import temptree, FakeLogger
 
 from mock import patch
 
@@ -352,6 +356,8 @@ class TestWSGI(unittest.TestCase):
         self.assertEquals(20, server_app.client_timeout)
         self.assert_(isinstance(server_logger, wsgi.NullLogger))
         self.assert_('custom_pool' in kwargs)
+        self.assertEquals(kwargs['protocol'], wsgi.SwiftHttpProtocol)
+        self.assertEquals(kwargs['keepalive'], True)
         self.assertEquals(1000, kwargs['custom_pool'].size)
 
     def test_run_server_conf_dir(self):
@@ -536,6 +542,154 @@ class TestWSGI(unittest.TestCase):
         self.assertEqual(calls['_global_conf_callback'], 1)
         self.assertEqual(calls['_loadapp'], 1)
 
+    def _run_wsgi_forking(self, conf, fork_pids):
+        """
+        Runs run_wsgi with the fork loop mocked out; the parent stops
+        waiting for its children at the first os.wait().
+        """
+        fake_logger = FakeLogger()
+        fake_logger.notice = fake_logger.info
+        sockets = []
+
+        def fake_get_socket(conf, default_port=8080, reuse_port=False):
+            sockets.append(mock.MagicMock(port=conf.get('bind_port'),
+                                          reuse_port=reuse_port))
+            return sockets[-1]
+
+        with nested(
+                mock.patch.object(wsgi, '_initrp',
+                                  return_value=(conf, fake_logger, 'name')),
+                mock.patch.object(wsgi, 'get_socket', fake_get_socket),
+                mock.patch.object(wsgi, 'get_ring_ports',
+                                  return_value=[6010, 6020]),
+                mock.patch.object(wsgi, 'drop_privileges'),
+                mock.patch.object(wsgi, 'loadapp'),
+                mock.patch.object(wsgi, 'capture_stdio'),
+                mock.patch.object(wsgi, 'run_server'),
+                mock.patch.object(wsgi.greenio, 'shutdown_safe'),
+                mock.patch('signal.signal'),
+                mock.patch('os.fork', side_effect=fork_pids),
+                mock.patch('os.wait', side_effect=KeyboardInterrupt)) as \
+                mocks:
+            wsgi.run_wsgi('conf_file', 'object-server',
+                          global_conf_callback=lambda c, g: g.update(x=1))
+        return sockets, dict(zip(
+            ('loadapp', 'run_server', 'fork'), (mocks[4], mocks[6], mocks[9])))
+
+    def test_run_wsgi_servers_per_port(self):
+        conf = {'__file__': 'test', 'workers': '8', 'servers_per_port': '2'}
+        sockets, mocks = self._run_wsgi_forking(conf, [101, 102, 103, 104])
+        self.assertEquals([sock.port for sock in sockets], [6010, 6020])
+        self.assertEquals(mocks['fork'].call_count, 4)
+        self.assertFalse(mocks['run_server'].called)
+        for sock in sockets:
+            self.assertTrue(sock.close.called)
+
+    def test_run_wsgi_child_gets_global_conf(self):
+        conf = {'__file__': 'test', 'workers': '2'}
+        sockets, mocks = self._run_wsgi_forking(conf, [0])
+        self.assertEquals(len(sockets), 1)
+        run_server = mocks['run_server']
+        self.assertEquals(run_server.call_count, 1)
+        self.assertEquals(run_server.call_args[0][2], sockets[0])
+        self.assertEquals(run_server.call_args[1]['global_conf'],
+                          {'log_name': 'name', 'x': 1})
+        # without preload_app the workers load their own app
+        self.assertEquals(run_server.call_args[1]['app'], None)
+
+    def test_run_wsgi_reuse_port(self):
+        conf = {'__file__': 'test', 'workers': '3', 'reuse_port': 'yes'}
+        sockets, mocks = self._run_wsgi_forking(conf, [101, 102, 103])
+        self.assertEquals(len(sockets), 3)
+        self.assertEquals(len(set(sockets)), 3)
+        for sock in sockets:
+            self.assertTrue(sock.reuse_port)
+            self.assertTrue(sock.close.called)
+        self.assertEquals(mocks['fork'].call_count, 3)
+
+        # each worker accepts on its own socket
+        sockets, mocks = self._run_wsgi_forking(conf, [101, 0])
+        run_server = mocks['run_server']
+        self.assertEquals(run_server.call_args[0][2], sockets[1])
+        self.assertEquals(run_server.call_args[1]['worker_index'], 1)
+
+        conf = {'__file__': 'test', 'workers': '3'}
+        sockets, mocks = self._run_wsgi_forking(conf, [101, 102, 0])
+        self.assertEquals(len(sockets), 1)
+        self.assertFalse(sockets[0].reuse_port)
+        run_server = mocks['run_server']
+        self.assertEquals(run_server.call_args[0][2], sockets[0])
+        self.assertEquals(run_server.call_args[1]['worker_index'], 2)
+
+    def test_get_socket_reuse_port(self):
+        conf = {'bind_ip': '127.0.0.1', 'bind_port': 0}
+        sock1 = wsgi.get_socket(conf, reuse_port=True)
+        try:
+            conf['bind_port'] = sock1.getsockname()[1]
+            sock2 = wsgi.get_socket(conf, reuse_port=True)
+            self.assertEquals(sock2.getsockname(), sock1.getsockname())
+            sock2.close()
+        finally:
+            sock1.close()
+
+    def test_run_server_reports_worker_stats(self):
+        logger = FakeLogger()
+        with nested(
+                mock.patch.object(wsgi, 'wsgi'),
+                mock.patch.object(wsgi, 'eventlet')) as (_wsgi, _eventlet):
+            wsgi.run_server({}, logger, 'sock', app=object(),
+                            worker_index=2)
+        self.assertEquals(_eventlet.spawn.call_args,
+                          mock.call(wsgi._report_worker_stats, logger, 2,
+                                    10.0))
+        self.assertTrue(_eventlet.spawn.return_value.kill.called)
+
+        with nested(
+                mock.patch.object(wsgi, 'wsgi'),
+                mock.patch.object(wsgi, 'eventlet')) as (_wsgi, _eventlet):
+            wsgi.run_server({}, logger, 'sock', app=object())
+        self.assertFalse(_eventlet.spawn.called)
+
+    def test_run_wsgi_preload_app(self):
+        conf = {'__file__': 'test', 'workers': '2', 'preload_app': 'yes'}
+        sockets, mocks = self._run_wsgi_forking(conf, [0])
+        loadapp = mocks['loadapp']
+        self.assertEquals(loadapp.call_count, 1)
+        self.assertEquals(loadapp.call_args,
+                          mock.call('test', global_conf={'log_name': 'name',
+                                                         'x': 1}))
+        self.assertEquals(mocks['run_server'].call_args[1]['app'],
+                          loadapp.return_value)
+
+    def test_run_server_preloaded_app(self):
+        app = object()
+        with nested(
+                mock.patch.object(wsgi, 'wsgi'),
+                mock.patch.object(wsgi, 'eventlet'),
+                mock.patch.object(wsgi, 'loadapp')) as (
+                _wsgi, _eventlet, loadapp):
+            wsgi.run_server({}, FakeLogger(), 'sock', app=app)
+        self.assertFalse(loadapp.called)
+        self.assertEquals(_wsgi.server.call_args[0][:2], ('sock', app))
+
+    def test_get_ring_ports(self):
+        devs = [{'ip': '10.0.0.1', 'port': 6010},
+                {'ip': '10.0.0.1', 'port': 6020},
+                None,
+                {'ip': '10.0.0.1', 'port': 6010},
+                {'ip': '10.0.0.2', 'port': 6030}]
+        with nested(
+                mock.patch.object(wsgi, 'Ring'),
+                mock.patch.object(wsgi, 'whataremyips',
+                                  return_value=['10.0.0.1'])) as (
+                fake_ring, _junk):
+            fake_ring.return_value.devs = devs
+            self.assertEquals(wsgi.get_ring_ports({}), [6010, 6020])
+            self.assertEquals(fake_ring.call_args,
+                              mock.call('/etc/swift', ring_name='object'))
+            self.assertEquals(
+                wsgi.get_ring_ports({'bind_ip': '10.0.0.2'}), [6030])
+
     def test_pre_auth_req_with_empty_env_no_path(self):
         r = wsgi.make_pre_authed_request(
             {}, 'GET')
@@ -597,5 +751,289 @@ class TestWSGIContext(unittest.TestCase):
         self.assertEquals(''.join(it), 'Ok\n')
 
 
+class TestSwiftHttpProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_limits = (wsgi.SwiftHttpProtocol.keepalive_timeout,
+                            wsgi.SwiftHttpProtocol.max_requests_per_connection)
+        self.orig_stats = wsgi.SwiftHttpProtocol.stats
+        self.sock = listen(('localhost', 0))
+        self.server = None
+        self.environs = []
+
+    def tearDown(self):
+        (wsgi.SwiftHttpProtocol.keepalive_timeout,
+         wsgi.SwiftHttpProtocol.max_requests_per_connection) = \
+            self.orig_limits
+        wsgi.SwiftHttpProtocol.stats = self.orig_stats
+        if self.server:
+            self.server.kill()
+        self.sock.close()
+
+    def _serve(self, body_iter=None):
+        def app(env, start_response):
+            self.environs.append(env)
+            if env['PATH_INFO'] == '/chunked':
+                resp = Response(app_iter=body_iter or iter(['abc', 'def']))
+            else:
+                resp = Response(body='hello')
+            return resp(env, start_response)
+
+        self.server = eventlet.spawn(
+            eventlet.wsgi.server, self.sock, app, wsgi.NullLogger(),
+            protocol=wsgi.SwiftHttpProtocol)
+        conn = httplib.HTTPConnection('localhost',
+                                      self.sock.getsockname()[1])
+        conn.auto_open = 0
+        conn.connect()
+        return conn
+
+    def _get(self, conn, path='/'):
+        conn.request('GET', path)
+        resp = conn.getresponse()
+        return resp, resp.read()
+
+    def test_worker_stats(self):
+        stats = wsgi.WorkerStats()
+        stats.accepted = 5
+        stats.connections = 2
+        stats.requests = 1
+        logger = FakeLogger()
+        stats.report(logger, 3)
+        stats.accepted = 7
+        stats.report(logger, 3)
+        self.assertEquals(logger.log_dict['update_stats'],
+                          [(('workers.3.accepted', 5), {}),
+                           (('workers.3.accepted', 2), {})])
+        self.assertEquals(logger.log_dict['gauge'][:2],
+                          [(('workers.3.connections', 2), {}),
+                           (('workers.3.requests', 1), {})])
+
+    def test_keepalive(self):
+        stats = wsgi.SwiftHttpProtocol.stats = wsgi.WorkerStats()
+        conn = self._serve()
+        resp, body = self._get(conn)
+        self.assertEquals(body, 'hello')
+        self.assertFalse(resp.will_close)
+        resp, body = self._get(conn, '/chunked')
+        self.assertEquals(resp.getheader('transfer-encoding'), 'chunked')
+        self.assertEquals(body, 'abcdef')
+        self.assertFalse(resp.will_close)
+        resp, body = self._get(conn)
+        self.assertEquals(body, 'hello')
+        self.assertEquals(stats.accepted, 1)
+        self.assertEquals(stats.connections, 1)
+        self.assertEquals(stats.requests, 0)
+        conn.close()
+        eventlet.sleep(0.01)
+        self.assertEquals(stats.connections, 0)
+
+    def test_request_received(self):
+        conn = self._serve()
+        before = time.time()
+        # the connection is accepted as soon as the server gets to run
+        eventlet.sleep(0.05)
+        self._get(conn)
+        after_first = time.time()
+        self._get(conn)
+        # the first request counts from when the connection was accepted
+        first, second = [env['swift.request_received']
+                         for env in self.environs]
+        self.assertTrue(before <= first < before + 0.04)
+        self.assertTrue(after_first <= second)
+
+    def test_max_requests_per_connection(self):
+        wsgi.SwiftHttpProtocol.max_requests_per_connection = 2
+        conn = self._serve()
+        resp, body = self._get(conn)
+        self.assertFalse(resp.will_close)
+        resp, body = self._get(conn)
+        self.assertEquals(body, 'hello')
+        self.assertTrue(resp.will_close)
+        self.assertRaises(httplib.NotConnected, conn.request, 'GET', '/')
+
+    def test_keepalive_timeout(self):
+        wsgi.SwiftHttpProtocol.keepalive_timeout = 0.01
+        conn = self._serve()
+        resp, body = self._get(conn)
+        self.assertEquals(body, 'hello')
+        eventlet.sleep(0.1)
+        self.assertEquals(conn.sock.recv(1), '')
+
+    def test_failed_chunked_response_closes(self):
+        def body_iter():
+            yield 'x' * 65536
+            raise ValueError('backend went away')
+
+        conn = self._serve(body_iter())
+        conn.request('GET', '/chunked')
+        resp = conn.getresponse()
+        # the body is cut short, not terminated as if it were complete
+        self.assertRaises(httplib.IncompleteRead, resp.read)
+
+
+class TestPipelineTiming(unittest.TestCase):
+
+    def setUp(self):
+        utils.HASH_PATH_PREFIX = 'startcap'
+
+    def test_stage_time_excludes_downstream(self):
+        clock = [100.0]
+
+        def tick(seconds):
+            clock[0] += seconds
+
+        def inner_app(env, start_response):
+            tick(2)
+            start_response('200 OK', [])
+            return iter(['', 'body'])
+
+        def outer_app(env, start_response):
+            tick(1)
+            resp = stats_app(env, start_response)
+            tick(1)
+            return resp
+
+        logger = FakeLogger()
+        stats = wsgi.PipelineTimingStats({}, logger)
+        outer_name = stats.add_stage('outer')
+        inner_name = stats.add_stage('inner')
+        stats_app = wsgi.PipelineStageTimer(inner_app, inner_name, stats)
+        app = wsgi.PipelineStageTimer(outer_app, outer_name, stats)
+        with mock.patch('swift.common.wsgi.time.time', lambda: clock[0]):
+            resp = app({}, lambda *args: None)
+            self.assertEquals(list(resp), ['', 'body'])
+            resp.close()
+            resp.close()
+        self.assertEquals(stats.stages, ['outer', 'inner'])
+        self.assertEquals(stats.totals['outer']['requests'], 1)
+        self.assertEquals(stats.totals['outer']['time'], 2.0)
+        self.assertEquals(stats.totals['inner']['time'], 2.0)
+        # the first byte is yielded after outer_app has returned
+        self.assertEquals(stats.totals['outer']['first_byte_time'], 4.0)
+        self.assertEquals(stats.totals['inner']['first_byte_time'], 3.0)
+        timings = sorted(args for args, kwargs in logger.log_dict['timing'])
+        self.assertEquals(timings, [
+            ('pipeline.inner.first-byte.timing', 3000.0),
+            ('pipeline.inner.timing', 2000.0),
+            ('pipeline.outer.first-byte.timing', 4000.0),
+            ('pipeline.outer.timing', 2000.0)])
+
+    def test_stage_records_exceptions(self):
+        def broken_app(env, start_response):
+            raise ValueError('oops')
+
+        stats = wsgi.PipelineTimingStats({}, FakeLogger())
+        app = wsgi.PipelineStageTimer(broken_app, stats.add_stage('x'), stats)
+        self.assertRaises(ValueError, app, {}, lambda *args: None)
+        self.assertEquals(stats.totals['x']['requests'], 1)
+        self.assertEquals(stats.totals['x']['first_byte_requests'], 0)
+
+    def test_stage_records_without_close(self):
+        class AppIter(object):
+            def __iter__(self):
+                return iter(['body'])
+
+            def app_iter_range(self, start, stop):
+                return ['od']
+
+        stats = wsgi.PipelineTimingStats({}, FakeLogger())
+        app = wsgi.PipelineStageTimer(lambda env, start_response: AppIter(),
+                                      stats.add_stage('x'), stats)
+        resp = app({}, lambda *args: None)
+        self.assertEquals(resp.app_iter_range(1, 3), ['od'])
+        # a filter above that never calls close()
+        self.assertEquals(list(resp), ['body'])
+        self.assertEquals(stats.totals['x']['requests'], 1)
+        self.assertEquals(stats.totals['x']['first_byte_requests'], 1)
+        resp.close()
+        self.assertEquals(stats.totals['x']['requests'], 1)
+
+    def test_add_stage_unique_names(self):
+        stats = wsgi.PipelineTimingStats({}, FakeLogger())
+        self.assertEquals(stats.add_stage('proxy-logging'), 'proxy-logging')
+        self.assertEquals(stats.add_stage('proxy-logging'),
+                          'proxy-logging_2')
+        self.assertEquals(stats.stages, ['proxy-logging', 'proxy-logging_2'])
+
+    def test_loadapp_with_pipeline_timing(self):
+        config = """
+        [DEFAULT]
+        swift_dir = TEMPDIR
+
+        [pipeline:main]
+        pipeline = catch_errors healthcheck proxy-logging proxy-logging \
+            proxy-server
+
+        [app:proxy-server]
+        use = egg:swift#proxy
+
+        [filter:catch_errors]
+        use = egg:swift#catch_errors
+
+        [filter:healthcheck]
+        use = egg:swift#healthcheck
+
+        [filter:proxy-logging]
+        use = egg:swift#proxy_logging
+        """
+        contents = dedent(config)
+        with temptree(['proxy-server.conf']) as t:
+            conf_file = os.path.join(t, 'proxy-server.conf')
+            with open(conf_file, 'w') as f:
+                f.write(contents.replace('TEMPDIR', t))
+            _fake_rings(t)
+            conf = wsgi.appconfig(conf_file)
+            app = wsgi.loadapp_with_pipeline_timing(
+                conf_file, {'log_name': 'proxy-server'}, conf,
+                logger=FakeLogger())
+        self.assert_(isinstance(app, wsgi.PipelineTimingEndpoint))
+        stats = app.stats
+        self.assertEquals(stats.stages, [
+            'catch_errors', 'healthcheck', 'proxy-logging',
+            'proxy-logging_2', 'proxy-server'])
+        self.assert_(isinstance(
+            app.app.app, swift.common.middleware.catch_errors.
+            CatchErrorMiddleware))
+
+        resp = Request.blank('/healthcheck').get_response(app)
+        self.assertEquals(resp.body, 'OK')
+        self.assertEquals(stats.totals['catch_errors']['requests'], 1)
+        self.assertEquals(stats.totals['healthcheck']['requests'], 1)
+        self.assertEquals(stats.totals['proxy-logging']['requests'], 0)
+
+        req = Request.blank('/debug/pipeline_timing',
+                            environ={'REMOTE_ADDR': '10.0.0.1'})
+        resp = req.get_response(app)
+        self.assertNotEquals(resp.content_type, 'application/json')
+        self.assertTrue('Service Unavailable' in resp.body)
+
+        req = Request.blank('/debug/pipeline_timing',
+                            environ={'REMOTE_ADDR': '127.0.0.1'})
+        resp = req.get_response(app)
+        self.assertEquals(resp.status_int, 200)
+        info = json.loads(resp.body)
+        self.assertEquals(info['pid'], os.getpid())
+        self.assertEquals([stage['name'] for stage in info['stages']],
+                          stats.stages)
+        self.assertEquals(info['stages'][1]['requests'], 2)
+
+    def test_run_server_pipeline_timing(self):
+        conf = {'__file__': 'conf_file', 'pipeline_timing': 'yes'}
+        with nested(
+                patch('swift.common.wsgi.wsgi'),
+                patch('swift.common.wsgi.eventlet'),
+                patch.object(wsgi, 'loadapp'),
+                patch.object(wsgi, 'loadapp_with_pipeline_timing')) as \
+                (_wsgi, _eventlet, _loadapp, _timed_loadapp):
+            wsgi.run_server(conf, logging.getLogger('test'), 'sock',
+                            global_conf={'log_name': 'test'})
+        self.assertFalse(_loadapp.called)
+        _timed_loadapp.assert_called_once_with(
+            'conf_file', {'log_name': 'test'}, conf)
+        args, kwargs = _wsgi.server.call_args
+        self.assertEquals(args[1], _timed_loadapp.return_value)
+
+
 if __name__ == '__main__':
     unittest.main()
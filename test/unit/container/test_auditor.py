@@ -40,6 +40,17 @@ class FakeContainerBroker(object):
         if self.file.startswith('true'):
             return 'ok'
 
+    def checkpoint(self):
+        return True
+
+    def get_free_ratio(self):
+        return 0.5
+
+    def compact(self):
+        if self.file.startswith('bad'):
+            raise ValueError
+        return 100
+
 
 class TestAuditor(unittest.TestCase):
 
@@ -117,5 +128,20 @@ class TestAuditor(unittest.TestCase):
         self.assertEquals(test_auditor.container_failures, 2)
         self.assertEquals(test_auditor.container_passes, 3)
 
+    @mock.patch('swift.container.auditor.ContainerBroker', FakeContainerBroker)
+    def test_container_auditor_compaction(self):
+        conf = {'compaction_free_ratio': '0.25', 'compaction_min_size': '0'}
+        test_auditor = auditor.ContainerAuditor(conf)
+        test_auditor.logger = test_auditor.compactor.logger = FakeLogger()
+        files = os.listdir(self.testdir)
+        for f in files:
+            path = os.path.join(self.testdir, f)
+            test_auditor.container_audit(path)
+        self.assertEquals(test_auditor.container_passes, 3)
+        self.assertEquals(test_auditor.compactor.compactions, 3)
+        self.assertEquals(test_auditor.compactor.report(0),
+                          {'container_compactions': 3,
+                           'container_compacted_bytes': 300})
+
 if __name__ == '__main__':
     unittest.main()
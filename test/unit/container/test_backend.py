@@ -16,10 +16,14 @@
 """ Tests for swift.container.backend """
 
 import hashlib
+import os
 import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
 from time import sleep, time
 from uuid import uuid4
 
+import swift.common.db
 from swift.container.backend import ContainerBroker
 from swift.common.utils import normalize_timestamp
 
@@ -125,6 +129,61 @@ class TestContainerBroker(unittest.TestCase):
         broker.reclaim(normalize_timestamp(time()), time())
         broker.delete_db(normalize_timestamp(time()))
 
+    def test_reclaim_batches(self):
+        # not in memory, as the DB is closed when reclaim raises
+        tempdir = mkdtemp()
+        self.addCleanup(rmtree, tempdir)
+        broker = ContainerBroker(os.path.join(tempdir, 'c.db'),
+                                 account='a', container='c')
+        broker.initialize(normalize_timestamp('1'))
+        for name in 'abcdefg':
+            broker.delete_object(name, normalize_timestamp(2))
+        broker.delete_object('h', normalize_timestamp(4))
+        broker.put_object('i', normalize_timestamp(2), 5, 'text/plain', 'x')
+
+        def names():
+            with broker.get() as conn:
+                return ''.join(row[0] for row in conn.execute(
+                    'SELECT name FROM object ORDER BY name'))
+
+        def reclaim_point():
+            with broker.get() as conn:
+                return conn.execute(
+                    'SELECT reclaim_point FROM container_stat').fetchone()[0]
+
+        # an interrupted reclaim carries on where it stopped
+        real_reclaim_items = broker._reclaim_items
+        calls = []
+
+        def fail_second_batch(conn, rows):
+            calls.append([row['name'] for row in rows])
+            if calls == [['a', 'b', 'c'], ['d', 'e', 'f']]:
+                raise Exception('test')
+            return real_reclaim_items(conn, rows)
+
+        broker._reclaim_items = fail_second_batch
+        self.assertRaises(Exception, broker.reclaim, normalize_timestamp(3),
+                          normalize_timestamp(3), batch_size=3)
+        self.assertEquals(calls, [['a', 'b', 'c'], ['d', 'e', 'f']])
+        self.assertEquals(names(), 'defghi')
+        self.assertEquals(reclaim_point(), 'c')
+        del calls[:]
+        self.assertEquals(
+            broker.reclaim(normalize_timestamp(3), normalize_timestamp(3),
+                           batch_size=3)[0], 4)
+        self.assertEquals(calls, [['d', 'e', 'f'], ['g']])
+        self.assertEquals(names(), 'hi')
+        self.assertEquals(reclaim_point(), '')
+        info = broker.get_info()
+        self.assertEquals(info['object_count'], 1)
+        self.assertEquals(info['bytes_used'], 5)
+        hash_ = '00000000000000000000000000000000'
+        for name, timestamp in (('h', normalize_timestamp(4)),
+                                ('i', normalize_timestamp(2))):
+            hash_ = '%032x' % (int(hash_, 16) ^ int(hashlib.md5(
+                '%s-%s' % (name, timestamp)).hexdigest(), 16))
+        self.assertEquals(info['hash'], hash_)
+
     def test_delete_object(self):
         # Test ContainerBroker.delete_object
         broker = ContainerBroker(':memory:', account='a', container='c')
@@ -962,6 +1021,125 @@ class TestContainerBroker(unittest.TestCase):
         broker2.merge_syncs(broker1.get_syncs())
         self.assertEquals(broker2.get_sync('12345'), 3)
 
+    def test_range_hashes(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(normalize_timestamp('1'))
+        for i in xrange(10):
+            broker.put_object('o%d' % i, normalize_timestamp(i + 1), 0,
+                              'text/plain', 'etag', deleted=i in (3, 7))
+        broker.put_object(u'o\u00e9', normalize_timestamp(11), 0,
+                          'text/plain', 'etag', deleted=1)
+        # the live rows are split
+        self.assertEquals(broker.get_range_bounds(None, None, 3),
+                          ['o1', 'o4'])
+        self.assertEquals(broker.get_range_bounds('o5', None, 3),
+                          ['o6', 'o8'])
+        self.assertEquals(broker.get_range_bounds('o8', None, 3), [])
+        # unless most rows in the range are deleted
+        self.assertEquals(broker.get_range_bounds('o9', None, 2), [])
+        self.assertEquals(broker.get_range_bounds('o2', 'o3', 2), [])
+        ranges = broker.get_range_hashes([None, 'o1', 'o4', None])
+        self.assertEquals([count for count, hsh in ranges], [2, 3, 6])
+        # the ranges cover the whole DB, so their hashes make up its hash
+        self.assertEquals(
+            '%032x' % reduce(lambda a, b: a ^ b,
+                             [int(hsh, 16) for count, hsh in ranges]),
+            broker.get_info()['hash'])
+        self.assertEquals(broker.get_range_hashes(['o4', None])[0],
+                          ranges[2])
+        # the rows are read a batch at a time
+        orig_batch_size = swift.common.db.RANGE_HASH_BATCH_SIZE
+        swift.common.db.RANGE_HASH_BATCH_SIZE = 2
+        try:
+            self.assertEquals(
+                broker.get_range_hashes([None, 'o1', 'o4', None]), ranges)
+        finally:
+            swift.common.db.RANGE_HASH_BATCH_SIZE = orig_batch_size
+        # ranges with more rows than are left to hash are skipped
+        self.assertEquals(
+            broker.get_range_hashes([None, 'o1', 'o4', None], 4),
+            [ranges[0], [3, None], [6, None]])
+        self.assertEquals(
+            broker.get_range_hashes([None, 'o1', 'o8', None], 5),
+            [ranges[0], [7, None],
+             broker.get_range_hashes(['o8', None])[0]])
+        self.assertEquals(broker.get_range_hashes([u'o\u00e9', None]),
+                          [[0, '0' * 32]])
+        self.assertEquals(
+            [item['name'] for item in broker.get_items_in_range('o2', 'o5')],
+            ['o3', 'o4', 'o5'])
+        self.assertEquals(
+            len(broker.get_items_in_range(None, None)), 11)
+
+    def _test_compact(self, wal):
+        testdir = mkdtemp()
+        swift.common.db.DB_WAL = wal
+        try:
+            broker = ContainerBroker(os.path.join(testdir, 'c.db'),
+                                     account='a', container='c')
+            broker.initialize(normalize_timestamp('1'))
+            broker.merge_items([
+                {'name': 'o%05d' % i, 'created_at': normalize_timestamp(2),
+                 'size': 0, 'content_type': 'text/plain',
+                 'etag': 'x' * 200, 'deleted': 1} for i in xrange(2000)])
+            broker.merge_items([
+                {'name': 'p', 'created_at': normalize_timestamp(2),
+                 'size': 0, 'content_type': 'text/plain',
+                 'etag': 'etag', 'deleted': 0}])
+            broker.reclaim(normalize_timestamp(3), normalize_timestamp(3))
+            broker.checkpoint()
+            self.assert_(broker.get_free_ratio() > 0.5)
+            size = os.path.getsize(broker.db_file)
+            reclaimed = broker.compact()
+            self.assert_(reclaimed > size / 2)
+            self.assertEquals(os.path.getsize(broker.db_file),
+                              size - reclaimed)
+            self.assertEquals(broker.get_free_ratio(), 0)
+            self.assertEquals(
+                [row[0] for row in broker.list_objects_iter(
+                    10, '', None, None, '')], ['p'])
+            self.assertEquals(broker.get_info()['object_count'], 1)
+        finally:
+            swift.common.db.DB_WAL = False
+            rmtree(testdir, ignore_errors=1)
+
+    def test_compact(self):
+        self._test_compact(False)
+
+    def test_compact_wal(self):
+        self._test_compact(True)
+
+    def test_changes_mark_dirty(self):
+        testdir = mkdtemp()
+        db_file = os.path.join(testdir, 'sda', 'containers', '0', 'abc',
+                               'fedabc', 'fedabc.db')
+        marker = os.path.join(testdir, 'sda', 'containers_dirty', '0-fedabc')
+        os.makedirs(os.path.dirname(db_file))
+        swift.common.db.DB_DIRTY_TRACKING = True
+        try:
+            broker = ContainerBroker(db_file, account='a', container='c')
+            broker.initialize(normalize_timestamp('1'))
+            self.assert_(os.path.exists(marker))
+            os.unlink(marker)
+            broker.put_object('o', normalize_timestamp(2), 0, 'text/plain',
+                              'd41d8cd98f00b204e9800998ecf8427e')
+            self.assert_(os.path.exists(marker))
+            os.unlink(marker)
+            # committing the pending file merges the object in
+            items = broker.get_items_since(-1, 10)
+            self.assertEquals(len(items), 1)
+            self.assert_(os.path.exists(marker))
+            os.unlink(marker)
+            # merging rows the DB already has changes nothing
+            broker.merge_items(items)
+            self.assertFalse(os.path.exists(marker))
+            items[0]['created_at'] = normalize_timestamp(3)
+            broker.merge_items(items)
+            self.assert_(os.path.exists(marker))
+        finally:
+            swift.common.db.DB_DIRTY_TRACKING = False
+            rmtree(testdir, ignore_errors=1)
+
     def test_merge_items(self):
         broker1 = ContainerBroker(':memory:', account='a', container='c')
         broker1.initialize(normalize_timestamp('1'))
@@ -1056,6 +1234,40 @@ class TestContainerBroker(unittest.TestCase):
                 self.assertEquals(rec['created_at'], normalize_timestamp(5))
                 self.assertEquals(rec['content_type'], 'text/plain')
 
+    def test_merge_items_batch_with_duplicates(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(normalize_timestamp('1'))
+        broker.put_object('a', normalize_timestamp(3), 1, 'text/plain', 'a3')
+        broker.put_object('b', normalize_timestamp(1), 1, 'text/plain', 'b1')
+
+        def item(name, timestamp, etag, size=2, deleted=0):
+            return {'name': name, 'created_at': normalize_timestamp(timestamp),
+                    'size': size, 'content_type': 'text/plain',
+                    'etag': etag, 'deleted': deleted, 'ROWID': timestamp}
+
+        broker.merge_items([item('b', 4, 'b4'), item('a', 2, 'a2'),
+                            item('c', 5, 'c5'), item('b', 2, 'b2'),
+                            item('c', 5, 'c5 again'), item('d', 6, 'd6'),
+                            item(u'\xe9', 3, 'e3'), item('d', 7, 'd7', 0, 1)],
+                           'remote')
+        items = broker.get_items_since(-1, 1000)
+        # an older item never replaces a row, the first of several items
+        # with the same timestamp wins, and rows are in the order the
+        # winning items came in
+        self.assertEquals([(rec['name'], rec['etag'], rec['deleted'])
+                           for rec in items],
+                          [('a', 'a3', 0), ('b', 'b4', 0), ('c', 'c5', 0),
+                           ('\xc3\xa9', 'e3', 0), ('d', 'd7', 1)])
+        info = broker.get_info()
+        self.assertEquals(info['object_count'], 4)
+        self.assertEquals(info['bytes_used'], 7)
+        self.assertEquals(broker.get_sync('remote'), 7)
+        with broker.get() as conn:
+            self.assertEquals(conn.execute('''
+                SELECT name FROM sqlite_temp_master
+                WHERE name = 'merge_batch'
+            ''').fetchall(), [])
+
 
 def premetadata_create_container_stat_table(self, conn, put_timestamp=None):
     """
@@ -1202,3 +1414,149 @@ class TestContainerBrokerBeforeXSync(TestContainerBroker):
         broker.initialize(normalize_timestamp('1'))
         with broker.get() as conn:
             conn.execute('SELECT x_container_sync_point1 FROM container_stat')
+
+
+def prebatchedstats_create_object_table(self, conn):
+    """
+    Copied from ContainerBroker before the object_insert and object_delete
+    triggers were dropped; used for testing with
+    TestContainerBrokerBeforeBatchedStats.
+
+    Create the object table which is specifc to the container DB.
+
+    :param conn: DB connection object
+    """
+    conn.executescript("""
+        CREATE TABLE object (
+            ROWID INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            created_at TEXT,
+            size INTEGER,
+            content_type TEXT,
+            etag TEXT,
+            deleted INTEGER DEFAULT 0
+        );
+
+        CREATE INDEX ix_object_deleted_name ON object (deleted, name);
+
+        CREATE TRIGGER object_insert AFTER INSERT ON object
+        BEGIN
+            UPDATE container_stat
+            SET object_count = object_count + (1 - new.deleted),
+                bytes_used = bytes_used + new.size,
+                hash = chexor(hash, new.name, new.created_at);
+        END;
+
+        CREATE TRIGGER object_update BEFORE UPDATE ON object
+        BEGIN
+            SELECT RAISE(FAIL, 'UPDATE not allowed; DELETE and INSERT');
+        END;
+
+        CREATE TRIGGER object_delete AFTER DELETE ON object
+        BEGIN
+            UPDATE container_stat
+            SET object_count = object_count - (1 - old.deleted),
+                bytes_used = bytes_used - old.size,
+                hash = chexor(hash, old.name, old.created_at);
+        END;
+    """)
+
+
+class TestContainerBrokerBatchedStats(TestContainerBroker):
+    """
+    Tests for ContainerBroker with DB_BATCHED_STATS on, so that databases
+    are created without the stat triggers.
+    """
+
+    def setUp(self):
+        swift.common.db.DB_BATCHED_STATS = True
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(normalize_timestamp('1'))
+        with broker.get() as conn:
+            self.assertEquals(broker.get_db_version(conn), 2)
+
+    def tearDown(self):
+        swift.common.db.DB_BATCHED_STATS = False
+
+    def test_triggers_restored(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(normalize_timestamp('1'))
+        broker.put_object('a', normalize_timestamp(1), 3, 'text/plain', 'x')
+        broker.put_object('b', normalize_timestamp(2), 4, 'text/plain', 'x')
+        info = broker.get_info()
+        # a node with DB_BATCHED_STATS off, or that was turned off, puts
+        # the triggers back before it changes the object table
+        swift.common.db.DB_BATCHED_STATS = False
+        broker.put_object('a', normalize_timestamp(3), 5, 'text/plain', 'y')
+        broker.delete_object('c', normalize_timestamp(4))
+        with broker.get() as conn:
+            self.assertEquals(broker.get_db_version(conn), 1)
+            self.assertEquals(sorted(row[0] for row in conn.execute('''
+                SELECT name FROM sqlite_master
+                WHERE type = 'trigger' AND tbl_name = 'object'
+            ''')), ['object_delete', 'object_insert', 'object_update'])
+        hash_ = info['hash']
+        for name, timestamp in (('a', '0000000001.00000'),
+                                ('a', '0000000003.00000'),
+                                ('c', '0000000004.00000')):
+            hash_ = '%032x' % (int(hash_, 16) ^ int(hashlib.md5(
+                '%s-%s' % (name, timestamp)).hexdigest(), 16))
+        info = broker.get_info()
+        self.assertEquals(info['object_count'], 2)
+        self.assertEquals(info['bytes_used'], 9)
+        self.assertEquals(info['hash'], hash_)
+
+
+class TestContainerBrokerBeforeBatchedStats(TestContainerBroker):
+    """
+    Tests for ContainerBroker with DB_BATCHED_STATS on against databases
+    created with the stat triggers; they are migrated on their first merge
+    or reclaim.
+    """
+
+    def setUp(self):
+        swift.common.db.DB_BATCHED_STATS = True
+        self._imported_create_object_table = \
+            ContainerBroker.create_object_table
+        ContainerBroker.create_object_table = \
+            prebatchedstats_create_object_table
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(normalize_timestamp('1'))
+        with broker.get() as conn:
+            self.assertEquals(broker.get_db_version(conn), 1)
+
+    def tearDown(self):
+        ContainerBroker.create_object_table = \
+            self._imported_create_object_table
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(normalize_timestamp('1'))
+        with broker.get() as conn:
+            self.assertEquals(broker.get_db_version(conn), 2)
+        swift.common.db.DB_BATCHED_STATS = False
+
+    def test_migration(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(normalize_timestamp('1'))
+        broker.put_object('a', normalize_timestamp(1), 3, 'text/plain', 'x')
+        broker.put_object('b', normalize_timestamp(2), 4, 'text/plain', 'x')
+        broker.delete_object('c', normalize_timestamp(3))
+        info = broker.get_info()
+        with broker.get() as conn:
+            self.assertEquals(broker.get_db_version(conn), 2)
+            self.assertEquals([row[0] for row in conn.execute('''
+                SELECT name FROM sqlite_master
+                WHERE type = 'trigger' AND tbl_name = 'object'
+            ''')], ['object_update'])
+        # the stats kept by the triggers carry on being kept by the broker
+        broker.put_object('a', normalize_timestamp(4), 5, 'text/plain', 'y')
+        broker.reclaim(normalize_timestamp(4), normalize_timestamp(4))
+        hash_ = info['hash']
+        for name, timestamp in (('a', '0000000001.00000'),
+                                ('a', '0000000004.00000'),
+                                ('c', '0000000003.00000')):
+            hash_ = '%032x' % (int(hash_, 16) ^ int(hashlib.md5(
+                '%s-%s' % (name, timestamp)).hexdigest(), 16))
+        info = broker.get_info()
+        self.assertEquals(info['object_count'], 2)
+        self.assertEquals(info['bytes_used'], 9)
+        self.assertEquals(info['hash'], hash_)
@@ -114,6 +114,26 @@ class TestContainerController(unittest.TestCase):
         self.assertEquals(response.headers.get('x-container-write'),
                           'account:user')
 
+    def test_load_hint(self):
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT',
+                                    'HTTP_X_TIMESTAMP': '0'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.headers['X-Backend-Load'],
+                          'active=0 queued=0 replicating=0')
+        self.assertEquals(self.controller.active_requests, {})
+
+        self.controller.active_requests['sda1'] = 2
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'HEAD'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.headers['X-Backend-Load'],
+                          'active=2 queued=0 replicating=0')
+        self.assertEquals(self.controller.active_requests, {'sda1': 2})
+
+        self.controller.load_hints = False
+        resp = req.get_response(self.controller)
+        self.assertFalse('X-Backend-Load' in resp.headers)
+
     def test_HEAD(self):
         req = Request.blank(
             '/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT',
@@ -1320,6 +1340,107 @@ class TestContainerController(unittest.TestCase):
               "content_type": "text/plain",
               "last_modified": "1970-01-01T00:00:01.000000"}])
 
+    def _put_objects(self, names):
+        for name in names:
+            req = Request.blank(
+                '/sda1/p/a/c/%s' % name,
+                environ={
+                    'REQUEST_METHOD': 'PUT', 'HTTP_X_TIMESTAMP': '1',
+                    'HTTP_X_CONTENT_TYPE': 'text/plain', 'HTTP_X_ETAG': 'x',
+                    'HTTP_X_SIZE': 0})
+            resp = req.get_response(self.controller)
+            self.assertEquals(resp.status_int, 201)
+
+    def test_GET_listing_cache(self):
+        self.controller = container_server.ContainerController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'listing_cache_size': '1048576'})
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT',
+                                    'HTTP_X_TIMESTAMP': '0'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 201)
+
+        def get(path):
+            return Request.blank(path, environ={'REQUEST_METHOD': 'GET'}
+                                 ).get_response(self.controller)
+
+        def fail(*args, **kwargs):
+            raise Exception('DB read')
+
+        with mock.patch.object(container_server, 'LISTING_CACHE_SETTLE_TIME',
+                               -1):
+            self.assertEquals(get('/sda1/p/a/c').status_int, 204)
+            self._put_objects(['a', 'b'])
+            # the first read commits the pending updates, changing the DB
+            # files, so only the second one leaves a listing that's cached
+            get('/sda1/p/a/c?format=json')
+            resp = get('/sda1/p/a/c?format=json')
+            self.assertEquals(resp.status_int, 200)
+            body = resp.body
+            headers = dict(resp.headers)
+            self.assertEquals(len(self.controller.listing_cache.entries), 2)
+            # the cached listing is served without reading the DB
+            with mock.patch.object(container_server.ContainerBroker,
+                                   'get_info', fail):
+                with mock.patch.object(container_server.ContainerBroker,
+                                       'list_objects_iter', fail):
+                    resp = get('/sda1/p/a/c?format=json')
+                    self.assertEquals(resp.status_int, 200)
+                    self.assertEquals(resp.body, body)
+                    self.assertEquals(dict(resp.headers), headers)
+                    self.assertEquals(resp.charset, 'utf-8')
+                    # other query parameters are cached separately
+                    resp = get('/sda1/p/a/c?format=json&limit=1')
+                    self.assertEquals(resp.status_int, 500)
+            # any update invalidates the cached listing
+            self._put_objects(['c'])
+            resp = get('/sda1/p/a/c?format=json')
+            self.assertEquals([o['name'] for o in simplejson.loads(resp.body)],
+                              ['a', 'b', 'c'])
+            self.assertEquals(resp.headers['X-Container-Object-Count'], '3')
+
+    def test_GET_listing_cache_settle_time(self):
+        self.controller = container_server.ContainerController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'listing_cache_size': '1048576'})
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT',
+                                    'HTTP_X_TIMESTAMP': '0'})
+        resp = req.get_response(self.controller)
+        self._put_objects(['a'])
+        # the DB was just changed, so a later change could leave its stats
+        # as they are; the listing isn't cached
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.body, 'a\n')
+        self.assertEquals(self.controller.listing_cache.entries, {})
+
+    def test_listing_cache(self):
+        cache = container_server.ListingCache(10)
+        cache.set('a', 's', 'A', 4)
+        cache.set('b', 's', 'B', 4)
+        self.assertEquals(cache.get('a', 's'), 'A')
+        # the least recently used listing is evicted
+        cache.set('c', 's', 'C', 4)
+        self.assertEquals(cache.get('b', 's'), None)
+        self.assertEquals(cache.get('a', 's'), 'A')
+        self.assertEquals(cache.get('c', 's'), 'C')
+        self.assertEquals(cache.size, 8)
+        # listings of changed DBs are dropped
+        self.assertEquals(cache.get('a', 't'), None)
+        self.assertEquals(sorted(cache.entries), ['c'])
+        self.assertEquals(cache.size, 4)
+        # replacing a listing
+        cache.set('c', 't', 'C2', 6)
+        self.assertEquals(cache.get('c', 't'), 'C2')
+        self.assertEquals(cache.size, 6)
+        # listings larger than the cache aren't cached
+        cache.set('d', 's', 'D', 11)
+        self.assertEquals(cache.get('d', 's'), None)
+        self.assertEquals(cache.get('c', 't'), 'C2')
+        self.assertEquals(cache.size, 6)
+
     def test_GET_insufficient_storage(self):
         self.controller = container_server.ContainerController(
             {'devices': self.testdir})
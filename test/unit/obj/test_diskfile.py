@@ -625,6 +625,17 @@ class TestDiskFile(unittest.TestCase):
             # new fast-post updateable keys are added
             self.assertEquals('Value2', df._metadata['X-Object-Meta-Key2'])
 
+    def test_disk_file_fast_post_content_type(self):
+        df = self._get_open_disk_file(
+            ts=41, extra_metadata={'Content-Type': 'text/garbage'})
+        df = self.df_mgr.get_diskfile('sda1', '0', 'a', 'c', 'o')
+        df.write_metadata({'X-Timestamp': normalize_timestamp(42),
+                           'Content-Type': 'text/plain'})
+        df = self.df_mgr.get_diskfile('sda1', '0', 'a', 'c', 'o')
+        with df.open():
+            self.assertEquals('text/plain', df._metadata['Content-Type'])
+            self.assertEquals('1024', df._metadata['Content-Length'])
+
     def test_disk_file_app_iter_corners(self):
         df = self._create_test_file('1234567890')
         quarantine_msgs = []
@@ -722,6 +733,23 @@ class TestDiskFile(unittest.TestCase):
         with df.create():
             self.assert_(os.path.exists(tmpdir))
 
+    def test_writer_put_timings(self):
+        df = self.df_mgr.get_diskfile('sda1', '0', 'a', 'c', 'o')
+        with df.create() as writer:
+            self.assertEquals(writer.put_timings, [])
+            writer.write('data')
+            writer.put({'X-Timestamp': normalize_timestamp(time()),
+                        'ETag': md5('data').hexdigest(),
+                        'Content-Length': '4'})
+            self.assertEquals([name for name, start, end in
+                               writer.put_timings],
+                              ['xattr', 'fsync', 'rename'])
+            last_end = writer.put_timings[0][1]
+            for name, start, end in writer.put_timings:
+                self.assertEquals(start, last_end)
+                self.assertTrue(end >= start)
+                last_end = end
+
     def _get_open_disk_file(self, invalid_type=None, obj_name='o', fsize=1024,
                             csize=8, mark_deleted=False, ts=None,
                             mount_check=False, extra_metadata=None):
@@ -17,6 +17,7 @@
 """Tests for swift.obj.server"""
 
 import cPickle as pickle
+import multiprocessing
 import operator
 import os
 import mock
@@ -36,6 +37,7 @@ from swift.common import utils
 from swift.common.utils import hash_path, mkdirs, normalize_timestamp, \
     NullLogger, storage_directory, public, replication
 from swift.common import constraints
+from swift.common import tracing
 from eventlet import tpool
 from swift.common.swob import Request, HeaderKeyDict
 
@@ -357,6 +359,98 @@ class TestObjectController(unittest.TestCase):
         finally:
             object_server.http_connect = old_http_connect
 
+    def test_POST_content_type(self):
+        given_args = []
+
+        def fake_async_update(*args):
+            given_args.append(args)
+
+        self.object_controller.async_update = fake_async_update
+        timestamp = normalize_timestamp(time())
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': timestamp,
+                     'Content-Type': 'application/x-test;swift_bytes=100',
+                     'X-Static-Large-Object': 'True'})
+        req.body = 'VERIFY'
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+
+        timestamp = normalize_timestamp(float(timestamp) + 1)
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'POST'},
+            headers={'X-Timestamp': timestamp,
+                     'X-Trans-Id': '123',
+                     'X-Container-Host': 'chost',
+                     'X-Container-Partition': 'cpartition',
+                     'X-Container-Device': 'cdevice',
+                     'Content-Type': 'text/plain',
+                     'X-Object-Meta-1': 'One'})
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 202)
+
+        req = Request.blank('/sda1/p/a/c/o',
+                            environ={'REQUEST_METHOD': 'HEAD'})
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.headers['Content-Type'],
+                          'text/plain;swift_bytes=100')
+        self.assertEquals(resp.headers['X-Object-Meta-1'], 'One')
+        self.assertEquals(resp.headers['X-Static-Large-Object'], 'True')
+        self.assertEquals(resp.headers['X-Timestamp'], timestamp)
+
+        # without a content type, the one set by the last POST is kept
+        timestamp = normalize_timestamp(float(timestamp) + 1)
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'POST'},
+            headers={'X-Timestamp': timestamp,
+                     'X-Container-Host': 'chost',
+                     'X-Container-Partition': 'cpartition',
+                     'X-Container-Device': 'cdevice'})
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 202)
+        req = Request.blank('/sda1/p/a/c/o',
+                            environ={'REQUEST_METHOD': 'HEAD'})
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.headers['Content-Type'],
+                          'text/plain;swift_bytes=100')
+        # the POSTs sent no container updates
+        self.assertEquals(given_args, [])
+
+    def test_POST_stale_replica_no_container_update(self):
+        given_args = []
+
+        def fake_async_update(*args):
+            given_args.append(args)
+
+        self.object_controller.async_update = fake_async_update
+        container_headers = {'X-Container-Host': 'chost',
+                             'X-Container-Partition': 'cpartition',
+                             'X-Container-Device': 'cdevice'}
+        timestamp = time()
+        headers = {'X-Timestamp': normalize_timestamp(timestamp),
+                   'Content-Type': 'application/octet-stream'}
+        headers.update(container_headers)
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers=headers)
+        req.body = 'OLD'
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(len(given_args), 1)
+        # a newer PUT at timestamp + 1 only reached the other replicas, so
+        # this one can't tell its data is stale when the POST comes in
+        headers = {'X-Timestamp': normalize_timestamp(timestamp + 2),
+                   'Content-Type': 'text/plain'}
+        headers.update(container_headers)
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'POST'},
+            headers=headers)
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 202)
+        # no listing row with the POST timestamp and the size and etag of
+        # the old data is sent to hide the newer PUT's row
+        self.assertEquals(len(given_args), 1)
+
     def test_POST_quarantine_zbyte(self):
         # Test swift.obj.server.ObjectController.GET
         timestamp = normalize_timestamp(time())
@@ -497,6 +591,104 @@ class TestObjectController(unittest.TestCase):
                            'name': '/a/c/o',
                            'Content-Encoding': 'gzip'})
 
+    def test_PUT_trace_spans(self):
+        trace_file = os.path.join(self.testdir, 'spans')
+        self.object_controller.tracer = tracing.Tracer(
+            {'trace_file': trace_file}, 'object-server')
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': normalize_timestamp(time()),
+                     'X-Trans-Id': 'tx1',
+                     'Content-Length': '6',
+                     'Content-Type': 'application/octet-stream'})
+        req.body = 'VERIFY'
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+        self.object_controller.tracer.flush()
+        with open(trace_file) as fp:
+            spans = tracing.load_spans([fp], 'tx1')
+        self.assertEquals(
+            [s['name'] for s in spans],
+            ['PUT', 'open', 'create', 'upload', 'put', 'xattr', 'fsync',
+             'rename', 'container_update'])
+        for span in spans:
+            self.assertEquals(span['server'], 'object-server')
+        request_span = [s for s in spans if s['name'] == 'PUT'][0]
+        self.assertEquals(request_span['status'], 201)
+
+    def test_PUT_phase_timing(self):
+        self.object_controller.logger = FakeLogger()
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': normalize_timestamp(time()),
+                     'Content-Length': '6',
+                     'Content-Type': 'application/octet-stream'})
+        req.body = 'VERIFY'
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+        phases = ['open', 'create', 'upload', 'write', 'put', 'xattr',
+                  'fsync', 'rename', 'container_update']
+        self.assertEquals([name for name, elapsed in
+                           req.environ['swift.phase_times']], phases)
+        timings = [args[0] for args, kwargs in
+                   self.object_controller.logger.log_dict['timing']]
+        for phase in phases:
+            self.assertTrue('PUT.phase.%s.timing' % phase in timings)
+
+        req = Request.blank('/sda1/p/a/c/o')
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals([name for name, elapsed in
+                           req.environ['swift.phase_times']], ['open'])
+
+    def test_slow_request_log(self):
+        self.object_controller.logger = FakeLogger()
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': normalize_timestamp(time()),
+                     'Content-Length': '6',
+                     'Content-Type': 'application/octet-stream'})
+        req.body = 'VERIFY'
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+        self.assertFalse(self.object_controller.logger.log_dict['warning'])
+
+        self.object_controller.slow_request_threshold = 0.000001
+        req = Request.blank('/sda1/p/a/c/o')
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.body, 'VERIFY')
+        warnings = self.object_controller.logger.log_dict['warning']
+        self.assertEquals(len(warnings), 1)
+        msg, args = warnings[0][0]
+        self.assertEquals(args['method'], 'GET')
+        self.assertEquals(args['path'], '/sda1/p/a/c/o')
+        self.assertEquals(args['status'], '200')
+        self.assertTrue(args['phases'].startswith('open='))
+
+    def test_slow_request_log_includes_body(self):
+        self.object_controller.logger = FakeLogger()
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': normalize_timestamp(time()),
+                     'Content-Length': '6',
+                     'Content-Type': 'application/octet-stream'})
+        req.body = 'VERIFY'
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+
+        self.object_controller.slow_request_threshold = 0.000001
+        req = Request.blank('/sda1/p/a/c/o')
+        app_iter = self.object_controller(req.environ,
+                                          lambda *args: None)
+        # nothing is logged while the body is still being sent
+        self.assertFalse(self.object_controller.logger.log_dict['warning'])
+        self.assertEquals(''.join(app_iter), 'VERIFY')
+        app_iter.close()
+        warnings = self.object_controller.logger.log_dict['warning']
+        self.assertEquals(len(warnings), 1)
+        self.assertEquals(warnings[0][0][1]['method'], 'GET')
+
     def test_PUT_old_timestamp(self):
         ts = time()
         req = Request.blank(
@@ -2820,6 +3012,38 @@ class TestObjectController(unittest.TestCase):
         finally:
             diskfile.fallocate = orig_fallocate
 
+    def test_load_hint(self):
+        req = Request.blank('/sda1/p/a/c/o')
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 404)
+        self.assertEquals(resp.headers['X-Backend-Load'],
+                          'active=0 queued=0 replicating=0')
+        self.assertEquals(self.object_controller.active_requests, {})
+
+        self.object_controller.active_requests['sda1'] = 2
+        self.object_controller.replication_semaphore = \
+            multiprocessing.BoundedSemaphore(4)
+        self.object_controller.replication_concurrency = 4
+        self.object_controller.replication_semaphore.acquire()
+        with mock.patch.object(self.object_controller, 'get_disk_queue_depth',
+                               return_value=5):
+            resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.headers['X-Backend-Load'],
+                          'active=2 queued=5 replicating=1')
+
+        self.object_controller.load_hints = False
+        resp = req.get_response(self.object_controller)
+        self.assertFalse('X-Backend-Load' in resp.headers)
+
+    def test_get_disk_queue_depth(self):
+        self.assertEquals(self.object_controller.get_disk_queue_depth('sda1'),
+                          0)
+        # the device's thread pool is created by its first disk operation
+        threadpool = self.object_controller._diskfile_mgr.threadpools['sda1']
+        with mock.patch.object(threadpool._run_queue, 'unfinished_tasks', 3):
+            self.assertEquals(
+                self.object_controller.get_disk_queue_depth('sda1'), 3)
+
     def test_global_conf_callback_does_nothing(self):
         preloaded_app_conf = {}
         global_conf = {}
@@ -2828,6 +3052,7 @@ class TestObjectController(unittest.TestCase):
         self.assertEqual(global_conf.keys(), ['replication_semaphore'])
         self.assertEqual(
             global_conf['replication_semaphore'][0].get_value(), 4)
+        self.assertEqual(global_conf['replication_semaphore'][1], 4)
 
     def test_global_conf_callback_replication_semaphore(self):
         preloaded_app_conf = {'replication_concurrency': 123}
@@ -2837,7 +3062,8 @@ class TestObjectController(unittest.TestCase):
                 return_value='test1') as mocked_Semaphore:
             object_server.global_conf_callback(preloaded_app_conf, global_conf)
         self.assertEqual(preloaded_app_conf, {'replication_concurrency': 123})
-        self.assertEqual(global_conf, {'replication_semaphore': ['test1']})
+        self.assertEqual(global_conf,
+                         {'replication_semaphore': ['test1', 123]})
         mocked_Semaphore.assert_called_once_with(123)
 
     def test_serv_reserv(self):
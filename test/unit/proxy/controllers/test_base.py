@@ -19,8 +19,8 @@ from swift.proxy.controllers.base import headers_to_container_info, \
     headers_to_account_info, headers_to_object_info, get_container_info, \
     get_container_memcache_key, get_account_info, get_account_memcache_key, \
     get_object_env_key, _get_cache_key, get_info, get_object_info, \
-    Controller, GetOrHeadHandler
-from swift.common.swob import Request, HTTPException
+    Controller, GetOrHeadHandler, update_headers
+from swift.common.swob import Request, Response, HTTPException
 from swift.common.utils import split_path
 from test.unit import fake_http_connect, FakeRing, FakeMemcache
 from swift.proxy import server as proxy_server
@@ -435,6 +435,17 @@ class TestFuncs(unittest.TestCase):
             resp,
             headers_to_object_info(headers.items(), 200))
 
+    def test_update_headers(self):
+        resp = Response()
+        update_headers(resp, [('etag', '"abc"'), ('x-object-meta-a', 'b'),
+                              ('x-put-timestamp', '1'),
+                              ('x-backend-load',
+                               'active=1 queued=0 replicating=0')])
+        self.assertEquals(resp.headers['etag'], 'abc')
+        self.assertEquals(resp.headers['x-object-meta-a'], 'b')
+        self.assertFalse('x-put-timestamp' in resp.headers)
+        self.assertFalse('x-backend-load' in resp.headers)
+
     def test_have_quorum(self):
         base = Controller(self.app)
         # just throw a bunch of test cases at it
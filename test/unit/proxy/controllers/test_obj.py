@@ -18,10 +18,13 @@ import unittest
 from contextlib import contextmanager
 
 import mock
+from eventlet import sleep
+from eventlet.event import Event
 
 import swift
+from swift.common.swob import Request
 from swift.proxy import server as proxy_server
-from test.unit import FakeRing, FakeMemcache, fake_http_connect
+from test.unit import FakeLogger, FakeRing, FakeMemcache, fake_http_connect
 
 
 @contextmanager
@@ -118,5 +121,107 @@ class TestObjController(unittest.TestCase):
             self.assertEquals(req.environ.get('swift.log_info'), None)
 
 
+class FakePutConn(object):
+    """Backend PUT connection whose final response waits for an event."""
+
+    def __init__(self, index, status, etag='abc'):
+        self.node = {'ip': '10.0.0.%d' % index, 'port': 6000,
+                     'device': 'sda1'}
+        self.resp = None
+        self.status = status
+        self.reason = 'Fake'
+        self.etag = etag
+        self.event = Event()
+
+    def getresponse(self):
+        self.event.wait()
+        return self
+
+    def getheader(self, name, default=None):
+        return {'etag': '"%s"' % self.etag}.get(name, default)
+
+    def read(self):
+        return ''
+
+
+class TestObjControllerPutResponses(unittest.TestCase):
+
+    def setUp(self):
+        self.app = proxy_server.Application(
+            None, FakeMemcache(), logger=FakeLogger(),
+            account_ring=FakeRing(), container_ring=FakeRing(),
+            object_ring=FakeRing())
+        self.controller = proxy_server.ObjectController(
+            self.app, 'a', 'c', 'o')
+        self.req = Request.blank('/v1/a/c/o',
+                                 environ={'REQUEST_METHOD': 'PUT'})
+
+    def _get_put_responses(self, conns):
+        for conn in conns:
+            if conn.status is not None:
+                conn.event.send()
+        return self.controller._get_put_responses(
+            self.req, conns, [conn.node for conn in conns])
+
+    def test_waits_for_stragglers_after_quorum(self):
+        conns = [FakePutConn(1, 201), FakePutConn(2, 201),
+                 FakePutConn(3, None)]
+
+        def finish_third():
+            sleep(0.01)
+            conns[2].status = 201
+            conns[2].event.send()
+        swift.proxy.controllers.obj.spawn_n(finish_third)
+        self.app.post_quorum_timeout = 1
+        statuses, reasons, bodies, etags = self._get_put_responses(conns)
+        self.assertEquals(statuses, [201, 201, 201])
+        self.assertEquals(etags, set(['abc']))
+        self.assertFalse(self.app.logger.log_dict['increment'])
+
+    def test_reply_without_stragglers(self):
+        conns = [FakePutConn(1, 201), FakePutConn(2, 201),
+                 FakePutConn(3, 201), FakePutConn(4, None),
+                 FakePutConn(5, None, etag='def')]
+        self.app.post_quorum_timeout = 0.01
+        statuses, reasons, bodies, etags = self._get_put_responses(conns)
+        # the missing responses count as failures
+        self.assertEquals(statuses, [201, 201, 201, 503, 503])
+        self.assertEquals(etags, set(['abc']))
+        # the stragglers finish in the background
+        conns[3].status = 201
+        conns[3].event.send()
+        conns[4].status = 201
+        conns[4].event.send()
+        sleep(0.01)
+        self.assertEquals(
+            self.app.logger.log_dict['increment'],
+            [(('stragglers.success',), {}), (('stragglers.success',), {})])
+        self.assertEquals(len(self.app.logger.log_dict['timing_since']), 2)
+        errors = self.app.logger.get_lines_for_level('error')
+        self.assertEquals(len(errors), 1)
+        self.assertTrue('10.0.0.5:6000/sda1' in errors[0])
+        self.assertTrue('mismatched etag def' in errors[0])
+
+    def test_straggler_failures(self):
+        conns = [FakePutConn(1, 201), FakePutConn(2, 201),
+                 FakePutConn(3, 201), FakePutConn(4, None),
+                 FakePutConn(5, None)]
+        # by default the client is replied to as soon as there is a quorum
+        statuses, reasons, bodies, etags = self._get_put_responses(conns)
+        self.assertEquals(statuses, [201, 201, 201, 503, 503])
+        conns[3].status = 507
+        conns[3].event.send()
+        conns[4].status = 404
+        conns[4].event.send()
+        sleep(0.01)
+        self.assertEquals(
+            self.app.logger.log_dict['increment'],
+            [(('stragglers.failure',), {})] * 2)
+        self.assertEquals(conns[3].node.get('errors'), 1)
+        warnings = self.app.logger.get_lines_for_level('warning')
+        self.assertEquals(len(warnings), 1)
+        self.assertTrue('10.0.0.5:6000/sda1 returned 404' in warnings[0])
+
+
 if __name__ == '__main__':
     unittest.main()
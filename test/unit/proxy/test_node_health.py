@@ -0,0 +1,94 @@
+# Copyright (c) 2013 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+
+from swift.proxy import node_health
+
+
+def _node(device='sda', ip='10.0.0.1'):
+    return {'ip': ip, 'port': 6000, 'device': device}
+
+
+class TestSharedNodeHealth(unittest.TestCase):
+
+    def test_node_key(self):
+        self.assertEquals(node_health.node_key(_node()),
+                          node_health.node_key(_node()))
+        self.assertNotEquals(node_health.node_key(_node('sda')),
+                             node_health.node_key(_node('sdb')))
+
+    def test_errors(self):
+        health = node_health.SharedNodeHealth(16)
+        node = _node()
+        health.load_errors(node)
+        self.assertEquals(node, _node())
+
+        node['errors'] = 3
+        node['last_error'] = 100.0
+        health.store_errors(node)
+        # another worker's copy of the same node picks up the errors
+        other = _node()
+        health.load_errors(other)
+        self.assertEquals(other['errors'], 3)
+        self.assertEquals(other['last_error'], 100.0)
+
+        del node['errors']
+        del node['last_error']
+        health.store_errors(node)
+        health.load_errors(other)
+        self.assertEquals(other, _node())
+
+    def test_latency(self):
+        health = node_health.SharedNodeHealth(16)
+        self.assertEquals(health.get_latency(_node()), None)
+        health.set_latency(_node(), 0.5, 0.25, 100.0)
+        self.assertEquals(health.get_latency(_node()), (0.5, 0.25, 100.0))
+        self.assertEquals(health.get_latency(_node('sdb')), None)
+
+    def test_load(self):
+        health = node_health.SharedNodeHealth(16)
+        self.assertEquals(health.get_load(_node()), None)
+        health.set_load(_node(), 7, 100.0)
+        self.assertEquals(health.get_load(_node()), (7, 100.0))
+        self.assertEquals(health.get_latency(_node()), None)
+
+    def test_eviction(self):
+        health = node_health.SharedNodeHealth(2)
+        health.set_latency(_node('sda'), 0.1, 0, 100.0)
+        health.set_latency(_node('sdb'), 0.2, 0, 200.0)
+        health.set_latency(_node('sdc'), 0.3, 0, 300.0)
+        # only the least recently updated device was dropped
+        self.assertEquals(health.get_latency(_node('sda')), None)
+        self.assertEquals(health.get_latency(_node('sdb')), (0.2, 0, 200.0))
+        self.assertEquals(health.get_latency(_node('sdc')), (0.3, 0, 300.0))
+
+    def test_shared_with_forked_workers(self):
+        health = node_health.SharedNodeHealth(16)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                health.store_errors(dict(_node(), errors=5, last_error=1.0))
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        node = _node()
+        health.load_errors(node)
+        self.assertEquals(node['errors'], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
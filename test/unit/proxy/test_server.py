@@ -650,6 +650,165 @@ class TestProxyServer(unittest.TestCase):
                           {'region': 2, 'zone': 1, 'ip': '127.0.0.1'}]
             self.assertEquals(exp_sorted, app_sorted)
 
+    def _latency_app(self, sorting_method='latency'):
+        return proxy_server.Application({'sorting_method': sorting_method,
+                                         'latency_half_life': '10'},
+                                        FakeMemcache(),
+                                        container_ring=FakeRing(),
+                                        object_ring=FakeRing(),
+                                        account_ring=FakeRing())
+
+    def test_node_latency_stats(self):
+        baseapp = self._latency_app()
+        node = {'ip': '127.0.0.1', 'port': 6000, 'device': 'sda'}
+        with mock.patch('swift.proxy.server.time', lambda: 100.0):
+            baseapp.record_node_response(node, 0.1)
+            self.assertEquals(baseapp.node_latency_score(node), 0.1)
+            baseapp.record_node_response(node, 1.1, error=True)
+            latency, error_rate, updated = baseapp.node_latencies[
+                ('127.0.0.1', 6000, 'sda')]
+            self.assertAlmostEquals(latency, 0.4)
+            self.assertAlmostEquals(error_rate, 0.3)
+            self.assertEquals(updated, 100.0)
+            self.assertAlmostEquals(baseapp.node_latency_score(node), 0.7)
+        # the score decays with age
+        self.assertAlmostEquals(baseapp.node_latency_score(node, 110.0), 0.35)
+        # and so do the stored averages before a new sample is blended in
+        with mock.patch('swift.proxy.server.time', lambda: 110.0):
+            baseapp.record_node_response(node, 0.1)
+        latency, error_rate, updated = baseapp.node_latencies[
+            ('127.0.0.1', 6000, 'sda')]
+        self.assertAlmostEquals(latency, 0.3 * 0.1 + 0.7 * 0.2)
+        self.assertAlmostEquals(error_rate, 0.7 * 0.15)
+        self.assertEquals(updated, 110.0)
+        # unknown devices, even on a known host, score 0
+        self.assertEquals(baseapp.node_latency_score(
+            {'ip': '127.0.0.1', 'port': 6000, 'device': 'sdb'}), 0.0)
+
+        # nothing is recorded for other sorting methods
+        baseapp = self._latency_app('shuffle')
+        baseapp.record_node_response(node, 0.1)
+        self.assertEquals(baseapp.node_latencies, {})
+
+    def test_invalid_latency_half_life(self):
+        for value in ('0', '-1'):
+            self.assertRaises(
+                ValueError, proxy_server.Application,
+                {'latency_half_life': value}, FakeMemcache(),
+                container_ring=FakeRing(), object_ring=FakeRing(),
+                account_ring=FakeRing())
+
+    def test_node_latency_sorting(self):
+        baseapp = self._latency_app()
+        nodes = [{'ip': '127.0.0.1', 'port': 6000, 'device': 'sda'},
+                 {'ip': '127.0.0.1', 'port': 6000, 'device': 'sdb'},
+                 {'ip': '127.0.0.2', 'port': 6000, 'device': 'sda'}]
+        baseapp.record_node_response(nodes[0], 0.5)
+        baseapp.record_node_response(nodes[1], 0.01)
+        baseapp.record_node_response(nodes[2], 0.01, error=True)
+        with mock.patch('swift.proxy.server.shuffle', lambda l: l):
+            res = baseapp.sort_nodes(list(nodes))
+        self.assertEquals(res, [nodes[1], nodes[0], nodes[2]])
+
+    def test_node_power_of_two(self):
+        baseapp = self._latency_app('power_of_two')
+        nodes = [{'ip': '127.0.0.1', 'port': 6000, 'device': 'sda'},
+                 {'ip': '127.0.0.1', 'port': 6000, 'device': 'sdb'},
+                 {'ip': '127.0.0.2', 'port': 6000, 'device': 'sda'}]
+        baseapp.record_node_response(nodes[0], 0.5)
+        baseapp.record_node_response(nodes[1], 0.01)
+        baseapp.record_node_response(nodes[2], 0.1)
+        choices = [[0, 2], [0, 1]]
+        with mock.patch('swift.proxy.server.shuffle', lambda l: l):
+            with mock.patch('swift.proxy.server.sample',
+                            lambda population, k: choices.pop(0)):
+                res = baseapp.sort_nodes(list(nodes))
+        self.assertEquals(res, [nodes[2], nodes[1], nodes[0]])
+        # every node is returned whatever the random choices
+        res = baseapp.sort_nodes(list(nodes))
+        self.assertEquals(sorted(res), sorted(nodes))
+
+    def test_node_load_hints(self):
+        baseapp = self._latency_app()
+        nodes = [{'ip': '127.0.0.1', 'port': 6000, 'device': 'sda'},
+                 {'ip': '127.0.0.1', 'port': 6000, 'device': 'sdb'}]
+        with mock.patch('swift.proxy.server.time', lambda: 100.0):
+            baseapp.record_node_response(nodes[0], 0.01)
+            baseapp.record_node_response(nodes[1], 0.02)
+            baseapp.record_node_load(nodes[0], 'active=2 queued=3')
+            baseapp.record_node_load(nodes[1], 'bogus')
+            self.assertEquals(baseapp.node_loads,
+                              {('127.0.0.1', 6000, 'sda'): (5, 100.0)})
+            self.assertAlmostEquals(baseapp.node_latency_score(nodes[0]),
+                                    0.06)
+            with mock.patch('swift.proxy.server.shuffle', lambda l: l):
+                res = baseapp.sort_nodes(list(nodes))
+            self.assertEquals(res, [nodes[1], nodes[0]])
+        # load hints expire
+        self.assertAlmostEquals(baseapp.node_latency_score(nodes[0], 110.0),
+                                0.005)
+
+        # load hints are ignored by other sorting methods
+        baseapp = self._latency_app('shuffle')
+        baseapp.record_node_load(nodes[0], 'active=2 queued=3')
+        self.assertEquals(baseapp.node_loads, {})
+
+    def test_node_load_recorded_from_responses(self):
+        baseapp = self._latency_app()
+        with save_globals():
+            set_http_connect(200, headers={'x-backend-load': 'active=4'})
+            req = Request.blank('/v1/a', environ={'REQUEST_METHOD': 'HEAD'})
+            baseapp.update_request(req)
+            resp = baseapp.handle_request(req)
+            self.assertEquals(resp.status_int, 200)
+            # but not passed on to the client
+            self.assertFalse('x-backend-load' in resp.headers)
+        self.assertEquals([load for load, updated in
+                           baseapp.node_loads.values()], [4])
+
+    def test_node_latency_recorded_from_responses(self):
+        baseapp = self._latency_app()
+        with save_globals():
+            set_http_connect(503, 200)
+            req = Request.blank('/v1/a', environ={'REQUEST_METHOD': 'HEAD'})
+            baseapp.update_request(req)
+            with mock.patch('swift.proxy.server.shuffle', lambda l: l):
+                resp = baseapp.handle_request(req)
+            self.assertEquals(resp.status_int, 200)
+        self.assertEquals(
+            sorted(stats[1] for stats in baseapp.node_latencies.values()),
+            [0.0, 1.0])
+
+    def test_global_conf_callback(self):
+        global_conf = {}
+        proxy_server.global_conf_callback({}, global_conf)
+        self.assertEquals(global_conf, {})
+        proxy_server.global_conf_callback({'node_health_slots': '64'},
+                                          global_conf)
+        self.assertEquals(global_conf.keys(), ['node_health'])
+        self.assertEquals(global_conf['node_health'][0].size, 64)
+
+    def test_shared_node_health(self):
+        global_conf = {}
+        proxy_server.global_conf_callback(
+            {'node_health_slots': '64'}, global_conf)
+        conf = dict(global_conf, sorting_method='latency')
+        workers = [proxy_server.Application(conf, FakeMemcache(),
+                                            container_ring=FakeRing(),
+                                            object_ring=FakeRing(),
+                                            account_ring=FakeRing())
+                   for _junk in range(2)]
+        # each worker has its own copy of the ring's node dicts
+        node = {'ip': '127.0.0.1', 'port': 6000, 'device': 'sda'}
+        other_node = dict(node)
+        self.assertFalse(workers[1].error_limited(other_node))
+        workers[0].error_limit(node, 'test')
+        self.assertTrue(workers[1].error_limited(other_node))
+
+        workers[0].record_node_response(node, 0.5)
+        self.assertEquals(workers[1].node_latency_score(other_node, 0), 0.5)
+        self.assertEquals(workers[0].node_latencies, {})
+
 
 class TestObjectController(unittest.TestCase):
 